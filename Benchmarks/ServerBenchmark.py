@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Throughput and latency benchmark of the Qweather instrument servers against simulated hardware.
+
+The servers are run in this process on the simulated visa backend (see Servers/VisaBackend.py), and every
+acquisition is split in stages that are timed separately:
+
+    io            instrument I/O, the transfer from the (simulated) instrument
+    conversion    conversion of the raw data to numpy arrays and packing of the reply
+    serialization pickling of the reply, as it is sent through the QWeatherStation
+    decode        unpickling and decoding of the reply on the client side
+
+With --broker the same QMethods are also called through a running QWeatherStation, which adds the stage
+roundtrip, from the call on the client until the reply is decoded. Start the servers with
+QWEATHER_VISA_BACKEND=sim (and the camera server in demo mode) first.
+
+The camera targets take their frames from the synthetic camera of the demo mode (see Servers/SyntheticCamera.py),
+seeded so every run sees the same frames. CameraPipeline follows a whole absorption shot through the camera GUI:
+the triplet is grabbed, sent and decoded, processed to an optical depth image and fitted with a 2-D Gaussian.
+
+The results (p50/p99 latency per stage and throughput) are written as JSON, so they can be compared between changes::
+
+    python ServerBenchmark.py --repeats 50 --out benchmark.json
+    python ServerBenchmark.py --broker tcp://127.0.0.1:5559 --out benchmark.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(HERE,'..','Servers'))
+sys.path.insert(0,os.path.join(HERE,'..','Clients'))
+
+import VisaBackend as vb
+
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+def summarize(times):
+    """p50, p99, mean and max of a list of times in seconds"""
+    times = np.asarray(times)
+    return {'p50':float(np.percentile(times,50)),
+            'p99':float(np.percentile(times,99)),
+            'mean':float(times.mean()),
+            'max':float(times.max())}
+
+
+def decode(reply):
+    """Decode a reply the way the clients do, so the cost of getting numpy arrays out of it is included"""
+    reply = pickle.loads(reply)
+    if isinstance(reply,dict) and 'frame_id' in reply:
+        from CameraFrames import Frame
+        Frame(reply).image
+    elif isinstance(reply,dict) and 'buffer' in reply:
+        from OscilloscopeTraces import Trace
+        trace = Trace(reply)
+        trace.data
+        trace.time
+    return reply
+
+
+class Target:
+    """An acquisition to benchmark. Subclasses set name and define the stages as methods,
+    each stage gets the result of the previous one
+
+    :param repeats: number of acquisitions to time
+    :type repeats: int"""
+    name = ''
+    stages = []
+    unit = 'traces'
+
+    def __init__(self,repeats):
+        self.repeats = repeats
+
+    def setup(self):
+        pass
+
+    def count(self,result):
+        """Number of samples and bytes of an acquisition"""
+        return 0,0
+
+    def run(self):
+        self.setup()
+        times = dict((astage,[]) for astage in self.stages)
+        totals = []
+        samples = 0
+        nbytes = 0
+        for i in range(self.repeats):
+            result = None
+            start = time.perf_counter()
+            for astage in self.stages:
+                t0 = time.perf_counter()
+                result = getattr(self,astage)(result)
+                times[astage].append(time.perf_counter() - t0)
+                if astage == 'serialization':
+                    asamples,abytes = self.count(result)
+                    samples += asamples
+                    nbytes += abytes
+            totals.append(time.perf_counter() - start)
+        elapsed = sum(totals)
+        return {'stages':dict((astage,summarize(atimes)) for astage,atimes in times.items()),
+                'total':summarize(totals),
+                'throughput':{'{:s}_per_s'.format(self.unit):self.repeats/elapsed,
+                              'samples_per_s':samples/elapsed,
+                              'bytes_per_s':nbytes/elapsed},
+                'repeats':self.repeats}
+
+
+def make_server(module,**attributes):
+    """Make a server object without connecting it to the QWeatherStation, and open its simulated hardware"""
+    server = module.Server.__new__(module.Server)
+    server.verbose = False
+    server.debug = False
+    for key,value in attributes.items():
+        setattr(server,key,value)
+    return server
+
+
+class ScopeTarget(Target):
+    """A single trace of several channels from an oscilloscope server, as sent by multi_measurement"""
+    stages = ['io','conversion','serialization','decode']
+
+    def __init__(self,repeats,model,channels=(1,2)):
+        super().__init__(repeats)
+        self.name = model
+        self.model = model
+        self.channels = list(channels)
+
+    def setup(self):
+        import OscilloscopeTools as ot
+        self.ot = ot
+        self.server = make_server(__import__(self.model),address='TCPIP0::simulated::INSTR')
+        self.server.initialize_hardware()
+        if self.model == 'DS1104Z':
+            self.pack = ot.pack_rigol_trace
+        else:
+            self.pack = ot.pack_rs_trace
+
+    def io(self,result):
+        if self.model == 'DS1104Z':
+            #Reading and scaling of the codes are done chunk by chunk, so conversion is part of io on this model
+            return self.server.get_multichannel_data(self.channels)
+        sources = ['CHAN{:d}'.format(achan) for achan in self.channels]
+        heads = self.ot.query_headers(self.server.hardware,sources)
+        return [sources,self.ot.query_blocks(self.server.hardware,sources),heads]
+
+    def conversion(self,result):
+        sources,data,heads = result
+        if self.model != 'DS1104Z':
+            data = self.ot.stack_blocks(data,self.server.hardware.dtype)
+        return self.pack(data,sources,heads)
+
+    def serialization(self,result):
+        return pickle.dumps(result)
+
+    def decode(self,result):
+        return decode(result)
+
+    def count(self,result):
+        trace = pickle.loads(result)
+        return int(np.prod(trace['shape'])),len(result)
+
+
+class CounterTarget(Target):
+    """An array of frequencies and timestamps from the CNT90 server, as sent by get_frequency"""
+    stages = ['io','conversion','serialization','decode']
+    unit = 'arrays'
+
+    def __init__(self,repeats,npoints=10000,gatetime=1e-4):
+        super().__init__(repeats)
+        self.name = 'CNT90'
+        self.npoints = npoints
+        self.gatetime = gatetime
+
+    def setup(self):
+        self.server = make_server(__import__('CNT90'),USBport='USB0::simulated::INSTR')
+        self.server.initialize_hardware()
+
+    def io(self,result):
+        return self.server.get_frequency(self.npoints,self.gatetime,1,binary=True)
+
+    def conversion(self,result):
+        return self.server.convert_binary_to_float(result,self.npoints)
+
+    def serialization(self,result):
+        return pickle.dumps(result)
+
+    def decode(self,result):
+        return decode(result)
+
+    def count(self,result):
+        return self.npoints,len(result)
+
+
+class CameraTarget(Target):
+    """A single image from the BlackFly camera server in demo mode, as sent by getImage"""
+    stages = ['io','serialization','decode']
+    unit = 'frames'
+
+    def __init__(self,repeats,bins=1,tof=0):
+        super().__init__(repeats)
+        self.name = 'BlackFlyCamera'
+        self.bins = bins
+        self.tof = tof
+
+    def setup(self):
+        module = __import__('BlackFlyCameraServer')
+        from SyntheticCamera import SyntheticCamera
+        module.demo = True
+        self.synthetic = SyntheticCamera(module.SENSORSHAPE,tof=self.tof,seed=0)
+        self.server = make_server(module,bit8=True,synthetic=self.synthetic,frame_id=0,acquisition=None,absorption=None,framecompression=None,
+                                  bins=self.bins,sensorroi=None)
+        self.server._apply_roi()
+        self.npixels = int(np.prod(self.server.frameFormat()['shape']))
+
+    def io(self,result):
+        return self.server.getImage()
+
+    def serialization(self,result):
+        return pickle.dumps(result)
+
+    def decode(self,result):
+        return decode(result)
+
+    def count(self,result):
+        return self.npixels,len(result)
+
+
+class CameraPipelineTarget(CameraTarget):
+    """An absorption imaging shot from the synthetic camera through the camera GUI: the (atoms, probe, background) triplet
+    as sent by getImage, the optical depth in a 300 x 300 pixel region of interest around the cloud as calculated by the GUI,
+    and the 2-D Gaussian fit of the region"""
+    stages = ['io','serialization','decode','processing','fitting']
+    unit = 'shots'
+
+    def __init__(self,repeats,bins=2,tof=1):
+        super().__init__(repeats,bins,tof)
+        self.name = 'CameraPipeline'
+
+    def setup(self):
+        super().setup()
+        from ImageProcessing import ImageProcessor
+        import GaussianFitting as gf
+        self.processor = ImageProcessor(0.1)
+        self.fit = gf.fit_gaussian2d
+        center,sigma,peak = self.synthetic.cloud()
+        self.size = (300,300)
+        self.pos = (center[0]/self.bins - self.size[0]/2,center[1]/self.bins - self.size[1]/2)
+
+    def io(self,result):
+        self.synthetic.count = 0
+        return [self.server.getImage() for i in range(3)]
+
+    def serialization(self,result):
+        return [pickle.dumps(aframe) for aframe in result]
+
+    def decode(self,result):
+        from CameraFrames import Frame
+        return [Frame(pickle.loads(aframe)).image for aframe in result]
+
+    def processing(self,result):
+        atoms,probe,background = result
+        od,roi = self.processor.process(atoms,probe,self.pos,self.size)
+        return roi
+
+    def fitting(self,result):
+        return self.fit(result)
+
+    def count(self,result):
+        return 3*self.npixels,sum(len(aframe) for aframe in result)
+
+
+async def broker_roundtrip(address,calls,repeats):
+    """Time QMethod calls through a running QWeatherStation, including the decoding of the reply
+
+    :param address: address of the QWeatherStation
+    :param calls: dictionary of name: (servername, QMethod name, args)
+    :return: dictionary of name: results"""
+    from qweather import QWeatherClient
+    loop = asyncio.get_event_loop()
+    client = QWeatherClient(address,name='ServerBenchmark',loop=loop)
+    loop.create_task(client.run())
+    servers = dict((aserv.name,aserv) for aserv in client)
+    results = {}
+    for name,(servername,method,args) in calls.items():
+        if servername not in servers:
+            results[name] = {'skipped':'{:s} is not connected to the QWeatherStation'.format(servername)}
+            continue
+        qmethod = getattr(servers[servername],method)
+        times = []
+        for i in range(repeats):
+            t0 = time.perf_counter()
+            reply = await qmethod(*args)
+            decode(pickle.dumps(reply))
+            times.append(time.perf_counter() - t0)
+        results[name] = {'stages':{'roundtrip':summarize(times)},
+                         'throughput':{'calls_per_s':repeats/sum(times)},
+                         'repeats':repeats}
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],cwd=HERE).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Qweather instrument servers against simulated hardware')
+    parser.add_argument('--repeats',type=int,default=50,help='acquisitions per target')
+    parser.add_argument('--latency',type=float,default=vb.LATENCY,help='simulated latency per message in s')
+    parser.add_argument('--bandwidth',type=float,default=vb.BANDWIDTH,help='simulated bandwidth in bytes/s')
+    parser.add_argument('--targets',nargs='*',default=['RTB2004','HMO3004','RTO1044','DS1104Z','CNT90','BlackFlyCamera','CameraPipeline'])
+    parser.add_argument('--bins',type=int,default=2,help='binning of the synthetic camera in CameraPipeline')
+    parser.add_argument('--tof',type=float,default=1,help='time of flight of the synthetic cloud in CameraPipeline in ms')
+    parser.add_argument('--broker',default=None,help='address of a QWeatherStation to also time the calls through, e.g. tcp://127.0.0.1:5559')
+    parser.add_argument('--out',default='benchmark.json',help='JSON file to write the results to')
+    args = parser.parse_args()
+
+    vb.set_backend('sim',args.latency,args.bandwidth)
+    targets = {'RTB2004':lambda: ScopeTarget(args.repeats,'RTB2004'),
+               'HMO3004':lambda: ScopeTarget(args.repeats,'HMO3004'),
+               'RTO1044':lambda: ScopeTarget(args.repeats,'RTO1044'),
+               'DS1104Z':lambda: ScopeTarget(args.repeats,'DS1104Z'),
+               'CNT90':lambda: CounterTarget(args.repeats),
+               'BlackFlyCamera':lambda: CameraTarget(args.repeats),
+               'CameraPipeline':lambda: CameraPipelineTarget(args.repeats,args.bins,args.tof)}
+    report = {'config':{'repeats':args.repeats,
+                        'latency':args.latency,
+                        'bandwidth':args.bandwidth,
+                        'bins':args.bins,
+                        'tof':args.tof,
+                        'date':datetime.datetime.now().isoformat(),
+                        'commit':git_commit(),
+                        'python':platform.python_version(),
+                        'numpy':np.__version__,
+                        'machine':platform.node()},
+              'results':{},
+              'skipped':{'NI6259':'The DAQ servers talk to the card through PyDAQmx, which has no simulated backend'}}
+    for aname in args.targets:
+        print('Benchmarking {:s}'.format(aname))
+        try:
+            report['results'][aname] = targets[aname]().run()
+        except ImportError as e:
+            report['skipped'][aname] = 'Missing dependency: {:}'.format(e)
+            print(report['skipped'][aname])
+
+    if args.broker is not None:
+        calls = {'RTB2004':('RTB2004OSC','multi_measurement',([1,2],)),
+                 'HMO3004':('HMO3004OSC','multi_measurement',([1,2],)),
+                 'DS1104Z':('DS1104ZOSC','multi_measurement',([1,2],)),
+                 'CNT90':('FreqCounter','get_frequency',(10000,1e-4)),
+                 'BlackFlyCamera':('BlackflyCamera','getImage',())}
+        report['broker'] = asyncio.get_event_loop().run_until_complete(broker_roundtrip(args.broker,calls,args.repeats))
+
+    with open(args.out,'w') as f:
+        json.dump(report,f,indent=2)
+    print('Results written to {:s}'.format(args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,10 @@ from PyQt5.QtWidgets import *
 from PyQt5 import QtGui,QtCore
 import pyqtgraph as pg
 from qweather import QWeatherClient
+import asyncio
+import QtLoop
+import time
+import numpy as np
 
 import sys
 sys.path.append('..')
@@ -10,35 +14,51 @@ from OscilloscopeLauncher import multidialog,OscilloscopeWidget
 
 class AcetyleneOscilloscope(QWidget):
 
-    def __init__(self):
+    colors = ['#FFFFFF','#2E2EFE','#2EFEF7','#2EFE2E']
+
+    def __init__(self,loop = None):
         super(AcetyleneOscilloscope,self).__init__()
+        QWeatherStationIP = "tcp://10.90.61.231:5559"
+        if loop is None:
+            self.loop = asyncio.get_event_loop()
+        else:
+            self.loop = loop
+        self.client = QWeatherClient(QWeatherStationIP,name='AcetyleneOscilloscope',loop=self.loop)
+        self.osclist = {}
+        for aserv in self.client:
+            if aserv.name[-3:] == 'OSC':
+                self.osclist[aserv.name[:-3]] = aserv
         self.listofservers = []
+        self.frame = None
+        self.mirrortask = None
+        self.received = 0
+        self.drawn = 0
+        self.dropped = 0
+        self.ratetime = time.time()
+        self.drawtimer = QtCore.QTimer()
+        self.drawtimer.setInterval(20)
+        self.drawtimer.timeout.connect(self.draw_frame)
+        self.ratetimer = QtCore.QTimer()
+        self.ratetimer.setInterval(1000)
+        self.ratetimer.timeout.connect(self.update_rate)
         self.initializeGui()
-        self.guiprocess = None
+        self.loop.create_task(self.client.run())
 
 
     def initializeGui(self):
-        layout = QHBoxLayout()
+        layout = QVBoxLayout()
 
         osc_panel = self.make_osc_panel()
         #self.serverlayout = QVBoxLayout()
         #server_panel = self.make_server_panel()
+        layout.addWidget(self.make_mirror_panel())
         layout.addWidget(osc_panel)
         self.setLayout( layout)
 
 
         #self.serverlayout.addWidget(server_panel)
-        buttonlayout = QHBoxLayout()
-
-        startbutton = QPushButton('Start Oscilloscope Mirror')
-
-        buttonlayout.addWidget(startbutton)
-
-        layout.addLayout(buttonlayout)
         #layout.addLayout(self.serverlayout)
 
-        startbutton.clicked.connect(self.start_clicked)
-
         self.show()
 
     def make_server_panel(self):
@@ -55,10 +75,10 @@ class AcetyleneOscilloscope(QWidget):
         return newserver
 
     def make_osc_panel(self):
+        """Four channels in linked ViewBoxes, each with its own axis.
+        The curves clip to the view and downsample with peak detection, so zooming and large traces stay cheap to draw"""
         self.display = pg.PlotWidget()
-        self.channels = [pg.PlotItem() for i in range(4)]
-        for achan in self.channels:
-            self.display.addItem(achan)
+
         # Axis
         a2 = pg.AxisItem("left")
         a3 = pg.AxisItem("left")
@@ -84,6 +104,7 @@ class AcetyleneOscilloscope(QWidget):
         pI = pg.PlotItem()
         v1 = pI.vb # reference to viewbox of the plotitem
         l.addItem(pI, row = 2, col = 4,  rowspan=1, colspan=1) # add plotitem to layout
+        pI.getAxis("bottom").setLabel('Time', units='s')
 
         # add viewboxes to layout 
         l.scene().addItem(v2)
@@ -100,11 +121,17 @@ class AcetyleneOscilloscope(QWidget):
         v3.setXLink(v2)
         v4.setXLink(v3)
 
-        # axes labels
-        pI.getAxis("left").setLabel('axis 1 in ViewBox of PlotItem', color='#FFFFFF')
-        a2.setLabel('axis 2 in Viewbox 2', color='#2E2EFE')
-        a3.setLabel('axis 3 in Viewbox 3', color='#2EFEF7')
-        a4.setLabel('axis 4 in Viewbox 4', color='#2EFE2E')
+        self.viewboxes = [v1,v2,v3,v4]
+        self.axes = [pI.getAxis("left"),a2,a3,a4]
+        self.curves = []
+        for i,(aview,aaxis,acolor) in enumerate(zip(self.viewboxes,self.axes,self.colors)):
+            aaxis.setLabel('CHAN{:d}'.format(i+1), units='V', color=acolor)
+            curve = pg.PlotDataItem(pen=acolor)
+            curve.setClipToView(True)
+            curve.setDownsampling(auto=True,method='peak')
+            aview.addItem(curve)
+            aview.enableAutoRange(axis=pg.ViewBox.XYAxes, enable=True)
+            self.curves.append(curve)
 
         # slot: update view when resized
         def updateViews():
@@ -113,33 +140,106 @@ class AcetyleneOscilloscope(QWidget):
             v3.setGeometry(v1.sceneBoundingRect())
             v4.setGeometry(v1.sceneBoundingRect())
 
-        # data
-        x = [1,2,3,4,5,6]
-        y1 = [0,4,6,8,10,4]
-        y2 = [0,5,7,9,11,3]
-        y3 = [0,1,2,3,4,12]
-        y4 = [0,8,0.3,0.4,2,5]
-
-        # plot
-        v1.addItem(pg.PlotCurveItem(x, y1, pen='#FFFFFF'))
-        v2.addItem(pg.PlotCurveItem(x, y2, pen='#2E2EFE'))
-        v3.addItem(pg.PlotCurveItem(x, y3, pen='#2EFEF7'))
-        v4.addItem(pg.PlotCurveItem(x, y4, pen='#2EFE2E'))
-
         # updates when resized
         v1.sigResized.connect(updateViews)
 
-        # autorange once to fit views at start
-        v2.enableAutoRange(axis= pg.ViewBox.XYAxes, enable=True)
-        v3.enableAutoRange(axis= pg.ViewBox.XYAxes, enable=True)
-        v4.enableAutoRange(axis= pg.ViewBox.XYAxes, enable=True)
-
         updateViews()    
         return self.display
 
-
-
-
+    def make_mirror_panel(self):
+        panel = QFrame()
+        layout = QHBoxLayout()
+        self.oscselector = QComboBox()
+        [self.oscselector.addItem(oscname) for oscname in self.osclist.keys()]
+        self.channelboxes = []
+        layout.addWidget(self.oscselector)
+        for i,acolor in enumerate(self.colors):
+            abox = QCheckBox('CH{:d}'.format(i+1))
+            abox.setChecked(True)
+            abox.setStyleSheet('color: {:s}'.format(acolor))
+            self.channelboxes.append(abox)
+            layout.addWidget(abox)
+        self.mirrorbutton = QPushButton('Live Mirror')
+        self.mirrorbutton.setCheckable(True)
+        self.mirrorbutton.toggled.connect(self.mirror_toggled)
+        self.ratelabel = QLabel('')
+        layout.addWidget(self.mirrorbutton)
+        layout.addWidget(self.ratelabel)
+        layout.addStretch()
+        panel.setLayout(layout)
+        return panel
+
+    def mirror_toggled(self,checked):
+        if checked:
+            if self.oscselector.currentText() == '':
+                self.mirrorbutton.setChecked(False)
+                return
+            channels = [i+1 for i,abox in enumerate(self.channelboxes) if abox.isChecked()]
+            self.oscselector.setEnabled(False)
+            [abox.setEnabled(False) for abox in self.channelboxes]
+            self.mirrortask = self.loop.create_task(self.mirror(self.osclist[self.oscselector.currentText()],channels))
+            self.ratetime = time.time()
+            self.drawtimer.start()
+            self.ratetimer.start()
+        else:
+            if self.mirrortask is not None:
+                self.mirrortask.cancel()
+                self.mirrortask = None
+            self.drawtimer.stop()
+            self.ratetimer.stop()
+            self.oscselector.setEnabled(True)
+            [abox.setEnabled(True) for abox in self.channelboxes]
+
+    async def mirror(self,server,channels):
+        """Request traces as fast as the oscilloscope delivers them, one request at a time.
+        The server reduces every trace to a min/max envelope of about one point pair per pixel, so the size of the replies
+        does not depend on the record length. Only the newest reply is kept for drawing, older replies that have not been
+        drawn yet are dropped, so a slow redraw does not make the mirror lag behind the oscilloscope."""
+        while self.mirrorbutton.isChecked():
+            npoints = max(100,int(self.viewboxes[0].width()))
+            try:
+                result = await server.reduced_measurement(channels,[['minmax',{'npoints':npoints}]])
+            except Exception as e:
+                print('Mirror error:',e)
+                await asyncio.sleep(1)
+                continue
+            if result is None or isinstance(result,Exception):
+                await asyncio.sleep(0.1)
+                continue
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = (channels,result)
+            self.received += 1
+
+    def draw_frame(self):
+        """Draw the newest frame, called by a timer so drawing runs at most at the timer rate"""
+        if self.frame is None:
+            return
+        channels,result = self.frame
+        self.frame = None
+        envelope = result['minmax']
+        npoints = envelope['min'].shape[-1]
+        # every bin is drawn as a vertical line from its min to its max
+        t = np.repeat(envelope['t0'] + envelope['dt']*np.arange(npoints),2)
+        y = np.empty(2*npoints,dtype=envelope['min'].dtype)
+        for i,acurve in enumerate(self.curves):
+            if i+1 in channels:
+                index = channels.index(i+1)
+                y[0::2] = envelope['min'][index]
+                y[1::2] = envelope['max'][index]
+                acurve.setData(t,y)
+            else:
+                acurve.clear()
+        self.drawn += 1
+
+    def update_rate(self):
+        now = time.time()
+        elapsed = now - self.ratetime
+        self.ratelabel.setText('{:.1f} fps received, {:.1f} fps drawn, {:d} dropped'.format(self.received/elapsed,self.drawn/elapsed,self.dropped))
+        self.drawn = 0
+        self.dropped = 0
+        self.received = 0
+        self.ratetime = now
 
     def create_clicked(self):
         newserverinfo = multidialog()
@@ -159,21 +259,8 @@ class AcetyleneOscilloscope(QWidget):
                 self.serverlayout.addWidget(newserver,row,len(self.listofservers)%3)
             self.listofservers.append(newserver)
 
-    def start_clicked(self):
-        if self.guiprocess is not None:
-            donebox = QMessageBox()
-            donebox.setText('Oscilloscope is already running')
-            donebox.exec()
-        else:
-            self.guiprocess = QtCore.QProcess()
-            self.guiprocess.finished.connect(self.reinitialize_gui_state)
-            self.guiprocess.start('python',['-u','Z:\Dataprogrammer\Qweather\Clients\OscilloscopeGUI.py'])
-
-
-    def reinitialize_gui_state(self):
-        self.guiprocess = None
-
     def closeEvent(self,evnt):
+        self.mirrorbutton.setChecked(False)
         print(self.listofservers)
         for aserver in self.listofservers:
             aserver.kill_server()
@@ -198,6 +285,7 @@ if __name__=="__main__":
     import ctypes
     myappid = u'mycompany.myproduct.subproduct.version4' # arbitrary string
     ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
-    w = AcetyleneOscilloscope()
-    sys.exit(a.exec_())
+    loop = QtLoop.make_loop(a)
+    w = AcetyleneOscilloscope(loop)
+    QtLoop.run(loop)
 
@@ -8,7 +8,7 @@
 from PyQt5.QtWidgets import *
 from PyQt5 import QtGui,QtCore
 import sys
-import asyncio
+import QtLoop
 import time
 import numpy as np
 import pyqtgraph as pg
@@ -269,10 +269,6 @@ class aowindow(QSplitter):
         plotpanel.aoplotfig.showGrid(x=True, y=True)
         plotpanel.aoplotfig.addItem(pg.InfiniteLine(0,angle=0))
 
-async def process_events(qapp):
-    while True:
-        await asyncio.sleep(0.1)
-        qapp.processEvents()
 
 class mySpinbox(QDoubleSpinBox):
     def __init__(self):
@@ -362,10 +358,9 @@ if __name__=="__main__":
     import ctypes
     myappid = u'mycompany.myproduct.subproduct.version2' # arbitrary string
     ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
-    loop = asyncio.get_event_loop()
+    loop = QtLoop.make_loop(a)
     w = aowindow()
     w.show()
-    loop.create_task(process_events(a))
-    loop.run_until_complete(process_events(a))
+    QtLoop.run(loop)
 
 
@@ -1,6 +1,6 @@
 from PyQt5.QtWidgets import *
 from PyQt5 import QtGui
-import asyncio
+import QtLoop
 import sys
 sys.path.append('../')
 from qweather import QWeatherStation
@@ -88,10 +88,6 @@ class BrokerGui(QWidget):
             event.ignore()
 
 
-async def process_events(qapp):
-    while True:
-        await asyncio.sleep(0)
-        qapp.processEvents()
 
 def icon():
     iconstring = ["40 40 4 1","   c #FFFFFF",".  c #000000","+  c #AE7C3C","@  c #FF1E00",
@@ -114,10 +110,9 @@ if __name__=="__main__":
    # ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
 #    loop = QEventLoop(a)
  #   asyncio.set_event_loop(loop)
-    loop = asyncio.get_event_loop()
+    loop = QtLoop.make_loop(a)
     w = BrokerGui(loop)
-    loop.run_until_complete(process_events(a))
+    QtLoop.run(loop)
 #    with loop:
  #      loop.run_until_complete(w.client.run())
 
-    sys.exit(a.exec_())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Client side helper for the compact frames returned by the camera servers
+
+A compact frame is a dictionary with the keys buffer, shape, dtype, frame_id and timestamp.
+The pixels are kept in the dtype of the camera and are only converted when a calculation needs it.
+12 bit images can come packed, two pixels in three bytes (entry packing), and buffers can be compressed losslessly (entry compression).
+The unpacking and the decompression are those of the servers (:py:func:`CameraTools.frame_array`), so the two sides can not drift apart.
+"""
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','Servers'))
+from CameraTools import frame_array
+
+
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+class Frame:
+    """Wraps a compact frame from a camera server.
+
+    :param packed: compact frame as returned by the server
+    :type packed: dict"""
+
+    def __init__(self,packed):
+        self.packed = packed
+        self.frame_id = packed['frame_id']
+        self.timestamp = packed['timestamp']
+        self.shape = tuple(packed['shape'])
+        self._data = None
+
+    @property
+    def data(self):
+        """The image as a numpy array of shape (rows, columns). Unless the frame is packed or compressed this is a read only view of the buffer, without copying"""
+        if self._data is None:
+            self._data = frame_array(self.packed)
+        return self._data
+
+    @property
+    def image(self):
+        """The image with shape (columns, rows) as pyqtgraph expects it, a transposed view of data"""
+        return self.data.T
+
+    def __getattr__(self,name):
+        if name in ('packed',):
+            raise AttributeError(name)
+        if name in self.packed:
+            return self.packed[name]
+        raise AttributeError(name)
+
+    @property
+    def nbytes(self):
+        """Number of bytes in the pixel buffer"""
+        return len(self.packed['buffer'])
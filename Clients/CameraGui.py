@@ -10,10 +10,12 @@ from PyQt5.QtWidgets import *
 from PyQt5 import QtGui,QtCore
 import sys
 import asyncio
+import QtLoop
 from qweather import QWeatherClient
 import time, datetime
 import os
 import numpy as np
+from CameraFrames import Frame
 import pyqtgraph as pg
 from matplotlib import cm
 from StrontiumBrainGUI import SrBrainGui, mySpinbox
@@ -92,8 +94,8 @@ class CamGui(QWidget):
     async def get_single_image(self,sender):
         self.camera.acquisitionMode('single')
         image = await self.camera.acquireSingleImage()
-        thisimage=QtGui.QImage(image,1920,1200,1920,QtGui.QImage.Format_Grayscale8)
-        self.update_images(thisimage)
+        if image:
+            self.update_images(image)
 
     async def log_images(self,stop):
         while not stop.is_set():
@@ -151,9 +153,7 @@ class CamGui(QWidget):
             self.stopcont.set()
 
     def update_images(self,image):
-        image = image.astype(float)
-        image = image.reshape(self.expectedPixels[1],self.expectedPixels[0])
-        image = np.transpose(image)
+        image = Frame(image).image.astype(np.float32)
         print(len(self.imagehistoryarray))
         if len(self.imagehistoryarray) > 1:
             self.imagehistoryarray = []
@@ -538,13 +538,6 @@ class CamGui(QWidget):
         self.loop.stop()
         '''
 
-async def process_events(qapp):
-    while True:
-        await asyncio.sleep(0.1)
-        qapp.processEvents()
-#        print(qapp.allWidgets())
-#        print(len(qapp.allWidgets()))
-#        qapp.connect.lastWindowClosed(lambda: qapp.quit())
 
 def icon():
     iconstring = ["77 63 806 2","    c None",".  c #A8ACA8","+   c #787C78","@   c #C0A070","#   c #605860","$   c #888888","%   c #606460","&   c #807880","*   c #888488","=   c #706C70","-   c #707470",";   c #101010",">   c #281C28",
@@ -675,8 +668,7 @@ if __name__=="__main__":
     import ctypes
     myappid = u'mycompany.myproduct.subproduct.version1' # arbitrary string
     ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
-    loop = asyncio.get_event_loop()
+    loop = QtLoop.make_loop(a)
     w = CamGui(loop)
-    loop.create_task(process_events(a))
-    loop.run_until_complete(process_events(a))
+    QtLoop.run(loop)
 
@@ -10,9 +10,11 @@ from PyQt5.QtWidgets import *
 from PyQt5 import QtGui,QtCore
 import sys
 import asyncio
+import QtLoop
 from qweather import QWeatherClient
 import time
 import numpy as np
+from CameraFrames import Frame
 import pyqtgraph as pg
 from matplotlib import cm
 import os
@@ -179,8 +181,8 @@ class CamGui(QWidget):
     async def get_single_image(self,sender):
         self.camera.acquisitionMode('single')
         image = await self.camera.acquireSingleImage()
-        thisimage=QtGui.QImage(image,1920,1200,1920,QtGui.QImage.Format_Grayscale8)
-        self.update_images(thisimage)
+        if image:
+            self.update_images(image)
 
 
 
@@ -212,9 +214,7 @@ class CamGui(QWidget):
             self.sender().setText('Start Temperature Measurement')
 
     def update_images(self,image):
-        image = image.astype(float)
-        image = image.reshape(self.expectedPixels[1],self.expectedPixels[0])
-        image = np.transpose(image)
+        image = Frame(image).image.astype(np.float32)
         if len(self.imagehistoryarray) > 1:
             self.imagehistoryarray = []
         self.imagehistoryarray.insert(0,image)
@@ -822,13 +822,6 @@ class EmittingStream(QtCore.QObject):
 
 
 
-async def process_events(qapp):
-    while True:
-        await asyncio.sleep(0.1)
-        qapp.processEvents()
-#        print(qapp.allWidgets())
-#        print(len(qapp.allWidgets()))
-#        qapp.connect.lastWindowClosed(lambda: qapp.quit())
 
 class PopupInspection(QDialog):
 
@@ -1036,8 +1029,7 @@ if __name__=="__main__":
     import ctypes
     myappid = u'mycompany.myproduct.subproduct.version1' # arbitrary string
     ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
-    loop = asyncio.get_event_loop()
+    loop = QtLoop.make_loop(a)
     w = CamGui(loop)
-    loop.create_task(process_events(a))
-    loop.run_until_complete(process_events(a))
+    QtLoop.run(loop)
 
@@ -10,9 +10,17 @@ from PyQt5.QtWidgets import *
 from PyQt5 import QtGui,QtCore
 import sys
 import asyncio
+import QtLoop
 from qweather import QWeatherClient
 import time
 import numpy as np
+from CameraFrames import Frame
+from ImageProcessing import ImageProcessor
+from FringeRemoval import FringeRemoval
+import GaussianFitting as gf
+from DataWriters import BackgroundWriter, write_image_stack
+import ScanEngine
+from TimeSeries import RollingSeries
 import pyqtgraph as pg
 from matplotlib import cm
 import os
@@ -58,7 +66,13 @@ class CamGui(QWidget):
         self.initialize_GUI()
         self.restore_GUI()
         self.saving = False
-        self.TempMeasuring = False
+        self.collector = ScanEngine.ShotCollector(self.loop)
+        self.processor = ImageProcessor(0.1)
+        self.fringeremoval = FringeRemoval(50)
+        self.fitter = gf.GaussianFitter()
+        self.writer = BackgroundWriter()
+        self.pendingsaves = 0
+        QApplication.instance().aboutToQuit.connect(self.shutdown)
         #sys.stdout = EmittingStream(textWritten = self.write_logmessage)
         #sys.stderr = EmittingStream(textWritten = self.write_logmessage)
         self.loop.create_task(self.client.run())
@@ -68,6 +82,7 @@ class CamGui(QWidget):
 
     def initialize_GUI(self):
         self.resultarray = []
+        self.resultinfo = []
         logpanel = self.make_logpanel()
         imagepanel = self.make_imagepanel()
 
@@ -168,40 +183,48 @@ class CamGui(QWidget):
         data = process.readAllStandardOutput()
         self.write_logmessage(msgprefix + ':' + str(data, 'utf-8'))    
 
-    async def grab_image(self,stop):
+    async def grab_image(self,stop,interval=0.02):
+        """Take the frames from the buffer of the camera server as they arrive. Frames that arrive while the last ones
+        are in transit or being processed wait in the buffer, and are all fetched with the next call.
+        The server is polled without waiting there, so other calls to the camera (exposure, stopGrabbing) are not held up,
+        and the client sleeps interval seconds when there were no new frames"""
+        nextrecord = 0
         while not stop.is_set():
-            image = await self.camera.getImage()
-            if image is None:
-                print('None')
-                pass
-            else:
-                self.update_images(image)
+            frames = await self.camera.getFramesSince(nextrecord,0)
+            if not frames:
+                await asyncio.sleep(interval)
+                continue
+            for aframe in frames:
+                self.update_images(aframe)
+            nextrecord = frames[-1]['record'] + 1
 
 
     async def get_single_image(self,sender):
         self.camera.acquisitionMode('single')
         image = await self.camera.acquireSingleImage()
-        thisimage=QtGui.QImage(image,1920,1200,1920,QtGui.QImage.Format_Grayscale8)
-        self.update_images(thisimage)
+        if image:
+            self.update_images(image)
 
 
 
     def wait_for_trigger_clicked(self,state):
         if state:
             self.imagehistoryarray = []
+            self.framehistory = []
             if self.SaveImagesBox.value() is not 0:
                 self.saving=True
                 self.resultarray = []
+                self.resultinfo = []
             self.sender().setText('Waiting for trigger (press to abort)')
             self.camera.acquisitionMode('cont')
             self.camera.triggerMode('on')
             self.camera.triggerSource('hardware')
             self.stopcont = asyncio.Event()
-            self.camera.beginAcquisition()
+            self.camera.startGrabbing()
             self.loop.create_task(self.grab_image(self.stopcont))
         if not state:
             self.sender().setText('Wait for trigger')
-            self.camera.endAcquisition()
+            self.camera.stopGrabbing()
             self.camera.triggerMode('off')
             self.stopcont.set()
 
@@ -220,46 +243,88 @@ class CamGui(QWidget):
     def calculate_optical_depth(self,diffimage):
         lambdalight = (461*10**(-9))
         sigma0= (1/(2*np.pi))*3*lambdalight**2
-        A = (2*5.86*1e-6)**2
+        A = self.pixelsize**2
         OD = diffimage
 
-        N = A/sigma0*sum(sum(OD))*10**(-6)
-        self.atomnumberlist.append(N)
+        N = A/sigma0*np.sum(OD,dtype=np.float64)*10**(-6)
+        self.atomnumbers.append(N)
         self.update_atom_number()
         self.db.write('MOT',tags={'Experiment':'Sr1'},fields={'Atom number':N})
         print("N = ",round(N,2), "million atoms")
 
     def update_atom_number(self):
-        self.numberplot.clear()
-        x = list(range(len(self.atomnumberlist)))
-        y = self.atomnumberlist
-        std = np.std(self.atomnumberlist)
-        mn = np.mean(self.atomnumberlist)
-        self.numberplot.plot(x,y)
-
-        pen = pg.mkPen(color=(255, 255, 255), style=QtCore.Qt.DashLine)
-        self.numberplot.plot([x[0],x[-1]],[mn+std,mn+std],pen=pen)
-        self.numberplot.plot([x[0],x[-1]],[mn-std,mn-std],pen=pen)
+        """Update the curves of the atom number plot with the last shots in the rolling series, the cost does not grow with the number of shots"""
+        x = self.atomnumbers.x
+        std = self.atomnumbers.std
+        mn = self.atomnumbers.mean
+        self.numbercurve.setData(x,self.atomnumbers.y)
+        self.numberupper.setData([x[0],x[-1]],[mn+std,mn+std])
+        self.numberlower.setData([x[0],x[-1]],[mn-std,mn-std])
         self.numbermean.setText('Mean: {:2.2f}'.format(mn))
         self.numberstd.setText('Std: {:2.2f}'.format(std))
+        total = self.atomnumbers.total
+        self.numbermean.setToolTip('All {:d} shots: {:2.2f} +- {:2.2f}'.format(total.count,total.mean,total.std))
 
     def clear_atomnumber(self):
-        self.atomnumberlist = []
+        self.atomnumbers.clear()
+        for acurve in (self.numbercurve,self.numberupper,self.numberlower):
+            acurve.setData([],[])
+
+
+    @property
+    def pixelsize(self):
+        """Side of an image pixel in meters, a sensor pixel times the binning of the last frame"""
+        return self.sensorpixel*self.frameformat[0]
+
+    def update_frame_format(self,frame):
+        """Follow changes of the binning and sensor region of the camera, which come with every frame.
+        The ROI is moved and scaled so it stays on the same part of the sensor, and the images of an unfinished triplet are dropped"""
+        frameformat = (getattr(frame,'binning',1),tuple(getattr(frame,'offset',(0,0))))
+        if frameformat == self.frameformat:
+            return
+        (oldbins,oldoffset),(bins,offset) = self.frameformat,frameformat
+        pos,size = self.ROI.pos(),self.ROI.size()
+        self.ROI.setPos([((oldoffset[i] + pos[i])*oldbins - offset[i]*bins)/bins for i in range(2)],finish=False)
+        self.ROI.setSize([size[i]*oldbins/bins for i in range(2)],finish=False)
+        self.frameformat = frameformat
+        self.imagehistoryarray = []
+        self.framehistory = []
+
+    def readout_roi_clicked(self,state):
+        """Read out only the part of the sensor under the ROI (with a margin of a quarter of the ROI), or the whole sensor again"""
+        if state:
+            bins,offset = self.frameformat
+            pos,size = self.ROI.pos(),self.ROI.size()
+            region = [int((offset[i] + pos[i] - size[i]/4)*bins) for i in range(2)] + [int(1.5*size[i]*bins) for i in range(2)]
+            result = self.camera.sensorROI(region)
+        else:
+            result = self.camera.sensorROI('full')
+        self.loop.create_task(self.report_camera_result(result,'Could not change the sensor region, stop waiting for trigger first'))
 
+    async def report_camera_result(self,result,message):
+        if not await result:
+            self.write_logmessage(message)
 
     def update_images(self,image):
-        image = image.astype(float)
-        image = image.reshape(self.expectedPixels[1],self.expectedPixels[0])
-        image = np.transpose(image)
+        self.collector.frame_received()
+        frame = Frame(image)
+        self.update_frame_format(frame)
+        image = frame.image
         if len(self.imagehistoryarray) == 3:
             self.imagehistoryarray = []
+            self.framehistory = []
         self.imagehistoryarray.insert(0,image)
+        self.framehistory.insert(0,frame)
         if len(self.imagehistoryarray) == 3:
             img1= self.imagehistoryarray[1] #-self.imagehistoryarray[0]
             img2= self.imagehistoryarray[2] #-self.imagehistoryarray[0]
             #back = self.imagehistoryarray[0]
-            aaaa = 0.1
-            diffim = -np.log((abs(img2)+aaaa)/(abs(img1)+aaaa))
+            diffim,ROIimage = self.processor.process(img2,img1,self.ROI.pos(),self.ROI.size())
+            if self.FringeBox.isChecked(): #divide by the best reference from the last probe images around the ROI, instead of the probe image
+                self.fringeremoval.add_probe(img1,self.ROI.pos(),self.ROI.size())
+                reference = self.fringeremoval.reference(img2)
+                if reference is not None:
+                    diffim = self.processor.replace_reference(img2,*reference)
 
             #diffim[diffim >  6] = np.mean(np.mean(diffim))
             #bcksubtract = np.mean(np.mean(diffim[1:3][1:3]))
@@ -279,31 +344,28 @@ class CamGui(QWidget):
             smallim2 = self.imagehistoryarray[2]
             for i, anim in enumerate([smallim1,smallim2]):
                 self.imagehistorycontainer[i].setImage(anim)
-            self.update_histogram(diffim)
-            self.calculate_optical_depth(diffim)
-            if self.saving or self.TempMeasuring:
-                self.resultarray.append(self.ROI.getArrayRegion(diffim,self.mainImage))
-                if self.TempMeasuring:
-                    self.progressbar.setValue(self.progressbar.value() +1)
-
+            self.update_histogram(ROIimage)
+            self.calculate_optical_depth(ROIimage)
+            info = {'timestamp':self.framehistory[2].timestamp,'frame_id':self.framehistory[2].frame_id}
+            if self.collector.add((ROIimage.copy(),info)): #the buffers of the processor are reused by the next frame
+                self.progressbar.setValue(self.progressbar.value() +1)
+            if self.saving:
+                self.resultarray.append(ROIimage.copy())
+                self.resultinfo.append(info)
                 if len(self.resultarray) >= self.SaveImagesBox.value():
                     self.waitbutton.toggle()
                     date = datetime.datetime.now().strftime('%Y%m%d')
                     tm = datetime.datetime.now().strftime('%H%M_%S')
                     self.savepath = self.logpath + '\\' + date + '\\' + tm
-                    self.save_images(self.resultarray,'')
+                    self.save_images(self.resultarray,'',self.resultinfo)
                     self.saving=False
                     self.SaveImagesBox.setValue(0)
 
-                if len(self.resultarray) >= self.Npicturebox.value():
-                    self.TempMeasuring = False
-
 
         #self.Srbrainpanel.Srbrain.stopSequence()
 
     
-    def update_histogram(self,diffimage):
-        ROIimage = self.ROI.getArrayRegion(diffimage,self.mainImage)
+    def update_histogram(self,ROIimage):
         coords = self.ROI.parentBounds()
         xsize = np.size(ROIimage,0)
         ysize = np.size(ROIimage,1)
@@ -325,7 +387,8 @@ class CamGui(QWidget):
         
 
     def make_imagepanel(self):
-        self.expectedPixels = (1920,1200)
+        self.sensorpixel = 5.86e-6
+        self.frameformat = (1,(0,0)) #binning and offset of the image on the sensor, from the frames
         panel = QFrame()
         panel.setFrameStyle(QFrame.Raised | QFrame.Panel)
         MainPwig = pg.PlotWidget()
@@ -353,6 +416,7 @@ class CamGui(QWidget):
             animage.setLookupTable(self.lut)
 
         self.imagehistoryarray = [None,None,None,None]
+        self.framehistory = []
         for i,awidget in enumerate([pg.PlotWidget() for i in range(2)]):     
             awidget.setMaximumSize(213,133)
             sp = awidget.sizePolicy()
@@ -401,7 +465,11 @@ class CamGui(QWidget):
 
         self.numberplot = pg.PlotWidget()
         self.numberplot.setLabel('left','Atom Number [x 1e6]')
-        self.atomnumberlist = []
+        self.atomnumbers = RollingSeries(1000) #the last 1000 shots are plotted, with their mean and standard deviation
+        self.numbercurve = self.numberplot.plot()
+        pen = pg.mkPen(color=(255, 255, 255), style=QtCore.Qt.DashLine)
+        self.numberupper = self.numberplot.plot(pen=pen)
+        self.numberlower = self.numberplot.plot(pen=pen)
         self.numberstd = QLabel('Mean: ??')
         self.numbermean = QLabel('Std: ??')
 #        atomnumberplot.setMaximumSize(213,133)
@@ -535,12 +603,14 @@ class CamGui(QWidget):
         binDrop.addItems(['No binning','2x2 binning','4x4 binning'])
         if CamBin == (2,2):
             binDrop.setCurrentIndex(1)
-            self.expectedPixels = (960,600)
         elif CamBin == (4,4):
             binDrop.setCurrentIndex(2)
-            self.expectedPixels = (480,300)
 
         binDrop.currentTextChanged.connect(self.change_binning)
+        self.FringeBox = QCheckBox('Fringe removal')
+        roiBut = QPushButton('Read out ROI only')
+        roiBut.setCheckable(True)
+        roiBut.toggled.connect(self.readout_roi_clicked)
 
         self.SaveImagesBox = QSpinBox()
         savelabel = QLabel('Number of images to save (0 to disable)')
@@ -577,6 +647,8 @@ class CamGui(QWidget):
         layout.addWidget(BlackLevelbox,  2,1)
         layout.addWidget(bitBut,3,0)
         layout.addWidget(binDrop,3,1)
+        layout.addWidget(roiBut,5,0)
+        layout.addWidget(self.FringeBox,5,1)
         layout.addWidget(self.saveLocLabel,3,2)
         layout.addWidget(savelabel,4,0)
         layout.addWidget(self.SaveImagesBox,4,1)
@@ -586,17 +658,14 @@ class CamGui(QWidget):
         return panel
 
     def change_binning(self,text):
+        """Set the binning of the camera, the frames come with the new binning so the image scale follows, see :py:meth:`update_frame_format`"""
         if text == 'No binning':
-            self.camera.binning((1,1))
-            self.expectedPixels = (1920,1200)
+            result = self.camera.binning(1)
         elif text == '2x2 binning':
-            self.camera.binning((2,2))
-            #self.camera.binningMode('Average')
-            self.expectedPixels = (960,600)
+            result = self.camera.binning(2)
         elif text == '4x4 binning':
-            self.camera.binning((4,4))
-            #self.camera.binningMode('Average')
-            self.expectedPixels = (480,300)
+            result = self.camera.binning(4)
+        self.loop.create_task(self.report_camera_result(result,'Could not change the binning, stop waiting for trigger first'))
 
     def make_temppanel(self):
         panel = QFrame()
@@ -667,13 +736,17 @@ class CamGui(QWidget):
 
 
     async def startTempMeas(self,Tlist):
-        for aname,achannelrow,rownumber in zip(self.Srbrainpanel.channelsDO,self.Srbrainpanel.timingboxes,range(len(self.Srbrainpanel.channelsDO))):
-            if aname == 'CamTrigger':
-                CamTriggerChannel = achannelrow
-            elif aname=='ImagingAOM':
-                AOMTriggerChannel = achannelrow
-            elif aname=='Zeeman':
-                ZeemanChannel = achannelrow
+        """Time of flight measurement: takes Npicturebox shots for every time of flight in Tlist (ms) and fits the widths of the cloud.
+        The scan is run by a :py:class:`ScanEngine.ScanEngine`, so every point ends as soon as its shots have arrived,
+        the sequence of the next point is compiled while the current one is imaging, and the fits run while the next point is acquiring.
+        The fits are inspected when all points are taken"""
+        rows = {}
+        for aname,achannelrow in zip(self.Srbrainpanel.channelsDO,self.Srbrainpanel.timingboxesDO):
+            for akey in ('CamTrigger','ImagingAOM','Zeeman'):
+                if aname.endswith(akey):
+                    rows[akey] = (aname,achannelrow)
+        CamTriggerChannel = rows['CamTrigger'][1]
+        AOMTriggerChannel = rows['ImagingAOM'][1]
 
         if self.SaveTempImages.isChecked():
             logpath = 'Z:\Sr1\MOT Image Logging'
@@ -681,59 +754,56 @@ class CamGui(QWidget):
             tm = datetime.datetime.now().strftime('%H%M_%S')
             self.savepath = logpath + '\\' + date + '\\' + tm
 
-        if self.expectedPixels == (480,300):
-            convfac = (4*5.86*1e-6)
-        elif self.expectedPixels == (960,600):        
-            convfac = (2*5.86*1e-6)    
-        elif self.expectedPixels == (1920,1200): 
-            convfac = (5.86e-6)
-
         CamWidth = CamTriggerChannel[1].value()-CamTriggerChannel[0].value() #find width of camtrigger pulses
         AOMWidth = AOMTriggerChannel[1].value() - AOMTriggerChannel[0].value()
         secondPulsedelay = CamTriggerChannel[2].value()-CamTriggerChannel[0].value()
+
+        def point_timings(aT):
+            """Switch times of the channels moved with the time of flight aT"""
+            timings = {}
+            for akey,shifted in (('CamTrigger',[aT,aT + CamWidth,secondPulsedelay + aT,secondPulsedelay + aT + CamWidth]),
+                                 ('ImagingAOM',[aT,aT + AOMWidth,secondPulsedelay + aT,secondPulsedelay + aT + AOMWidth]),
+                                 ('Zeeman',[aT,aT + CamWidth,secondPulsedelay + aT])):
+                if akey not in rows: #not every sequencer has all the channels
+                    continue
+                aname,achannelrow = rows[akey]
+                values = [abox.value() for abox in achannelrow]
+                values[:len(shifted)] = shifted
+                timings[aname] = values
+            return timings
+
+        async def compile_point(aT):
+            await self.Srbrainpanel.compile_pattern(point_timings(aT))
+
+        async def start_point(aT):
+            #the engine has stopped the last sequence and waited for its frames, so the triplet history starts with the first frame of the point
+            self.imagehistoryarray = []
+            self.framehistory = []
+            for aname,values in point_timings(aT).items(): #show the timings of the running point
+                for abox,avalue in zip(dict(rows.values())[aname],values):
+                    abox.setValue(avalue)
+            await self.Srbrainpanel.Srbrain.armCompiledSequence()
+            await self.Srbrainpanel.Srbrain.startSequence()
+
+        async def stop_point(aT):
+            await self.Srbrainpanel.Srbrain.stopSequence()
+
+        async def analyse_point(aT,shots):
+            return await self.fit_point(shots)
+
         self.progressbar.setRange(0,len(Tlist)*self.Npicturebox.value()*2)
         self.progressbar.setValue(0)
         self.TempDatax.setData(x=np.array([0,1,2,3]),y=np.array([0,1,2,3]),height =np.array([0,1,2,3]))
         self.TempDatay.setData(x=np.array([0,1,2,3]),y=np.array([0,1,2,3]),height =np.array([0,1,2,3]))
         self.TempFitx.setData([],[])
         self.TempFity.setData([],[])
-        result = [[],[],[],[],[]]
-        for aT in Tlist:
-            CamTriggerChannel[0].setValue(aT)
-            CamTriggerChannel[1].setValue(aT + CamWidth)
-            CamTriggerChannel[2].setValue(secondPulsedelay + aT)
-            CamTriggerChannel[3].setValue(secondPulsedelay + aT + CamWidth)
-
-
-            AOMTriggerChannel[0].setValue(aT)
-            AOMTriggerChannel[1].setValue(aT + AOMWidth)
-            AOMTriggerChannel[2].setValue(secondPulsedelay + aT)
-            AOMTriggerChannel[3].setValue(secondPulsedelay + aT + AOMWidth)
-
-            ZeemanChannel[0].setValue(aT)
-            ZeemanChannel[1].setValue(aT + CamWidth)
-            ZeemanChannel[2].setValue(secondPulsedelay + aT)
-
-            self.resultarray = []
-            self.TempMeasuring = True
-            self.Srbrainpanel.Srbrain.stopSequence()
-            self.Srbrainpanel.arm_pattern()
-            self.waitbutton.toggle()
-            await asyncio.sleep(2)
-            self.Srbrainpanel.Srbrain.startSequence()
-
-            while self.TempMeasuring:
-                await asyncio.sleep(1)
-
-            self.Srbrainpanel.Srbrain.stopSequence()
-            self.waitbutton.toggle()
-            await asyncio.sleep(2)
-
-            fitdat = await self.fit_routine(aT-Tlist[0])
+
+        def plot_point(result,aT,fitdat):
             x0,y0,xsig,ysig,amplitude,offset = fitdat[0]
             x0err,y0err,xsigerr,ysigerr,amplitudeerr,offseterr = fitdat[1]
 
             result[0].append(aT-Tlist[0])
+            convfac = self.pixelsize
             result[1].append(xsig*convfac)
             result[2].append(ysig*convfac)
             result[3].append(xsigerr*convfac)
@@ -745,6 +815,21 @@ class CamGui(QWidget):
             self.fitcurve.setPos((x0-xsig,y0-ysig))
             self.fitcurve.setSize((2*xsig,2*ysig))
 
+        engine = ScanEngine.ScanEngine(compile_point,start_point,stop_point,analyse_point,self.collector,loop=self.loop)
+        points = []
+        result = [[],[],[],[],[]]
+        self.waitbutton.setChecked(True)
+        try:
+            async for i,aT,fits in engine.run(Tlist,self.Npicturebox.value()):
+                points.append((aT,fits))
+                plot_point(result,aT,self.average_fits(fits)) #preliminary, with all the fits
+        finally:
+            self.waitbutton.setChecked(False)
+
+        result = [[],[],[],[],[]]
+        for aT,fits in points:
+            plot_point(result,aT,self.fit_routine(aT-Tlist[0],fits))
+
         def sigfit(x,a,b):
             return np.sqrt(b + a*x**2)
 
@@ -786,101 +871,133 @@ class CamGui(QWidget):
 
 
 
-    async def fit_routine(self,adT):
+    async def fit_point(self,shots):
+        """Fit 2-D Gaussians to the images of a time of flight point in a pool of processes, updating the progress as the fits finish
+
+        Shots with another image shape than most of the point, e.g. taken before the ROI was moved or the frame format changed, are left out
+
+        :param shots: list of (image, info) of the point
+        :return: dictionary with the images, the info of the images, and the parameters, errors and cuts of the fits
+        :rtype: dict"""
+        shapes = [np.shape(ashot[0]) for ashot in shots]
+        shape = max(shapes,key=shapes.count)
+        if shapes.count(shape) < len(shots):
+            self.write_logmessage('Left out {:d} of {:d} shots with another image shape than {:}'.format(len(shots) - shapes.count(shape),len(shots),shape))
+            self.progressbar.setValue(self.progressbar.value() + len(shots) - shapes.count(shape))
+            shots = [ashot for ashot,ashape in zip(shots,shapes) if ashape == shape]
+        images = np.array([ashot[0] for ashot in shots])
+        xlen,ylen = images.shape[1:]
+        fits = {'images':images,
+                'info':[ashot[1] for ashot in shots],
+                'fit':np.full((len(images),6),np.nan),
+                'fit_error':np.full((len(images),6),np.nan),
+                'xcuts':[np.nan]*len(images),
+                'ycuts':[np.nan]*len(images)}
+        async for i,popt,perr in self.fitter.fit_stack(images,self.loop):
+            fits['fit'][i] = popt
+            fits['fit_error'][i] = perr
+            if not np.isnan(popt).any():
+                fits['xcuts'][i],fits['ycuts'][i] = gf.gaussian_cuts(popt,(xlen,ylen),int(xlen/2+0.5),int(ylen/2+0.5))
+            self.progressbar.setValue(self.progressbar.value() +1)
+        return fits
+
+    def average_fits(self,fits,keeplist=None):
+        """Mean and standard deviation of the fit parameters of the kept images of a point, leaving out failed fits"""
+        fitvalues = fits['fit'] if keeplist is None else fits['fit'][keeplist]
+        fitvalues = fitvalues[~np.isnan(fitvalues).any(axis=1)] #remove all NaN values that we have not deselected
+        if len(fitvalues) == 0:
+            return(np.ones(6)*np.nan,np.ones(6)*np.nan)
+        return (np.mean(fitvalues,axis=0),np.std(fitvalues,axis=0))
 
-        def gaussian2d(x, y, x0, y0, xalpha, yalpha, A, offset):
-            return offset + A * np.exp( -((x-x0)**2/(2*xalpha**2)) -((y-y0)**2/(2*yalpha**2)))
+    def fit_routine(self,adT,fits):
+        """Let the user inspect the fits of a time of flight point, save the kept images and show their mean
 
-        def _gaussian(M, *args):
-            x, y = M
-            arr = np.zeros(x.shape)
-            arr = gaussian(x, y, *args)
-            return arr
-        def gaussian(data,center,sigma,amp,offset):
-            return offset + amp * np.exp( -((data-center)**2/(2*sigma**2)))
-        
-        ylen = np.size(self.resultarray[0],1)
-        xlen = np.size(self.resultarray[0],0)
+        :param adT: time of flight of the point relative to the first point in ms
+        :param fits: the fits of the point, see :py:meth:`fit_point`
+        :return: mean and standard deviation of the fit parameters of the kept images"""
+        images = fits['images']
+        xlen,ylen = images.shape[1:]
         y = np.arange(0,ylen,1)
         x = np.arange(0,xlen,1)
-        X,Y = np.meshgrid(x,y)
-        xdata = np.vstack((X.ravel(), Y.ravel()))
-        fitvalues = []
-        xfitlist = []
-        yfitlist = []
-
-        p0 = [xlen/2, ylen/2, xlen, ylen, 10, 0]
-        for i in range(len(self.resultarray)):
-            data = self.resultarray[i]
-            xdata = data[:,int(ylen/2+0.5)]
-            ydata = data[int(xlen/2+0.5),:]
-            try:
-                #popt, pcov = curve_fit(_gaussian, xdata, data.ravel(),p0)
-                poptx, pcovx = curve_fit(gaussian, x,xdata ,[xlen/2,200,20,0])
-                popty, pcovy = curve_fit(gaussian, y,ydata ,[ylen/2,200,20,0])
-
-                fitvalues.append([poptx[0],popty[0],abs(poptx[1]),abs(popty[1]),poptx[2],poptx[3]])
-                xfitlist.append(gaussian(x,*poptx))
-                yfitlist.append(gaussian(y,*popty))
-            except RuntimeError as e:
-                fitvalues.append([np.nan,np.nan,np.nan,np.nan,np.nan,np.nan])
-                xfitlist.append(np.nan)
-                yfitlist.append(np.nan)
-                print(e)
-
-            self.progressbar.setValue(self.progressbar.value() +1)
-            
-            popt_array = np.array(fitvalues)
-
-            asyncio.sleep(0.1)
+        keeplist = np.ones(len(images),dtype=bool)
         try:
-            self.Imagecheck = PopupInspection(self.resultarray,self.lut,x,y,xfitlist,yfitlist)
+            self.Imagecheck = PopupInspection(list(images),self.lut,x,y,fits['xcuts'],fits['ycuts'])
             a = self.Imagecheck.exec_()
             keeplist = self.Imagecheck.keeplist
 
-            fitvalues = np.array(fitvalues)[keeplist]
         except Exception as e:
             print(e)
-        fitvalues = fitvalues[~np.isnan(fitvalues).any(axis=1)] #remove all NaN values that we have not deselected
-        if len(fitvalues) == 0:
-            return(np.ones(6)*np.nan,np.ones(6)*np.nan)
+        meanval,stdval = self.average_fits(fits,keeplist)
+        if np.isnan(meanval).any():
+            return (meanval,stdval)
 
         if self.SaveTempImages.isChecked():
             savepath = 'dT_' + str.replace('{:3.3f}'.format(adT),'.','_') + '_ms'
-            imagelist = []
-            for i in range(len(resultarray)):
-                if keeplist[i]:
-                    imagelist.append(resultarray[i])
-            self.save_images(imagelist,savepath)
+            keep = np.flatnonzero(keeplist)
+            metadata = {'timestamp':[fits['info'][i]['timestamp'] for i in keep],
+                        'frame_id':[fits['info'][i]['frame_id'] for i in keep],
+                        'fit':fits['fit'][keep],
+                        'fit_error':fits['fit_error'][keep]}
+            self.save_images(list(images[keep]),savepath,metadata,{'dT':adT,'fit_parameters':['x0','y0','sigmax','sigmay','amplitude','offset']})
 
-        meanval = np.mean(fitvalues,axis=0)
-        stdval = np.std(fitvalues,axis=0)
-               
-        meanim = np.mean(self.resultarray,axis=0)
+        meanim = np.mean(images,axis=0)
 
         self.fitim.setImage(meanim)
 
-        self.histogramplot[2].setData(x,gaussian(x,*poptx))
-        self.histogramplot[3].setData(y,gaussian(y,*popty))
+        xfit,yfit = gf.gaussian_cuts(meanval,(xlen,ylen),int(xlen/2+0.5),int(ylen/2+0.5))
+        self.histogramplot[2].setData(x,xfit)
+        self.histogramplot[3].setData(y,yfit)
 
         return (meanval,stdval)
 
-    def save_images(self,images,saveloc):
+    def save_images(self,images,saveloc,metadata=None,attrs=None):
+        """Save the images as a stack in a compressed HDF5 file, see :py:class:`DataWriters.H5ImageStack`.
+        The file is written on the writer thread, so taking images can go on in the meantime
+
+        Args:
+            images (list): images of the same shape
+            saveloc (str): name of the file in the save path, 'images' if empty
+            metadata (dict or list): per image metadata, a dictionary of lists or a list of dictionaries, one per image
+            attrs (dict): attributes of the file
+        """
+        if isinstance(metadata,list):
+            metadata = dict((akey,[ainfo[akey] for ainfo in metadata]) for akey in (metadata[0] if metadata else {}))
+        attrs = {} if attrs is None else dict(attrs)
+        attrs['roi'] = [self.ROI.pos()[0],self.ROI.pos()[1],self.ROI.size()[0],self.ROI.size()[1]]
         try:
-            savelocation = self.savepath + '\\' + saveloc
-            if not os.path.exists(savelocation):
-                os.makedirs(savelocation)
-            self.saveBar.show()
+            if not os.path.exists(self.savepath):
+                os.makedirs(self.savepath)
+            savelocation = os.path.join(self.savepath,(saveloc if saveloc else 'images') + '.h5')
             self.saveLocLabel.setText('Saving {:d} images to "{:s}"'.format(len(images),savelocation))
-            self.saveBar.setRange(0,len(images)-1)
-            for i in range(len(images)):
-                 np.savetxt(savelocation + '\_{:d}.txt'.format(i), images[i], delimiter=",")
-                 self.saveBar.setValue(i)
-            self.saveLocLabel.setText('')
-            self.saveBar.hide()
+            self.pendingsaves += 1
+            self.writer.submit(self.write_stack,savelocation,list(images),metadata,attrs)
         except Exception as e:
             print(e)
-            print(savelocation)
+            print(self.savepath)
+
+    def write_stack(self,savelocation,images,metadata,attrs):
+        """Write a stack of images, run on the writer thread. The GUI is told on the event loop when it is done"""
+        try:
+            write_image_stack(savelocation,images,metadata,attrs)
+            error = None
+        except Exception as e:
+            error = e
+        self.loop.call_soon_threadsafe(self.stack_written,savelocation,error)
+
+    def stack_written(self,savelocation,error):
+        """Log the result of a save, and clear the save label when no more saves are queued"""
+        self.pendingsaves -= 1
+        if error is not None:
+            self.write_logmessage('Failed at saving "{:s}": {:}'.format(savelocation,error))
+        else:
+            self.write_logmessage('Saved "{:s}"'.format(savelocation))
+        if self.pendingsaves == 0:
+            self.saveLocLabel.setText('')
+
+    def shutdown(self):
+        """Finish writing the images that are still queued and stop the fitting processes before the application quits"""
+        self.writer.close()
+        self.fitter.close()
 
 
 
@@ -924,13 +1041,6 @@ class EmittingStream(QtCore.QObject):
 
 
 
-async def process_events(qapp):
-    while True:
-        await asyncio.sleep(0.1)
-        qapp.processEvents()
-#        print(qapp.allWidgets())
-#        print(len(qapp.allWidgets()))
-#        qapp.connect.lastWindowClosed(lambda: qapp.quit())
 
 
 class PopupInspection(QDialog):
@@ -1139,8 +1249,7 @@ if __name__=="__main__":
     import ctypes
     myappid = u'mycompany.myproduct.subproduct.version1' # arbitrary string
     ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
-    loop = asyncio.get_event_loop()
+    loop = QtLoop.make_loop(a)
     w = CamGui(loop)
-    loop.create_task(process_events(a))
-    loop.run_until_complete(process_events(a))
+    QtLoop.run(loop)
 
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Writers for the data saved by the clients
+
+write_text formats whole blocks of rows at once instead of one sample at a time,
+H5ScanFile appends scans to extensible, chunked and compressed datasets in a single HDF5 file,
+H5ImageStack does the same for images with per image metadata, and BackgroundWriter runs the writing on a separate thread, so the next scan can be taken while the last one is written.
+"""
+
+import threading
+import queue
+import numpy as np
+
+
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+def write_text(filename,columns,header=None,fmt='{:e}',delimiter='\t ',blocksize=65536):
+    """Write columns of numbers to a text file, one row per sample.
+    The rows are formatted a block at a time with a single string formatting call per block.
+
+    :param filename: file to write
+    :type filename: str
+    :param columns: list of 1-D arrays of the same length, e.g. [time, chan1, chan2]
+    :type columns: list
+    :param header: line(s) written before the data
+    :type header: str
+    :param fmt: format of a single number
+    :type fmt: str
+    :param delimiter: string between the columns
+    :type delimiter: str
+    :param blocksize: number of rows formatted at a time
+    :type blocksize: int"""
+    data = np.column_stack([np.asarray(acol,dtype=float) for acol in columns])
+    rowformat = delimiter.join([fmt]*data.shape[1]) + '\n'
+    with open(filename,'w') as f:
+        if header is not None:
+            f.write(header.rstrip('\n') + '\n')
+        for start in range(0,len(data),blocksize):
+            block = data[start:start+blocksize]
+            f.write((rowformat*len(block)).format(*block.ravel().tolist()))
+
+
+class H5ScanFile:
+    """A single HDF5 file scans are appended to. Every dataset grows along its first axis, one entry per scan,
+    and is stored in chunks of one scan, compressed. All datasets have an entry for every scan:
+    a dataset missing from a scan, e.g. of an oscilloscope that failed, gets a row of NaN (0 for integers),
+    and a dataset first seen after some scans is filled the same way for those, so the scan indices of all datasets stay in step.
+
+    :param filename: HDF5 file, it is made if it does not exist and appended to if it does
+    :type filename: str
+    :param compression: h5py compression filter, e.g. gzip or lzf, None for no compression
+    :type compression: str
+    :param compression_opts: compression level for gzip
+    :type compression_opts: int"""
+
+    def __init__(self,filename,compression='gzip',compression_opts=4):
+        import h5py
+        self.filename = filename
+        self.file = h5py.File(filename,'a')
+        self.compression = compression
+        self.compression_opts = compression_opts if compression == 'gzip' else None
+        self.datasets = []
+        self.file.visititems(lambda aname,aitem: self.datasets.append(aname) if isinstance(aitem,h5py.Dataset) else None)
+        self.nscans = max([self.file[aname].shape[0] for aname in self.datasets if self.file[aname].ndim > 0],default=0)
+
+    def _fillvalue(self,dtype):
+        return np.nan if np.dtype(dtype).kind in 'fc' else 0
+
+    def append(self,datasets):
+        """Append one scan
+
+        :param datasets: dictionary of dataset name (groups are separated by /) and the array or number of this scan
+        :type datasets: dict
+        :return: index of the scan in the datasets
+        :rtype: int"""
+        datasets = dict((name,np.asarray(value)) for name,value in datasets.items())
+        for name,value in datasets.items():
+            if name in self.file and self.file[name].shape[1:] != value.shape:
+                raise ValueError('Scan of shape {:} does not fit dataset {:s} of shape {:}'.format(value.shape,name,self.file[name].shape[1:]))
+        for name,value in datasets.items():
+            if name not in self.file:
+                chunks = (1,) + tuple(min(alen,65536) for alen in value.shape) if value.size > 0 else None
+                self.file.create_dataset(name,shape=(self.nscans,) + value.shape,maxshape=(None,) + value.shape,dtype=value.dtype,
+                                         chunks=chunks,compression=self.compression,compression_opts=self.compression_opts,
+                                         fillvalue=self._fillvalue(value.dtype))
+                self.datasets.append(name)
+        for name in self.datasets:
+            dataset = self.file[name]
+            dataset.resize(self.nscans + 1,axis=0)
+            dataset[-1] = datasets[name] if name in datasets else self._fillvalue(dataset.dtype)
+        self.nscans += 1
+        self.file.flush()
+        return self.nscans - 1
+
+    def set_attrs(self,attrs,name='/'):
+        """Set attributes of the file or a group/dataset in it"""
+        for key,value in attrs.items():
+            self.file[name].attrs[key] = value
+
+    def set_layout(self,attrs):
+        """Set the attributes describing the layout of the scans, e.g. the channels, of a new file.
+        A file that already has scans must have the same attributes, so scans of another layout are not mixed into it
+
+        :param attrs: dictionary of attribute name and value
+        :type attrs: dict
+        :raises ValueError: if the file has scans of another layout"""
+        if self.nscans > 0:
+            for key,value in attrs.items():
+                if key not in self.file.attrs or not np.array_equal(np.asarray(self.file.attrs[key]),np.asarray(value)):
+                    raise ValueError('{:s} holds scans with other {:s}, save to a new file'.format(self.filename,key))
+        self.set_attrs(attrs)
+
+    def close(self):
+        self.file.close()
+
+
+class H5ImageStack(H5ScanFile):
+    """A stack of images in a single HDF5 file. The images are appended to the dataset images with shape (images, x, y),
+    stored in chunks of one image, compressed, and every other dataset holds metadata with one entry per image,
+    e.g. timestamp, frame_id or fit parameters. Read it back a slice at a time with :py:func:`read_image_stack`"""
+
+    def append_image(self,image,**metadata):
+        """Append an image and its metadata
+
+        :param image: the image
+        :type image: numpy.ndarray
+        :param metadata: numbers or arrays belonging to the image, each stored in the dataset of the same name
+        :return: index of the image in the stack
+        :rtype: int"""
+        datasets = {'images':image}
+        datasets.update(metadata)
+        return self.append(datasets)
+
+
+def write_image_stack(filename,images,metadata=None,attrs=None,compression='gzip'):
+    """Write (or append) a list of images to an :py:class:`H5ImageStack`, e.g. as a job of a :py:class:`BackgroundWriter`
+
+    :param filename: HDF5 file
+    :type filename: str
+    :param images: list of images of the same shape
+    :type images: list
+    :param metadata: dictionary of name and list with one entry per image
+    :type metadata: dict
+    :param attrs: attributes of the file, e.g. the settings of the sequence
+    :type attrs: dict
+    :param compression: h5py compression filter
+    :type compression: str"""
+    stack = H5ImageStack(filename,compression)
+    try:
+        if attrs is not None:
+            stack.set_attrs(attrs)
+        metadata = {} if metadata is None else metadata
+        for i,animage in enumerate(images):
+            stack.append_image(animage,**dict((akey,avalue[i]) for akey,avalue in metadata.items()))
+    finally:
+        stack.close()
+
+
+def read_image_stack(filename,index=slice(None)):
+    """Read a slice of an image stack written by :py:class:`H5ImageStack`. Only the selected images are read from the file
+
+    :param filename: HDF5 file
+    :type filename: str
+    :param index: index, slice or sorted list of indices of the images to read, e.g. slice(0,100,10)
+    :return: (images, dictionary of metadata, dictionary of the file attributes)
+    :rtype: tuple"""
+    import h5py
+    with h5py.File(filename,'r') as f:
+        images = f['images'][index]
+        metadata = dict((aname,f[aname][index]) for aname in f if aname != 'images' and isinstance(f[aname],h5py.Dataset))
+        attrs = dict(f.attrs)
+    return images,metadata,attrs
+
+
+class BackgroundWriter(threading.Thread):
+    """Thread running write jobs one at a time in the order they were submitted.
+    Errors are stored in errors instead of raised, as they happen on another thread; take them with take_errors.
+
+    :param maxqueue: Number of jobs that can wait. When the queue is full submit blocks, so memory does not grow without bound if writing is slower than taking data
+    :type maxqueue: int"""
+
+    def __init__(self,maxqueue=4):
+        super(BackgroundWriter, self).__init__()
+        self.daemon = True
+        self.jobs = queue.Queue(maxqueue)
+        self.errors = []
+        self.lock = threading.Lock()
+        self.start()
+
+    def submit(self,function,*args,**kwargs):
+        """Queue function(*args,**kwargs) to run on the writer thread"""
+        self.jobs.put((function,args,kwargs))
+
+    def take_errors(self):
+        """Get and clear the errors raised by the jobs since the last call"""
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+        return errors
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            function,args,kwargs = job
+            try:
+                function(*args,**kwargs)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+            self.jobs.task_done()
+
+    def flush(self):
+        """Wait until all submitted jobs are done"""
+        self.jobs.join()
+
+    def close(self):
+        """Finish the submitted jobs and stop the thread"""
+        self.jobs.put(None)
+        self.join()
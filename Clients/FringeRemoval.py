@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Fringe removal for absorption images with an optimal reference image
+
+Instead of dividing by the probe image of the same shot, the optical depth is calculated with the linear combination of
+the probe images in a library that best matches the atoms image where there are no atoms, so the fringes of the probe beam
+cancel. The fit is done in a window around the region of interest, on the pixels of the window outside the region,
+and the reference is only calculated in the window.
+
+Every new probe image costs one matrix-vector product with the library to update the Gram matrix of the masked probes,
+and every shot one with the library for the projections, a small eigenvalue solve and one product for the reference,
+so the cost per shot does not depend on how many shots have been taken, only on the size of the library and the window.
+"""
+
+import numpy as np
+from ImageProcessing import region
+
+
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+class FringeRemoval:
+    """Rolling library of probe images and the best reference image for an atoms image from it.
+    The library is kept for a window around the region of interest, and is emptied when the window or the image shape changes
+
+    :param maxlen: number of probe images in the library
+    :type maxlen: int
+    :param margin: pixels around the region of interest in the window, the pixels used for the fit
+    :type margin: int
+    :param rcond: eigenvalues of the Gram matrix below rcond times the largest are left out, as the probe images are nearly alike
+    :type rcond: float"""
+
+    def __init__(self,maxlen=50,margin=40,rcond=1e-9):
+        self.maxlen = maxlen
+        self.margin = margin
+        self.rcond = rcond
+        self.key = None
+        self.length = 0
+
+    def _setup(self,shape,pos,size):
+        """Set the window and the mask for a region of interest, empty the library if they changed"""
+        window = region(shape,pos,size,self.margin)
+        roi = region(shape,pos,size)
+        key = (tuple(shape),window,roi)
+        if key == self.key:
+            return
+        self.key = key
+        self.window = window
+        self.windowshape = (window[0].stop - window[0].start,window[1].stop - window[1].start)
+        mask = np.ones(self.windowshape,dtype=np.float64)
+        mask[roi[0].start - window[0].start:roi[0].stop - window[0].start,roi[1].start - window[1].start:roi[1].stop - window[1].start] = 0
+        self.mask = mask.ravel()
+        npixels = self.mask.size
+        self.library = np.zeros((self.maxlen,npixels))
+        self.masked = np.zeros((self.maxlen,npixels)) #the library with the region of interest set to 0
+        self.gram = np.zeros((self.maxlen,self.maxlen))
+        self.length = 0
+        self.next = 0
+        self._basis = None
+
+    def __len__(self):
+        return self.length
+
+    def _flat(self,image):
+        return np.asarray(image[self.window],dtype=np.float64).ravel()
+
+    def add_probe(self,probe,pos,size):
+        """Add a probe image to the library, replacing the oldest if it is full
+
+        :param probe: probe image of shape (x, y)
+        :param pos: position (x, y) of the region of interest
+        :param size: size (width, height) of the region of interest"""
+        self._setup(probe.shape,pos,size)
+        k = self.next
+        self.library[k] = self._flat(probe)
+        np.multiply(self.library[k],self.mask,out=self.masked[k])
+        self.length = min(self.length + 1,self.maxlen)
+        self.next = (k + 1)%self.maxlen
+        products = np.dot(self.masked[:self.length],self.masked[k])
+        self.gram[k,:self.length] = products
+        self.gram[:self.length,k] = products
+        self._basis = None
+
+    def basis(self):
+        """Eigenvectors of the Gram matrix of the library over the mask, scaled by the inverse eigenvalues, and calculated once per change of the library.
+        The coefficients of the best reference are basis times the projections of the atoms image on the library"""
+        if self._basis is None:
+            values,vectors = np.linalg.eigh(self.gram[:self.length,:self.length])
+            keep = values > max(self.rcond*values[-1],0)
+            self._basis = (vectors[:,keep]/values[keep],vectors[:,keep].T)
+        return self._basis
+
+    def coefficients(self,atoms):
+        """Coefficients of the library images in the best reference for an atoms image, the least squares fit over the mask"""
+        scaled,vectors = self.basis()
+        return np.dot(scaled,np.dot(vectors,np.dot(self.masked[:self.length],self._flat(atoms))))
+
+    def reference(self,atoms):
+        """The best reference for an atoms image in the window
+
+        :param atoms: atoms image of the same shape as the probe images
+        :return: (window, reference) with window the slices of the window in the image and reference the image of the window,
+                 or None if the library is empty, for another shape or if there are no pixels to fit
+        :rtype: tuple"""
+        if self.length == 0 or tuple(atoms.shape) != self.key[0] or len(self.basis()[1]) == 0:
+            return None
+        reference = np.dot(self.coefficients(atoms),self.library[:self.length])
+        return self.window,reference.reshape(self.windowshape)
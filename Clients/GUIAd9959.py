@@ -9,7 +9,7 @@ from PyQt5.QtWidgets import *
 from PyQt5 import QtGui,QtCore
 import sys
 import asyncio
-import quamash
+import QtLoop
 from qweather import QWeatherClient
 
 __author__ = 'Asbjorn Arvad Jorgensen'
@@ -245,13 +245,6 @@ class AD9959Gui(QWidget):
         self.loop.stop()
 
 
-async def process_events(qapp):
-    while True:
-        await asyncio.sleep(0)
-        qapp.processEvents()
-#        print(qapp.allWidgets())
-#        print(len(qapp.allWidgets()))
-#        qapp.connect.lastWindowClosed(lambda: qapp.quit())
 
 def icon():
     iconstring = ["20 20 3 1","   c #FFFFFF",".  c #000000","+  c #FDFDFD",
@@ -264,16 +257,14 @@ if __name__=="__main__":
     a = QApplication(sys.argv)
     a.setWindowIcon(QtGui.QIcon(QtGui.QPixmap(icon())))
     a.lastWindowClosed.connect(lambda :print('lol'))
-    loop = asyncio.get_event_loop()
+    loop = QtLoop.make_loop(a)
     w = AD9959Gui(loop)
-    #loop.create_task(process_events(a))
     #loop.run_forever()
 #    try:
-    loop.run_until_complete(process_events(a))
+    QtLoop.run(loop)
   #  finally:
    #     loop.close()
 
-    #loop.call_soon(process_events(a),loop)
 
 
 
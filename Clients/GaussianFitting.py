@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""2-D Gaussian fitting of stacks of absorption images, e.g. the images of a time of flight point
+
+The fits are seeded with moment estimates calculated for the whole stack at once, and are full 2-D fits
+with an analytic Jacobian, run in a pool of processes. The results are streamed back as the fits finish,
+so the GUI stays responsive and can show the progress.
+
+The parameters of a fit are [x0, y0, sigmax, sigmay, amplitude, offset] in pixels, with x along the first axis of the images.
+"""
+
+import asyncio
+import concurrent.futures
+import numpy as np
+
+
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+def _marginal(marginals,threshold=0.2):
+    """Marginals with the bins below threshold times the maximum set to zero, so the noise in the wings does not inflate the widths.
+    This underestimates the widths of a Gaussian by about 20%, which is close enough for a seed"""
+    return np.where(marginals > threshold*marginals.max(axis=1,keepdims=True),marginals,0)
+
+
+def moment_seeds(images):
+    """Estimate the Gaussian parameters of every image in a stack from its moments, vectorized over the stack.
+    The offset is the median of the border pixels, and the moments are taken of the marginals above it, see :py:func:`_marginal`
+
+    :param images: stack of images with shape (images, x, y)
+    :type images: numpy.ndarray
+    :return: array of shape (images, 6) with [x0, y0, sigmax, sigmay, amplitude, offset] for each image
+    :rtype: numpy.ndarray"""
+    images = np.asarray(images,dtype=np.float32)
+    nx,ny = images.shape[1:]
+    border = np.concatenate([images[:,0,:],images[:,-1,:],images[:,:,0],images[:,:,-1]],axis=1)
+    offset = np.median(border,axis=1)
+    signal = images - offset[:,np.newaxis,np.newaxis]
+    px = _marginal(signal.sum(axis=2,dtype=np.float64))
+    py = _marginal(signal.sum(axis=1,dtype=np.float64))
+    total = np.maximum(px.sum(axis=1),np.finfo(float).tiny)
+    x = np.arange(nx)
+    y = np.arange(ny)
+    x0 = px.dot(x)/total
+    y0 = py.dot(y)/total
+    sx = np.sqrt(np.maximum((px*(x[np.newaxis,:] - x0[:,np.newaxis])**2).sum(axis=1)/total,0))
+    sy = np.sqrt(np.maximum((py*(y[np.newaxis,:] - y0[:,np.newaxis])**2).sum(axis=1)/total,0))
+    sx = np.clip(sx,1,nx)
+    sy = np.clip(sy,1,ny)
+    amplitude = total/(2*np.pi*sx*sy)
+    return np.column_stack([x0,y0,sx,sy,amplitude,offset])
+
+
+def gaussian2d(shape,x0,y0,sx,sy,amplitude,offset):
+    """The 2-D Gaussian offset + amplitude*exp(-(x-x0)^2/(2 sx^2) - (y-y0)^2/(2 sy^2)) on a grid of pixels
+
+    :param shape: shape (x, y) of the grid
+    :return: the Gaussian with the given shape
+    :rtype: numpy.ndarray"""
+    ex = np.exp(-(np.arange(shape[0]) - x0)**2/(2*sx**2))
+    ey = np.exp(-(np.arange(shape[1]) - y0)**2/(2*sy**2))
+    return offset + amplitude*np.outer(ex,ey)
+
+
+def gaussian_cuts(params,shape,ix,iy):
+    """Cuts through a fitted Gaussian along x at the column iy and along y at the row ix,
+    the same cuts as data[:,iy] and data[ix,:] of an image
+
+    :return: (cut along x, cut along y)
+    :rtype: tuple"""
+    x0,y0,sx,sy,amplitude,offset = params
+    ex = np.exp(-(np.arange(shape[0]) - x0)**2/(2*sx**2))
+    ey = np.exp(-(np.arange(shape[1]) - y0)**2/(2*sy**2))
+    return offset + amplitude*ex*ey[iy],offset + amplitude*ex[ix]*ey
+
+
+def _factors(x,y,params):
+    """Factors of the separable Gaussian: the model is offset + amplitude*outer(ex,ey),
+    and column k of the Jacobian is outer(a[k],b[k])"""
+    x0,y0,sx,sy,amplitude,offset = params
+    dx = x - x0
+    dy = y - y0
+    ex = np.exp(-dx**2/(2*sx**2))
+    ey = np.exp(-dy**2/(2*sy**2))
+    a = np.array([amplitude*ex*dx/sx**2,amplitude*ex,amplitude*ex*dx**2/sx**3,amplitude*ex,ex,np.ones_like(x)])
+    b = np.array([ey,ey*dy/sy**2,ey,ey*dy**2/sy**3,ey,np.ones_like(y)])
+    return ex,ey,a,b
+
+
+def fit_gaussian2d(image,p0=None,maxiter=100,tol=1e-10):
+    """Fit a 2-D Gaussian to an image by least squares, with Levenberg-Marquardt and the analytic Jacobian.
+    As the Gaussian is separable, every column of the Jacobian is an outer product of a vector along x and one along y,
+    so J^T J is calculated from 1-D dot products and J^T r from two matrix-vector products,
+    without ever making the (pixels x 6) Jacobian.
+
+    :param image: image with shape (x, y)
+    :type image: numpy.ndarray
+    :param p0: initial parameters [x0, y0, sigmax, sigmay, amplitude, offset], from :py:func:`moment_seeds` if None
+    :param maxiter: maximum number of iterations
+    :type maxiter: int
+    :param tol: relative change of the sum of squares at which the fit has converged
+    :type tol: float
+    :return: (parameters, standard errors), both NaN if the fit failed. The widths are positive
+    :rtype: tuple"""
+    image = np.asarray(image,dtype=float)
+    if p0 is None:
+        p0 = moment_seeds(image[np.newaxis])[0]
+    x = np.arange(image.shape[0],dtype=float)
+    y = np.arange(image.shape[1],dtype=float)
+
+    def chisq(params):
+        ex,ey,a,b = _factors(x,y,params)
+        residual = image - params[5] - params[4]*np.outer(ex,ey)
+        return np.dot(residual.ravel(),residual.ravel()),residual,a,b
+
+    params = np.array(p0,dtype=float)
+    damping = 1e-3
+    chi2,residual,a,b = chisq(params)
+    for iteration in range(maxiter):
+        jtj = np.dot(a,a.T)*np.dot(b,b.T)
+        jtr = np.einsum('ky,ky->k',np.dot(a,residual),b)
+        improved = False
+        while damping < 1e10:
+            try:
+                step = np.linalg.solve(jtj + damping*np.diag(np.diag(jtj)),jtr)
+            except np.linalg.LinAlgError:
+                damping *= 10
+                continue
+            trial = params + step
+            trialchi2,trialresidual,triala,trialb = chisq(trial)
+            if np.isfinite(trialchi2) and trialchi2 <= chi2:
+                improved = True
+                break
+            damping *= 10
+        if not improved:
+            break
+        converged = chi2 - trialchi2 <= tol*chi2
+        params,chi2,residual,a,b = trial,trialchi2,trialresidual,triala,trialb
+        damping = max(damping/10,1e-12)
+        if converged:
+            break
+    jtj = np.dot(a,a.T)*np.dot(b,b.T)
+    try:
+        covariance = np.linalg.inv(jtj)*chi2/max(image.size - len(params),1)
+    except np.linalg.LinAlgError:
+        return np.full(6,np.nan),np.full(6,np.nan)
+    if not np.all(np.isfinite(params)):
+        return np.full(6,np.nan),np.full(6,np.nan)
+    params[2:4] = np.abs(params[2:4])
+    return params,np.sqrt(np.abs(np.diag(covariance)))
+
+
+def _fit_indexed(index,image,p0):
+    return (index,) + fit_gaussian2d(image,p0)
+
+
+class GaussianFitter:
+    """Runs 2-D Gaussian fits of image stacks in a pool of processes
+
+    :param processes: number of processes, defaults to the number of processors
+    :type processes: int"""
+
+    def __init__(self,processes=None):
+        self.processes = processes
+        self.executor = None
+
+    async def fit_stack(self,images,loop=None):
+        """Fit every image of a stack, yielding the results as the fits finish (not necessarily in order)::
+
+            async for index,params,errors in fitter.fit_stack(images):
+                ...
+
+        :param images: stack of images with shape (images, x, y)
+        :type images: numpy.ndarray
+        :return: asynchronous generator of (index, parameters, standard errors), see :py:func:`fit_gaussian2d`"""
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.processes)
+        images = np.asarray(images,dtype=np.float32)
+        seeds = moment_seeds(images)
+        futures = [loop.run_in_executor(self.executor,_fit_indexed,i,animage,aseed) for i,(animage,aseed) in enumerate(zip(images,seeds))]
+        try:
+            for afuture in asyncio.as_completed(futures):
+                yield await afuture
+        finally:
+            for afuture in futures:
+                afuture.cancel()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
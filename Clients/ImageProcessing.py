@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Processing of the absorption images in the camera GUI
+
+The optical depth is calculated in float32 buffers that are allocated once and reused for every frame,
+with all arithmetic done in place, and the region of interest is a view into the optical depth image,
+cut out once per frame and shared by the histogram, the atom number and the saving.
+"""
+
+import numpy as np
+
+
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+def region(shape,pos,size,margin=0):
+    """Slices of a region (rounded to whole pixels) of an image, grown by margin pixels on every side and clipped to the image
+
+    :param shape: shape (x, y) of the image
+    :param pos: position (x, y) of the corner of the region, e.g. pg.ROI.pos()
+    :param size: size (width, height) of the region, e.g. pg.ROI.size()
+    :return: (slice along x, slice along y)
+    :rtype: tuple"""
+    x0 = min(max(int(round(pos[0])) - margin,0),shape[0])
+    y0 = min(max(int(round(pos[1])) - margin,0),shape[1])
+    x1 = min(max(int(round(pos[0] + size[0])) + margin,x0),shape[0])
+    y1 = min(max(int(round(pos[1] + size[1])) + margin,y0),shape[1])
+    return slice(x0,x1),slice(y0,y1)
+
+
+class ImageProcessor:
+    """Calculates the optical depth -ln((atoms + offset)/(probe + offset)) of pairs of images of the same shape.
+    The returned optical depth and region of interest are views of buffers that are overwritten by the next frame,
+    so copy what has to be kept (e.g. images for saving).
+
+    :param offset: counts added to atoms and probe, so empty pixels do not give infinities
+    :type offset: float"""
+
+    def __init__(self,offset=0.1):
+        self.offset = np.float32(offset)
+        self.od = None
+        self.roi = None
+        self._probe = None
+
+    def _allocate(self,image):
+        """Allocate the buffers in the shape and memory order of image (e.g. the transposed view of a frame), so they are read and written in order"""
+        if self.od is None or self.od.shape != image.shape or self.od.flags.f_contiguous != image.flags.f_contiguous:
+            self.od = np.empty_like(image,dtype=np.float32)
+            self._probe = np.empty_like(image,dtype=np.float32)
+
+    def optical_depth(self,atoms,probe):
+        """Optical depth of an image with atoms and one of the probe light only, in any integer or float dtype
+
+        :return: the optical depth, a float32 buffer reused by the next call
+        :rtype: numpy.ndarray"""
+        self._allocate(atoms)
+        od = self.od
+        np.add(atoms,self.offset,out=od,dtype=np.float32)
+        np.add(probe,self.offset,out=self._probe,dtype=np.float32)
+        np.divide(od,self._probe,out=od)
+        np.log(od,out=od)
+        np.negative(od,out=od)
+        return od
+
+    def crop(self,pos,size):
+        """Cut the region of interest out of the last optical depth image. The region is rounded to whole pixels and clipped to the image
+
+        :param pos: position (x, y) of the corner of the region in pixels, e.g. pg.ROI.pos()
+        :param size: size (width, height) of the region in pixels, e.g. pg.ROI.size()
+        :return: view of the region in the optical depth image, with x along the first axis
+        :rtype: numpy.ndarray"""
+        self.roi = self.od[region(self.od.shape,pos,size)]
+        return self.roi
+
+    def replace_reference(self,atoms,window,reference):
+        """Recalculate the optical depth in a window of the last image with another reference than the probe image,
+        e.g. the optimal reference of :py:class:`FringeRemoval.FringeRemoval`. The region of interest is a view, so it follows
+
+        :param atoms: the atoms image of the last call to :py:meth:`optical_depth`
+        :param window: (slice along x, slice along y) of the window
+        :param reference: reference image of the window
+        :return: the optical depth
+        :rtype: numpy.ndarray"""
+        od = self.od[window]
+        np.add(atoms[window],self.offset,out=od,dtype=np.float32)
+        np.divide(od,np.add(reference,self.offset,dtype=np.float32),out=od)
+        np.log(od,out=od)
+        np.negative(od,out=od)
+        return self.od
+
+    def process(self,atoms,probe,pos,size):
+        """Optical depth and region of interest of a frame, see :py:meth:`optical_depth` and :py:meth:`crop`
+
+        :return: (optical depth, region of interest)
+        :rtype: tuple"""
+        self.optical_depth(atoms,probe)
+        return self.od,self.crop(pos,size)
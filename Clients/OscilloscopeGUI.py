@@ -9,16 +9,18 @@ from PyQt5.QtWidgets import *
 from PyQt5 import QtGui,QtCore
 import sys
 import asyncio
+import QtLoop
 import datetime
 from qweather import QWeatherClient
 import time
-import h5py
 import logging
 import numpy as np
 import os
 import psutil
 import sys
 import traceback
+from OscilloscopeTraces import Trace
+from DataWriters import BackgroundWriter, H5ScanFile, write_text
 
 
 
@@ -83,6 +85,14 @@ class OscGui(QWidget):
         scannumber.setRange(1,100)
 
         channels = self.make_channel_panel()
+
+        self.scopelist = QListWidget()
+        for oscname in self.osclist.keys():
+            item = QListWidgetItem(oscname)
+            item.setFlags(item.flags() | QtCore.Qt.ItemIsUserCheckable)
+            item.setCheckState(QtCore.Qt.Unchecked)
+            self.scopelist.addItem(item)
+        self.multiscope = QCheckBox('Capture from all checked oscilloscopes at once')
         
 
         self.savebutton = QPushButton('SAVE')
@@ -102,6 +112,8 @@ class OscGui(QWidget):
 
         layout = QGridLayout()
         layout.addWidget(oscselector)
+        layout.addWidget(self.multiscope,0,4,1,6)
+        layout.addWidget(self.scopelist,5,4,1,6)
         layout.addWidget(filepath,1,0,1,6)
         layout.addWidget(browsepath,1,6,1,1)
         layout.addWidget(channels,2,0,4,2)
@@ -120,9 +132,12 @@ class OscGui(QWidget):
         self.savebutton.setText('Working...')
         logging.info('Data taking begun')
         self.progressbar.setRange(0,nscans)
-        osc = self.osclist[oscname]
         channels = [i+1 for i in range(len(self.channellist)) if self.channellist[i].isChecked()]
         refchannels = [i+1 for i in range(len(self.refchannellist)) if self.refchannellist[i].isChecked()]
+        if self.multiscope.isChecked():
+            oscnames = [self.scopelist.item(i).text() for i in range(self.scopelist.count()) if self.scopelist.item(i).checkState() == QtCore.Qt.Checked]
+        else:
+            oscnames = [oscname]
 
         if len(path) == 0:
             errmsg = QMessageBox()
@@ -132,103 +147,53 @@ class OscGui(QWidget):
             errmsg = QMessageBox()
             errmsg.setText('No channels have been specified')
             errmsg.exec()
+        elif len(oscnames) == 0:
+            errmsg = QMessageBox()
+            errmsg.setText('No oscilloscopes have been specified')
+            errmsg.exec()
         else:
-            for j in range(nscans):
-                data = []
-                try:
-                    for achannel in range(len(channels)-1):
+            writer = BackgroundWriter()
+            h5file = None
+            try:
+                if self.filetype.currentText() == 'h5':
+                    h5file = H5ScanFile(path + '.h5')
+                    try:
+                        h5file.set_layout({'channels':channels,'refchannels':refchannels,'oscilloscopes':oscnames})
+                    except ValueError as e:
+                        logging.error(e)
+                        errmsg = QMessageBox()
+                        errmsg.setText(str(e))
+                        errmsg.exec()
+                        nscans = 0
+                for j in range(nscans):
+                    try:
                         self.print_memory_usage()
-                        tmp = await osc.single_measurement(channels[achannel])
-                        logging.info('got data from channel {:d}'.format(channels[achannel]))
-                        data.append(tmp)
-                    tmp = await osc.single_measurement(channels[-1])#,rerun=True)
-                    data.append(tmp)
-                    logging.info('got data from channel {:d}, rerunning oscilloscope'.format(channels[-1]))
-                    newdata = [data[0][0],[adat[1] for adat in data]]
-                    data = newdata
-                    if len(refchannels) > 0:
-                        refdata = []
-                        for arefchannel in range(len(refchannels)):
-                            tmp = await osc.single_measurement(refchannels[arefchannel],ref=True)
-                            refdata.append(tmp)
-                        newdata = [refdata[0][0],[adat[1] for adat in refdata],refdata[0][2]]
-                        refdata = newdata
-                    logging.info('Got data from oscilloscope')
-                except Exception as e:
-                    logging.exception(e)
-                    self.savebutton.setText('SAVE')
-                    donebox = QMessageBox()
-                    donebox.setText('Failed at getting data')
-                    donebox.exec()
-                try:
-                    t = data[0]
-                    chandata = data[1]
-                    if len(refchannels)> 0:
-                        reftime = refdata[0]
-                        refchandata = refdata[1]
-
-                    if self.filetype.currentText() == 'h5':
-                        h5f = h5py.File(path + '_{:03d}.h5'.format(j+1), 'w')
-                        h5f.create_dataset('time', data=t)
-                        for achan in range(len(chandata)):
-                            h5f.create_dataset('chan_{:d}'.format(achan), data=chandata[achan])
-                            logging.info('wrote data')
-                        if len(refchannels)> 0:
-                            h5f.create_dataset('reftime', data=reftime)
-                            for achan in range(len(refchandata)):
-                                h5f.create_dataset('refchan_{:d}'.format(achan), data=refchandata[achan])
-                        h5f.close()
-                    elif self.filetype.currentText() == 'txt':
-                        if len(data) == 3:
-                            head = data[2]
-                        else:
-                            head = None
-                        with open(path + '_{:03d}.txt'.format(j+1), 'w') as f:
-                            headerstr = ''
-                            if head is not None:
-                                headerstr += 'Samplerate {:.3e}, Npoints {:}\n'.format(head[1],head[0])
-                            headerstr += 'time(ms)'
-                            for achan in channels:
-                                headerstr += '\t Chan{:d} (V)'.format(achan)
-                            f.write(headerstr + '\n')
-                            NChans = len(chandata)
-                            for apoint in zip(t,*chandata):
-                                writestring = ""
-                                writestring += '{:e}'.format(apoint[0])
-                                for i in range(NChans):
-                                    writestring += '\t {:e}'.format(apoint[i+1])
-                                writestring += '\n'
-                                f.write(writestring)
-                                
-                        f.close()
-                        if len(refchannels)>0:
-                            with open(path + 'Ref__{:03d}.txt'.format(j+1), 'w') as f:
-                                headerstr = ''
-                                if head is not None:
-                                    headerstr += 'Samplerate {:.3e}, Npoints {:}\n'.format(head[1],head[0])
-                                headerstr += 'time(ms)'
-                                for achan in refchannels:
-                                    headerstr += '\t RefChan{:d} (V)'.format(achan)
-                                f.write(headerstr + '\n')
-                                NChans = len(refchandata)
-                                for apoint in zip(reftime,*refchandata):
-                                    writestring = ""
-                                    writestring += '{:e}'.format(apoint[0])
-                                    for i in range(NChans):
-                                        writestring += '\t {:e}'.format(apoint[i+1])
-                                    writestring += '\n'
-                                    f.write(writestring)
-                                    
-                            f.close()
-                except Exception as e:
-                    logging.exception(e)
-                    donebox = QMessageBox()
-                    donebox.setText('Failed at saving')
-                    donebox.exec()
-                    print(e)
-                logging.info('Saved data')
-                self.progressbar.setValue(j+1)
-                time.sleep(0.5)
+                        record = await self.capture_snapshot(oscnames,channels,refchannels)
+                        logging.info('Got data from oscilloscope')
+                    except Exception as e:
+                        logging.exception(e)
+                        self.savebutton.setText('SAVE')
+                        donebox = QMessageBox()
+                        donebox.setText('Failed at getting data')
+                        donebox.exec()
+                        continue
+                    #The scan is written on the writer thread while the next one is taken
+                    if h5file is not None:
+                        await self.loop.run_in_executor(None,writer.submit,self.write_h5,h5file,record,oscnames,channels,refchannels)
+                    else:
+                        for aname,atrace in record['traces'].items():
+                            filepath = path if len(oscnames) == 1 else path + '_' + aname
+                            await self.loop.run_in_executor(None,writer.submit,self.write_txt,filepath,j,atrace,channels,refchannels)
+                    self.report_write_errors(writer)
+                    logging.info('Queued data for saving')
+                    self.progressbar.setValue(j+1)
+                    await asyncio.sleep(0.5)
+            finally:
+                await self.loop.run_in_executor(None,writer.close)
+                if h5file is not None:
+                    h5file.close()
+            self.report_write_errors(writer)
+            logging.info('Saved data')
         self.savebutton.setFlat(False)
         donebox = QMessageBox()
         donebox.setText('Measurements done')
@@ -236,6 +201,66 @@ class OscGui(QWidget):
         self.progressbar.reset()
         self.savebutton.setText('SAVE')
 
+    async def capture_scope(self,oscname,channels,refchannels):
+        """Get a trace from a single oscilloscope, and the time it took"""
+        start = time.perf_counter()
+        trace = Trace(await self.osclist[oscname].multi_measurement(channels,refchannels))
+        return trace,time.perf_counter() - start
+
+    async def capture_snapshot(self,oscnames,channels,refchannels):
+        """Get traces from several oscilloscopes at the same time, so a snapshot takes as long as the slowest oscilloscope.
+        The traces from the same trigger are grouped in one record, a dictionary with the entries
+        time (unix time when the capture started), traces and latencies (keyed by oscilloscope name) and latency (of the whole snapshot).
+        Oscilloscopes that fail are logged and left out of the record"""
+        record = {'time':time.time(),'traces':{},'latencies':{}}
+        start = time.perf_counter()
+        results = await asyncio.gather(*[self.capture_scope(aname,channels,refchannels) for aname in oscnames],return_exceptions=True)
+        record['latency'] = time.perf_counter() - start
+        for aname,aresult in zip(oscnames,results):
+            if isinstance(aresult,Exception):
+                logging.error('Failed at getting data from {:s}: {:}'.format(aname,aresult))
+            else:
+                record['traces'][aname],record['latencies'][aname] = aresult
+                logging.info('got data from {:s} channels {:} in {:.3f} s'.format(aname,', '.join(aresult[0].sources),aresult[1]))
+        if len(record['traces']) == 0:
+            raise RuntimeError('No oscilloscope returned data')
+        if len(oscnames) > 1:
+            logging.info('Snapshot of {:d} oscilloscopes in {:.3f} s'.format(len(record['traces']),record['latency']))
+        return record
+
+    def report_write_errors(self,writer):
+        """Log and show the errors of the writer thread"""
+        errors = writer.take_errors()
+        for e in errors:
+            logging.error('Failed at saving: {:}'.format(e))
+        if len(errors) > 0:
+            donebox = QMessageBox()
+            donebox.setText('Failed at saving')
+            donebox.exec()
+
+    def write_h5(self,h5file,record,oscnames,channels,refchannels):
+        """Append a record to the h5 file, one scan in every dataset. With several oscilloscopes the datasets of each oscilloscope are in a group.
+        The layout is set by the oscilloscopes of the run, so an oscilloscope that failed gets a row of NaN in its datasets"""
+        datasets = {'timestamp':record['time'],'latency':record['latency']}
+        for aname,atrace in record['traces'].items():
+            prefix = '' if len(oscnames) == 1 else aname + '/'
+            datasets[prefix + 't0'] = atrace.t0
+            datasets[prefix + 'dt'] = atrace.dt
+            datasets[prefix + 'scope_latency'] = record['latencies'][aname]
+            datasets[prefix + 'data'] = atrace.data[:len(channels)]
+            if len(refchannels) > 0 and len(atrace.data) > len(channels): #not every oscilloscope sends reference channels
+                datasets[prefix + 'reftime'] = atrace.channel_time(len(channels))
+                datasets[prefix + 'refdata'] = atrace.data[len(channels):]
+        h5file.append(datasets)
+
+    def write_txt(self,path,j,trace,channels,refchannels):
+        """Write a trace to a text file, and the reference channels to a second text file"""
+        header = 'time(ms)' + ''.join('\t Chan{:d} (V)'.format(achan) for achan in channels)
+        write_text(path + '_{:03d}.txt'.format(j+1),[trace.time] + list(trace.data[:len(channels)]),header)
+        if len(refchannels)>0 and len(trace.data) > len(channels):
+            header = 'time(ms)' + ''.join('\t RefChan{:d} (V)'.format(achan) for achan in refchannels)
+            write_text(path + 'Ref__{:03d}.txt'.format(j+1),[trace.channel_time(len(channels))] + list(trace.data[len(channels):]),header)
+
 
     def make_channel_panel(self):
         panel = QFrame()
@@ -294,13 +319,6 @@ class QTextEditLogger(logging.Handler):
         self.widget.appendPlainText(msg)
 
 
-async def process_events(qapp):
-    while True:
-        await asyncio.sleep(0)
-        qapp.processEvents()
-#        print(qapp.allWidgets())
-#        print(len(qapp.allWidgets()))
-#        qapp.connect.lastWindowClosed(lambda: qapp.quit())
 
 
 if __name__=="__main__":
@@ -308,16 +326,14 @@ if __name__=="__main__":
     import ctypes
     myappid = u'mycompany.myproduct.subproduct.version' # arbitrary string
     ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
-    loop = asyncio.get_event_loop()
+    loop = QtLoop.make_loop(a)
     w = OscGui(loop)
-    #loop.create_task(process_events(a))
     #loop.run_forever()
 #    try:
-    loop.run_until_complete(process_events(a))
+    QtLoop.run(loop)
   #  finally:
    #     loop.close()
 
-    #loop.call_soon(process_events(a),loop)
 
 
 
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Client side helper for the compact traces returned by the oscilloscope servers
+
+A compact trace is a dictionary with the keys t0, dt, n, dtype, shape, channels and buffer.
+The time axis is not sent, but rebuilt here when it is asked for.
+"""
+
+import numpy as np
+
+
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+class Trace:
+    """Wraps a compact trace from an oscilloscope server.
+
+    :param packed: compact trace as returned by the server
+    :type packed: dict"""
+
+    def __init__(self,packed):
+        self.packed = packed
+        self.t0 = packed['t0']
+        self.dt = packed['dt']
+        self.n = packed['n']
+        self.channels = packed['channels']
+        self.sources = [achan['source'] for achan in self.channels]
+        self._data = None
+        self._time = None
+
+    @property
+    def data(self):
+        """The samples as a read only numpy array of the original shape, without copying the buffer"""
+        if self._data is None:
+            self._data = np.frombuffer(self.packed['buffer'],dtype=self.packed['dtype']).reshape(self.packed['shape'])
+        return self._data
+
+    @property
+    def time(self):
+        """The time axis, built the first time it is asked for"""
+        if self._time is None:
+            self._time = self.t0 + self.dt*np.arange(self.n)
+        return self._time
+
+    def channel_time(self,index):
+        """The time axis of a single channel, built from its own header or preamble if it has one
+        (reference channels can have a different time axis than the live channels)
+
+        :param index: index of the channel in the trace
+        :type index: int
+        :return: time axis
+        :rtype: numpy.ndarray"""
+        preamble = self.channels[index].get('preamble')
+        if preamble is not None:
+            xinc,xorig,xref = preamble[4:7]
+            return xorig - xref*xinc + xinc*np.arange(int(preamble[2]))
+        head = self.channels[index].get('head')
+        if head is None or len(head) < 4:
+            return self.time
+        n = int(head[2]*head[3])
+        return np.linspace(head[0],head[1],n)
+
+    def __getitem__(self,source):
+        """The samples of a single source, e.g. trace['CHAN1']"""
+        return self.data[...,self.sources.index(source),:]
+
+    def __getattr__(self,name):
+        if name in ('packed',):
+            raise AttributeError(name)
+        if name in self.packed:
+            return self.packed[name]
+        raise AttributeError(name)
+
+    @property
+    def nbytes(self):
+        """Number of bytes in the sample buffer"""
+        return len(self.packed['buffer'])
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""One event loop for Qt and asyncio, shared by the GUIs
+
+The GUIs used to run asyncio and call processEvents in a loop with asyncio.sleep(0) in between, which keeps a CPU core busy
+even when nothing happens, and lets the Qt events and the QWeather messages wait on each other.
+Here the asyncio event loop is implemented on top of the Qt event loop (qasync, or quamash if qasync is not installed),
+so both sleep until a socket, a timer or a window has something to do.
+
+Usage::
+
+    a = QApplication(sys.argv)
+    loop = QtLoop.make_loop(a)
+    w = SomeGui(loop)
+    QtLoop.run(loop)
+"""
+
+import asyncio
+
+
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+def make_loop(qapp):
+    """Make an asyncio event loop running on the Qt event loop of qapp, and make it the current event loop.
+    Has to be called before anything (e.g. a QWeatherClient) asks for the event loop.
+
+    :param qapp: the application
+    :type qapp: QApplication
+    :return: the event loop
+    :rtype: asyncio.AbstractEventLoop"""
+    try:
+        from qasync import QEventLoop
+    except ImportError:
+        from quamash import QEventLoop
+    loop = QEventLoop(qapp)
+    asyncio.set_event_loop(loop)
+    qapp.lastWindowClosed.connect(loop.stop)
+    return loop
+
+
+def run(loop,coroutine=None):
+    """Run the Qt and asyncio event loop until it is stopped, e.g. by closing the last window or by loop.stop() in a closeEvent
+
+    :param loop: event loop made by :py:func:`make_loop`
+    :param coroutine: optional coroutine to start as a task first
+    :type coroutine: coroutine"""
+    with loop:
+        if coroutine is not None:
+            loop.create_task(coroutine)
+        loop.run_forever()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Event driven scans of an experiment sequence, e.g. the time of flight points of a temperature measurement
+
+Every point of a scan is acquired until the required number of shots has arrived, with no fixed waits:
+the acquisition of a point is a future resolved by the shot that completes it.
+The stages of neighbouring points overlap, so a scan is limited by the cycle time of the experiment:
+the sequence of the next point is compiled while the current point is imaging,
+and the shots of a point are analysed while the next point is acquiring.
+"""
+
+import asyncio
+
+
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+class ShotCollector:
+    """Collects the shots of the point being acquired, and resolves the future of the point when it has all of them.
+    Shots arriving while no point is being acquired are thrown away."""
+
+    def __init__(self,loop=None):
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.future = None
+        self.nshots = 0
+        self.shots = []
+        self.lastframe = self.loop.time()
+
+    @property
+    def collecting(self):
+        return self.future is not None and not self.future.done()
+
+    def expect(self,nshots):
+        """Start collecting the shots of a new point
+
+        :param nshots: number of shots of the point
+        :type nshots: int
+        :return: future with the list of shots, resolved when the last one has arrived
+        :rtype: asyncio.Future"""
+        self.cancel()
+        self.future = self.loop.create_future()
+        self.nshots = nshots
+        self.shots = []
+        return self.future
+
+    def frame_received(self):
+        """Note that a frame arrived from the camera, complete shot or not, see :py:meth:`ScanEngine.settle`"""
+        self.lastframe = self.loop.time()
+
+    def add(self,shot):
+        """Add a shot to the point being acquired
+
+        :return: True if the shot was taken, False if no point is being acquired
+        :rtype: bool"""
+        if not self.collecting:
+            return False
+        self.shots.append(shot)
+        if len(self.shots) >= self.nshots:
+            self.future.set_result(self.shots)
+        return True
+
+    def cancel(self):
+        if self.collecting:
+            self.future.cancel()
+
+
+class ScanEngine:
+    """Runs a scan point by point, pipelining the points: for every point the running sequence is stopped,
+    the engine waits until the frames have settled, starts collecting and then the sequence of the point is armed and started,
+    the sequence of the following point is compiled while the shots come in, and as soon as the last shot has arrived
+    the analysis of the point is started in a task, while the next point is acquiring.
+
+    All the stages are coroutine functions taking the point:
+
+    :param compile_point: compile the sequence of a point, without changing the running sequence
+    :param start_point: arm the compiled sequence of the point and start it. It is called once collecting has started,
+                        so anything it clears before its first await is cleared before the first frame of the point
+    :param stop_point: stop the running sequence, called before every point and after the last
+    :param analyse_point: analyse the shots of a point, called as analyse_point(point, shots)
+    :param collector: collector fed with the shots by the GUI
+    :type collector: ShotCollector
+    :param settle: seconds without frames before a point is started, so frames of the previous point still on their way are not taken
+    :type settle: float"""
+
+    def __init__(self,compile_point,start_point,stop_point,analyse_point,collector,settle=0.3,loop=None):
+        self.compile_point = compile_point
+        self.start_point = start_point
+        self.stop_point = stop_point
+        self.analyse_point = analyse_point
+        self.collector = collector
+        self.settle = settle
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+
+    async def wait_settled(self):
+        """Wait until no frame has arrived for settle seconds"""
+        while True:
+            remaining = self.collector.lastframe + self.settle - self.loop.time()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    async def _acquire(self,points,nshots,analyses):
+        try:
+            if len(points):
+                await self.compile_point(points[0])
+            for i,apoint in enumerate(points):
+                #stop whatever runs before the point, and let its last frames arrive before collecting, so none of them are taken for the point
+                await self.stop_point(apoint)
+                await self.wait_settled()
+                shots = self.collector.expect(nshots)
+                await self.start_point(apoint)
+                if i + 1 < len(points):
+                    await self.compile_point(points[i+1])
+                shots = await shots
+                analyses.put_nowait(self.loop.create_task(self.analyse_point(apoint,shots)))
+            if len(points):
+                await self.stop_point(points[-1])
+        finally:
+            self.collector.cancel()
+            analyses.put_nowait(None)
+
+    async def run(self,points,nshots):
+        """Run the scan, yielding the results of the analyses in the order of the points::
+
+            async for i,point,result in engine.run(points,nshots):
+                ...
+
+        The acquisition goes on while the results are handled, so handling them must not block the event loop.
+
+        :param points: the points of the scan
+        :param nshots: number of shots for each point
+        :type nshots: int
+        :return: asynchronous generator of (index, point, result of analyse_point)"""
+        analyses = asyncio.Queue()
+        acquisition = self.loop.create_task(self._acquire(points,nshots,analyses))
+        pending = []
+        try:
+            for i,apoint in enumerate(points):
+                analysis = await analyses.get()
+                if analysis is None:
+                    await acquisition #raises the error that stopped the acquisition
+                    return
+                pending.append(analysis)
+                yield i,apoint,await analysis
+            await acquisition
+        finally:
+            acquisition.cancel()
+            for analysis in pending:
+                analysis.cancel()
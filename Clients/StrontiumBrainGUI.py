@@ -9,6 +9,7 @@ from PyQt5.QtWidgets import *
 from PyQt5 import QtGui,QtCore
 import sys
 import asyncio
+import QtLoop
 from qweather import QWeatherClient
 import time
 import numpy as np
@@ -283,58 +284,78 @@ class SrBrainGui(QWidget):
             self.setTabOrder(firstbox,followingbox)
 
 
+    def pattern(self,values = None): # Digital and analog outputs of the pattern in the boxes
+        """The outputs of the pattern in the timing boxes
+
+        :param values: dictionary of channel name to switch times (in the unit of the time resolution), used instead of the boxes of those channels
+        :type values: dict
+        :return: (digital, analog, maxtime) with digital a dictionary of channel name to [(tstart, tstop), ...] and analog of channel name to [(tstart, tstop, volt)], in seconds
+        :rtype: tuple"""
+        if values is None:
+            values = {}
+        digital = {}
+        analog = {}
+        maxtime = 0
+        for aname,achannelrow in zip(self.channelsDO,self.timingboxesDO):
+            timings = sorted(list(set([i*self.timeresolution.currentData() for i in values.get(aname,[abox.value() for abox in achannelrow])])))
+            if timings and timings[0] == 0:
+                timings.pop(0)
+            if self.channelOnDict[aname]:
+                timings.insert(0,0)
+            if len(timings)%2 == 0:
+                digital[aname] = list(zip(timings[::2],timings[1::2]))
+                if timings and timings[-1] > maxtime:
+                    maxtime = timings[-1]
+        if len(self.tAO) > 0: # Don't add the AO channels if the AO time array is empty
+            tstop = max(self.tAO)
+            if tstop > maxtime:
+                maxtime = tstop
+            for aname in self.channelsAO:
+                analog[aname] = [(0.0,tstop,5.0)] # Single value voltage
+        maxtime += 1e-6 #added this to prevent some corner crashes when two signals have to turn off at the end of the time sequence.
+        return digital,analog,maxtime
+
+    def compile_pattern(self,values = None): # Compile a pattern on the server without arming it
+        """Compile the pattern on the server while the current one keeps running. Arm it with Srbrain.armCompiledSequence()
+
+        :param values: switch times replacing those in the boxes, see :py:meth:`pattern`"""
+        digital,analog,maxtime = self.pattern(values)
+        return self.Srbrain.compileSequence(digital,analog,self.UAO,user_Max_Time = maxtime)
+
     def arm_pattern(self): # Arm digital and/or analog output patterns
-        self.Srbrain.clearDigitalSequence()
-        self.Srbrain.clearAnalogOutput()
+        digital,analog,maxtime = self.pattern()
         xdatalist = []
         ydatalist = []
-        maxtime = 0
-        for aname,achannelrow,rownumber in zip(self.channelsDO,self.timingboxesDO,range(len(self.channelsDO))):
-            timings = sorted(list(set([i.value()*self.timeresolution.currentData() for i in achannelrow])))
-            if timings[0] == 0:
-                timings.pop(0)
+        for aname,rownumber in zip(self.channelsDO,range(len(self.channelsDO))):
+            if aname not in digital:
+                continue
             xdata = []
             ydata = []
             ylow = 0.25 + len(self.channelsDO) + len(self.channelsAO) -rownumber -1.5
             yhigh = 0.75 + len(self.channelsDO) + len(self.channelsAO) -rownumber -1.5
-            if self.channelOnDict[aname]:
-                timings.insert(0,0)
-            if len(timings)%2 != 0:
-                pass
-            else:
-                for tstart,tstop in zip(timings[::2],timings[1::2]):
-                    if tstop> maxtime:
-                        maxtime = tstop
-                    self.Srbrain.addDigitalOutput(aname,tstart,tstop)
-                    xdata += [tstart,tstart, tstop, tstop]
-                    if len(ydata) == 0:
-                        ydata +=[ylow, yhigh, yhigh, ylow]
+            for tstart,tstop in digital[aname]:
+                xdata += [tstart,tstart, tstop, tstop]
+                if len(ydata) == 0:
+                    ydata +=[ylow, yhigh, yhigh, ylow]
+                else:
+                    if ydata[-1] == yhigh:
+                        ydata += [yhigh, ylow, ylow, yhigh]
                     else:
-                        if ydata[-1] == yhigh:
-                            ydata += [yhigh, ylow, ylow, yhigh]
-                        else:
-                            ydata += [ylow, yhigh, yhigh, ylow]
-                xdatalist.append(np.array(xdata)*1000)
-                ydatalist.append(np.array(ydata))
+                        ydata += [ylow, yhigh, yhigh, ylow]
+            xdatalist.append(np.array(xdata)*1000)
+            ydatalist.append(np.array(ydata))
                 
-        for aname,achannelrow,rownumber in zip(self.channelsAO,self.timingboxesAO,range(len(self.channelsAO))):
-            
-            if len(self.tAO) > 0: # Don't run this if there if the AO time array is empty
-                tstop = max(self.tAO)
+        for aname,rownumber in zip(self.channelsAO,range(len(self.channelsAO))):
+            if aname in analog:
+                tstop = analog[aname][0][1]
                 self.timingboxesAO[rownumber][0].setValue(tstop/self.timeresolution.currentData())# Update value displayed in GUI
-                if tstop > maxtime:
-                    maxtime = tstop
-                    
-                self.Srbrain.addAnalogOutput(aname,0.0,tstop,5.0) # Single value voltage
-                
                 xdatalist.append(np.float(1e3)*np.linspace(0,tstop,len(self.UAO))) # UAO should be type np.float64
                 UAOrescaled = 0.5*(self.UAO-min(self.UAO))/(max(self.UAO)-min(self.UAO)) + len(self.channelsAO)-rownumber - 1.25
                 ydatalist.append(np.float(1)*UAOrescaled)
-                
-        maxtime += 1e-6 #added this to prevent some corner crashes when two signals have to turn off at the end of the time sequence.
         
         self.plot_timings(xdatalist,ydatalist) # Plot DO and AO signals
-        self.Srbrain.armSequence(self.UAO,user_Max_Time = maxtime)
+        self.Srbrain.compileSequence(digital,analog,self.UAO,user_Max_Time = maxtime)
+        self.Srbrain.armCompiledSequence()
         
         
     def plot_timings(self,xlist,ylist):
@@ -357,10 +378,6 @@ class SrBrainGui(QWidget):
         self.aopopup.sendAOsignal.connect(self.importAOdata) # Connect to AO popup
 
 
-async def process_events(qapp):
-    while True:
-        await asyncio.sleep(0.1)
-        qapp.processEvents()
 
 
 def icon():
@@ -440,9 +457,8 @@ if __name__=="__main__":
     import ctypes
     myappid = u'mycompany.myproduct.subproduct.version2' # arbitrary string
     ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
-    loop = asyncio.get_event_loop()
+    loop = QtLoop.make_loop(a)
     w = SrBrainGui(loop)
-    loop.create_task(process_events(a))
-    loop.run_until_complete(process_events(a))
+    QtLoop.run(loop)
 
 
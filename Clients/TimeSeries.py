@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Fixed capacity time series for monitoring plots that run for hours, e.g. the atom number of every shot
+
+Appending a value, updating the statistics and getting the data to plot all take the same time
+however long the series has been running: the values are kept in a preallocated ring buffer,
+the mean and variance of all values are kept with Welford's algorithm,
+and those of the values in the buffer (the window) are updated by adding the new value and removing the one it replaces.
+"""
+
+import numpy as np
+
+
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+class RunningStats:
+    """Mean and variance of a stream of values with Welford's algorithm, numerically stable and O(1) per value"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self,value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta/self.count
+        self.m2 += delta*(value - self.mean)
+
+    @property
+    def variance(self):
+        """Population variance (as np.var), NaN without values"""
+        return self.m2/self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(max(self.variance,0)) if self.count else np.nan
+
+
+class RollingSeries:
+    """Ring buffer of the last capacity values with their shot numbers, and statistics over all values and over the buffer.
+
+    Every value is written twice, at its place in the buffer and capacity places later,
+    so the values in order are always a contiguous slice that can be plotted without copying or reordering.
+
+    :param capacity: number of values kept
+    :type capacity: int"""
+
+    def __init__(self,capacity=1000):
+        self.capacity = capacity
+        self._x = np.zeros(2*capacity)
+        self._y = np.zeros(2*capacity)
+        self.total = RunningStats()
+        self.clear()
+
+    def clear(self):
+        self.total.reset()
+        self.start = 0
+        self.length = 0
+        self.count = 0
+        self.windowmean = 0.0
+        self.windowm2 = 0.0
+
+    def __len__(self):
+        return self.length
+
+    def append(self,value):
+        """Add a value with the next shot number, replacing the oldest value if the buffer is full"""
+        value = float(value)
+        self.total.add(value)
+        if self.length < self.capacity:
+            index = (self.start + self.length)%self.capacity
+            self.length += 1
+            delta = value - self.windowmean
+            self.windowmean += delta/self.length
+            self.windowm2 += delta*(value - self.windowmean)
+        else:
+            index = self.start
+            old = self._y[index]
+            oldmean = self.windowmean
+            self.windowmean += (value - old)/self.capacity
+            self.windowm2 += (value - old)*(value - self.windowmean + old - oldmean)
+            self.start = (self.start + 1)%self.capacity
+        self._x[index] = self._x[index + self.capacity] = self.count
+        self._y[index] = self._y[index + self.capacity] = value
+        self.count += 1
+
+    @property
+    def x(self):
+        """Shot numbers of the values in the buffer, oldest first, a view valid until the next append"""
+        return self._x[self.start:self.start + self.length]
+
+    @property
+    def y(self):
+        """Values in the buffer, oldest first, a view valid until the next append"""
+        return self._y[self.start:self.start + self.length]
+
+    @property
+    def mean(self):
+        """Mean of the values in the buffer, NaN if it is empty"""
+        return self.windowmean if self.length else np.nan
+
+    @property
+    def std(self):
+        """Standard deviation of the values in the buffer (as np.std), NaN if it is empty"""
+        return np.sqrt(max(self.windowm2/self.length,0)) if self.length else np.nan
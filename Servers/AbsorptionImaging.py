@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Absorption imaging on the camera server.
+
+Frames are grouped in shots of three, (atoms, probe, background), in the order they are taken.
+Every shot is reduced to an optical depth image in float32 and the atom number, centroid and widths in a region of interest,
+so clients monitoring the atom number only have to fetch the small results, and the images only when they want them.
+'''
+import numpy as np
+import time
+import AcquisitionBuffer as ab
+import CameraTools as ct
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+def optical_depth(atoms,probe,background=None,offset=0.1):
+    """Optical depth -ln((atoms - background)/(probe - background)) in float32.
+    Differences below zero are set to zero, and offset is added to both, so empty pixels do not give infinities
+
+    :param atoms: image with atoms and probe light
+    :param probe: image with probe light only
+    :param background: image without probe light, or None to not subtract a background
+    :param offset: counts added to numerator and denominator
+    :type offset: float
+    :return: optical depth
+    :rtype: numpy.ndarray"""
+    atoms = np.asarray(atoms,dtype=np.float32)
+    probe = np.asarray(probe,dtype=np.float32)
+    if background is not None:
+        background = np.asarray(background,dtype=np.float32)
+        atoms = atoms - background
+        probe = probe - background
+    offset = np.float32(offset)
+    numerator = np.maximum(atoms,0) + offset
+    denominator = np.maximum(probe,0) + offset
+    od = np.divide(numerator,denominator,out=numerator)
+    np.log(od,out=od)
+    np.negative(od,out=od)
+    return od
+
+
+def crop(image,roi):
+    """View of the region of interest (x, y, width, height) of an image of shape (rows, columns), the whole image if roi is None"""
+    if roi is None:
+        return image
+    x,y,width,height = [int(aval) for aval in roi]
+    return image[y:y+height,x:x+width]
+
+
+def moments(od):
+    """Centroid and rms widths in pixels of the positive part of an optical depth image, from its first and second moments
+
+    :param od: optical depth image of shape (rows, columns)
+    :return: (x, y) centroid and (x, y) widths, NaN if there is no positive optical depth
+    :rtype: tuple"""
+    weights = np.maximum(od,0)
+    px = weights.sum(axis=0,dtype=np.float64)
+    py = weights.sum(axis=1,dtype=np.float64)
+    total = px.sum()
+    if total <= 0:
+        return (np.nan,np.nan),(np.nan,np.nan)
+    x = np.arange(len(px))
+    y = np.arange(len(py))
+    x0 = np.dot(px,x)/total
+    y0 = np.dot(py,y)/total
+    sx = np.sqrt(max(np.dot(px,(x - x0)**2)/total,0))
+    sy = np.sqrt(max(np.dot(py,(y - y0)**2)/total,0))
+    return (x0,y0),(sx,sy)
+
+
+class AbsorptionPipeline:
+    """Groups frames in (atoms, probe, background) shots and processes every complete shot.
+    The results are kept in a ring buffer, each with the optical depth image of the shot.
+
+    If a frame id is skipped (a frame got lost) the frames of the incomplete shot are thrown away,
+    so the frames do not end up in the wrong place in the following shots.
+
+    :param roi: region of interest (x, y, width, height) in pixels of the frames as they come from the camera, binned
+                and relative to the region read out of the sensor, None for the whole image
+    :type roi: tuple
+    :param sensorpixel: side of an unbinned sensor pixel in the object plane in meters. The pixel size of a shot is this times the binning of its frames
+    :type sensorpixel: float
+    :param wavelength: wavelength of the probe light in meters
+    :type wavelength: float
+    :param offset: counts added in the optical depth, see :py:func:`optical_depth`
+    :type offset: float
+    :param subtract_background: subtract the background image from atoms and probe
+    :type subtract_background: bool
+    :param maxlen: number of shots to keep
+    :type maxlen: int"""
+
+    def __init__(self,roi=None,sensorpixel=5.86e-6,wavelength=461e-9,offset=0.1,subtract_background=True,maxlen=10):
+        self.roi = roi
+        self.sensorpixel = sensorpixel
+        self.wavelength = wavelength
+        self.offset = offset
+        self.subtract_background = subtract_background
+        self.shots = ab.RingBuffer(maxlen)
+        self.pending = []
+
+    @property
+    def cross_section(self):
+        """Resonant cross section of a two level atom, 3 lambda^2 / 2 pi"""
+        return 3*self.wavelength**2/(2*np.pi)
+
+    def reset(self):
+        """Throw away the frames of an incomplete shot, so the next frame is taken as the atoms image"""
+        self.pending = []
+
+    def add(self,frame):
+        """Add a frame and process the shot if it is complete
+
+        :param frame: compact frame, see :py:func:`CameraTools.pack_frame`
+        :type frame: dict
+        :return: id of the shot if it was completed, else None
+        :rtype: int"""
+        if self.pending and frame['frame_id'] != self.pending[-1]['frame_id'] + 1:
+            print('Frame {:d} does not follow frame {:d}, starting a new shot'.format(frame['frame_id'],self.pending[-1]['frame_id']))
+            self.pending = []
+        self.pending.append(frame)
+        if len(self.pending) < 3:
+            return None
+        shot = self.pending
+        self.pending = []
+        return self.shots.append(self.process(*shot))
+
+    def process(self,atoms,probe,background):
+        """Process a single shot
+
+        :return: dictionary with the results and the optical depth image in od
+        :rtype: dict"""
+        images = [ct.frame_array(aframe) for aframe in (atoms,probe,background)]
+        od = optical_depth(crop(images[0],self.roi),crop(images[1],self.roi),
+                           crop(images[2],self.roi) if self.subtract_background else None,self.offset)
+        (x0,y0),(sx,sy) = moments(od)
+        xoffset,yoffset = (0,0) if self.roi is None else self.roi[:2]
+        pixelsize = self.sensorpixel*atoms.get('binning',1)
+        return {'timestamp':atoms['timestamp'],
+                'processed':time.time(),
+                'frame_ids':[aframe['frame_id'] for aframe in (atoms,probe,background)],
+                'roi':self.roi,
+                'pixelsize':pixelsize,
+                'atomnumber':float(pixelsize**2/self.cross_section*od.sum(dtype=np.float64)),
+                'centroid':(float(x0 + xoffset),float(y0 + yoffset)),
+                'widths':(float(sx),float(sy)),
+                'peak_od':float(od.max()),
+                'od':od}
+
+    def results(self,shots):
+        """The results of a list of (id, shot) from the buffer, without the images"""
+        return [dict(((akey,aval) for akey,aval in ashot.items() if akey != 'od'),shot=shotid) for shotid,ashot in shots]
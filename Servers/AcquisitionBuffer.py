@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Continuous acquisition for the QWeather servers.
+
+A background thread keeps fetching records from an instrument into a bounded ring buffer,
+so QMethods can hand out the newest records without waiting on the instrument.
+'''
+import threading
+import collections
+import contextlib
+import time
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+class RingBuffer:
+    """Bounded buffer of records. When it is full the oldest records are dropped.
+    Every record gets an id, counting from 0 since the buffer was made, so clients can ask for the records they have not seen yet.
+
+    :param maxlen: Number of records to keep
+    :type maxlen: int"""
+
+    def __init__(self,maxlen):
+        self.records = collections.deque(maxlen=maxlen)
+        self.count = 0
+        self.condition = threading.Condition()
+
+    def append(self,record):
+        """Add a record and wake up everybody waiting for new records
+
+        :return: id of the record
+        :rtype: int"""
+        with self.condition:
+            recordid = self.count
+            self.records.append((recordid,record))
+            self.count += 1
+            self.condition.notify_all()
+        return recordid
+
+    def latest(self):
+        """The newest record
+
+        :return: (id, record) or None if the buffer is empty
+        :rtype: tuple"""
+        with self.condition:
+            if len(self.records) == 0:
+                return None
+            return self.records[-1]
+
+    def since(self,recordid,timeout=0):
+        """All records still in the buffer with an id larger than or equal to recordid
+
+        :param timeout: Time in seconds to wait for the record recordid, if it has not been appended yet
+        :type timeout: float
+        :return: list of (id, record)
+        :rtype: list"""
+        with self.condition:
+            if timeout > 0:
+                self.condition.wait_for(lambda: self.count > recordid,timeout)
+            return [arecord for arecord in self.records if arecord[0] >= recordid]
+
+    def next(self,N,timeout=10):
+        """Wait for the next N records appended after the call
+
+        :param N: Number of records to wait for
+        :type N: int
+        :param timeout: Time in seconds to wait. If it runs out, the records that did arrive are returned
+        :type timeout: float
+        :return: list of (id, record)
+        :rtype: list"""
+        with self.condition:
+            first = self.count
+            self.condition.wait_for(lambda: self.count >= first + N,timeout)
+            return [arecord for arecord in self.records if first <= arecord[0] < first + N]
+
+    def clear(self):
+        with self.condition:
+            self.records.clear()
+
+
+class AcquisitionThread(threading.Thread):
+    """Daemon thread calling fetch in a loop and appending what it returns to a RingBuffer, until it is stopped.
+    Each call of fetch is done while holding lock, so QMethods sharing the lock are not interleaved with a transfer.
+    fetch can return None if there was nothing to get.
+
+    :param fetch: Function getting a single record from the instrument
+    :type fetch: callable
+    :param maxlen: Number of records to keep in the buffer
+    :type maxlen: int
+    :param lock: Lock protecting the instrument connection, or None if fetch takes the lock itself,
+                 e.g. to release it while waiting for a trigger
+    :type lock: threading.Lock, threading.RLock"""
+
+    def __init__(self,fetch,maxlen=100,lock=None):
+        super(AcquisitionThread, self).__init__()
+        self.daemon = True
+        self.fetch = fetch
+        self.buffer = RingBuffer(maxlen)
+        self.lock = contextlib.nullcontext() if lock is None else lock
+        self._stopevent = threading.Event()
+        self.errors = 0
+
+    def stop(self,timeout=None):
+        """Stop the thread after the current fetch, and wait for it to finish"""
+        self._stopevent.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+    def stopped(self):
+        return self._stopevent.is_set()
+
+    def run(self):
+        while not self.stopped():
+            try:
+                with self.lock:
+                    record = self.fetch()
+            except Exception as e:
+                self.errors += 1
+                print('Continuous acquisition failed:',e)
+                time.sleep(0.1)
+                continue
+            if record is not None:
+                self.buffer.append(record)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 '''Server (Qweather) to grab data from the Agilent 34461A'''
 from qweather import QWeatherServer, QMethod
-import visa
+import VisaBackend as vb
 import numpy as np
 import serial
 import time
@@ -38,8 +38,7 @@ class Server(QWeatherServer):
     '''
 
     def initialize_hardware(self):
-        rm = visa.ResourceManager()
-        self.hardware = rm.open_resource(self.visaaddr)
+        self.hardware = vb.open_resource(self.visaaddr,'Agilent 34461A')
         print('Multimeter server running. Made contact with:')
         print(self.hardware.query('*IDN?'))
         print('*'*50)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 '''Server (Qweather) to grab data from the HP531813A Frequency Counter'''
 from qweather import QWeatherServer, QMethod
-import visa
+import VisaBackend as vb
 import numpy as np
 import serial
 import time
@@ -50,8 +50,7 @@ class Server(QWeatherServer):
     '''
 
     def initialize_hardware(self):
-        rm = visa.ResourceManager()
-        self.hardware = rm.open_resource(self.TCPIPaddr)
+        self.hardware = vb.open_resource(self.TCPIPaddr,'Agilent 53230A')
         print('Frequency counter server running. Made contact with:')
         print(self.hardware.query('*IDN?'))
         print('*'*50)
@@ -5,8 +5,14 @@ import PySpin as ps
 from qweather import QWeatherServer, QMethod
 import time
 import atexit
+import CameraTools as ct
+import AcquisitionBuffer as ab
+import AbsorptionImaging as ai
+import SyntheticCamera as sc
 
 demo = False
+SENSORSHAPE = (1200,1920) #rows, columns of the sensor
+
 class Server(QWeatherServer):
     def __init__(self):
         if True:
@@ -20,11 +26,19 @@ class Server(QWeatherServer):
 
 
         self.bit8 = True
+        self.framecompression = None
+        self.frame_id = 0
+        self.acquisition = None
+        self.absorption = None
+        self.bins = 1
+        self.sensorroi = None #region of the sensor read out (x, y, width, height) in sensor pixels, None for the whole sensor
+        self.frameformat = {}
         if demo:
-            self.demodata = np.genfromtxt('testpic2.csv',delimiter='\n',dtype='float')
-            print('demo mode, demo data loaded')
+            self.synthetic = sc.SyntheticCamera(SENSORSHAPE)
+            print('demo mode, frames from a synthetic camera')
         if not demo:
             self.initialize_hardware()
+        self._apply_roi()
         atexit.register(self.onClosing)
 
 
@@ -49,6 +63,7 @@ class Server(QWeatherServer):
         self.acquisitionMode('single')
         self.triggerMode('on')
         self.triggerSource('hardware',risingedge = True)
+        self.bins = self.cam.BinningVertical.GetValue()
 
 
 
@@ -177,6 +192,7 @@ class Server(QWeatherServer):
 
     @QMethod
     def bitFormat(self, bitsize = None):
+        '''sets or gets the pixel format: 8 for Mono8, 12 for Mono12Packed (12 bits in 1.5 bytes per pixel, unpacked on the client) or 16 for Mono16'''
         if demo:
             return bitsize
         if bitsize is None:
@@ -187,6 +203,10 @@ class Server(QWeatherServer):
             self.bit8 = True
         elif bitsize == 12:
             print('changing bitformat now to 12')
+            self.cam.PixelFormat.SetValue(ps.PixelFormat_Mono12Packed)
+            self.bit8 = False
+        elif bitsize == 16:
+            print('changing bitformat now to 16')
             self.cam.PixelFormat.SetValue(ps.PixelFormat_Mono16)
             self.bit8 = False
         else:
@@ -194,6 +214,20 @@ class Server(QWeatherServer):
             return False
         return True
 
+    @QMethod
+    def compression(self, method = None):
+        '''sets or gets the lossless compression of the frames sent to clients: zlib, lz4 (if the lz4 package is installed) or none'''
+        if method is None:
+            return self.framecompression
+        elif method.lower() == 'none':
+            self.framecompression = None
+        elif method.lower() in ct.compressions():
+            self.framecompression = method.lower()
+        else:
+            print('Failed to set compression, did not understand keyword: ',method)
+            return False
+        return True
+
     @QMethod
     def triggerMode(self, mode = None):
         if demo:
@@ -230,15 +264,29 @@ class Server(QWeatherServer):
 
     @QMethod
     def binning(self,bins = None):
+        '''sets or gets the binning, the same horizontally and vertically: binning(2) or binning((2,2)) for 2x2 binning.
+        The sensor region set by sensorROI is kept, and the frames get the new shape. Not while grabbing'''
         if bins is None:
+            if demo:
+                return (self.bins,self.bins)
             return (self.cam.BinningHorizontal.GetValue(),
                     self.cam.BinningVertical.GetValue())
-        else:
-            horizontalbins = bins[0]
-            verticalbins = bins[1]
-#            self.cam.BinningHorizontal.SetValue(horizontalbins)
-            self.cam.BinningVertical.SetValue(verticalbins)
-            return True
+        if not np.isscalar(bins):
+            if bins[0] != bins[1]:
+                print('Failed to set binning, only symmetric binning is supported: ',bins)
+                return False
+            bins = bins[0]
+        if self.acquisition is not None:
+            print('Failed to set binning, stop grabbing first')
+            return False
+        bins = int(bins)
+        if not demo:
+            self.cam.BinningVertical.SetValue(bins)
+            if ps.IsWritable(self.cam.BinningHorizontal): #on some models horizontal binning follows the vertical
+                self.cam.BinningHorizontal.SetValue(bins)
+        self.bins = bins
+        self._apply_roi()
+        return True
 
     @QMethod
     def binningMode(self,binningMode = None):
@@ -246,41 +294,106 @@ class Server(QWeatherServer):
             return (self.cam.BinningHorizontalMode.GetCurrentEntry().GetSymbolic(),
                     self.cam.BinningVerticalMode.GetCurrentEntry().GetSymbolic())
         elif binningMode.lower() == 'average':
-            #self.cam.BinningHorizontalMode.SetValue(ps.BinningHorizontalMode_Average)
             self.cam.BinningVerticalMode.SetValue(ps.BinningVerticalMode_Average)
+            if ps.IsWritable(self.cam.BinningHorizontalMode):
+                self.cam.BinningHorizontalMode.SetValue(ps.BinningHorizontalMode_Average)
             return True
         elif binningMode.lower() == 'sum':
-            #self.cam.BinningHorizontalMode.SetValue(ps.BinningHorizontalMode_Sum)
             self.cam.BinningVerticalMode.SetValue(ps.BinningVerticalMode_Sum)
+            if ps.IsWritable(self.cam.BinningHorizontalMode):
+                self.cam.BinningHorizontalMode.SetValue(ps.BinningHorizontalMode_Sum)
             return True
         else:
             print('Failed to set BinningMode, did not understand keyword: ',binningMode)
             return False
 
+    @QMethod
+    def sensorROI(self,roi = None):
+        '''sets or gets the region of the sensor that is read out (x, y, width, height) in sensor pixels, set it to 'full' for the whole sensor.
+        The region is rounded to what the camera allows with the current binning. A smaller region gives a higher frame rate and smaller frames. Not while grabbing'''
+        if roi is None:
+            return self.frameformat['sensorroi']
+        if self.acquisition is not None:
+            print('Failed to set the sensor region, stop grabbing first')
+            return False
+        self.sensorroi = None if roi == 'full' else tuple(int(aval) for aval in roi)
+        self._apply_roi()
+        return True
 
+    @QMethod
+    def frameFormat(self):
+        '''The format of the frames: a dictionary with shape (rows, columns), binning, offset (x, y) of the image on the sensor in binned pixels
+        and sensorroi, the region read out in sensor pixels. Every frame has the entries binning and offset as well'''
+        return dict(self.frameformat)
+
+    def _set_int(self,node,value):
+        """Set an integer node to value, rounded down to the increment of the node and clipped to its range"""
+        vmin,vmax,inc = node.GetMin(),node.GetMax(),node.GetInc()
+        value = min(max(vmin + (int(value) - vmin)//inc*inc,vmin),vmax)
+        node.SetValue(value)
+        return value
+
+    def _apply_roi(self):
+        """Set the region read out to sensorroi with the current binning, and update the frame format"""
+        rows,columns = SENSORSHAPE[0]//self.bins,SENSORSHAPE[1]//self.bins
+        x,y,width,height = (0,0,columns*self.bins,rows*self.bins) if self.sensorroi is None else self.sensorroi
+        if demo:
+            offset = (min(max(x//self.bins,0),columns - 1),min(max(y//self.bins,0),rows - 1))
+            shape = (min(max(height//self.bins,1),rows - offset[1]),min(max(width//self.bins,1),columns - offset[0]))
+        else:
+            #the offsets are set to 0 first, so the width and height can take any value up to the full sensor
+            self.cam.OffsetX.SetValue(0)
+            self.cam.OffsetY.SetValue(0)
+            shape = (self._set_int(self.cam.Height,height//self.bins),self._set_int(self.cam.Width,width//self.bins))
+            offset = (self._set_int(self.cam.OffsetX,x//self.bins),self._set_int(self.cam.OffsetY,y//self.bins))
+        self.frameformat = {'shape':shape,
+                            'binning':self.bins,
+                            'offset':offset,
+                            'sensorroi':(offset[0]*self.bins,offset[1]*self.bins,shape[1]*self.bins,shape[0]*self.bins)}
+
+    @property
+    def framemetadata(self):
+        """Entries added to every frame, so clients know where the image is on the sensor"""
+        return {'binning':self.frameformat['binning'],'offset':self.frameformat['offset']}
+
+    def demo_frame(self):
+        """Next frame of the synthetic camera (atoms, probe and background in turn) in the current binning and sensor region,
+        with a frame id counting up like the camera's"""
+        self.frame_id += 1
+        data = self.synthetic.frame(bins=self.bins,offset=self.frameformat['offset'],shape=self.frameformat['shape'])
+        return ct.pack_frame(data,self.frame_id,compression=self.framecompression,**self.framemetadata)
+
+    @QMethod
+    def demoCamera(self,settings = None):
+        """sets or gets the settings of the synthetic camera of the demo mode, a dictionary of settings to change,
+        e.g. {'tof':5,'temperature':1e-3,'framerate':20}, see :py:class:`SyntheticCamera.SyntheticCamera`. Returns False when not in demo mode"""
+        if not demo:
+            return False
+        if settings is None:
+            return self.synthetic.settings()
+        try:
+            self.synthetic.configure(**settings)
+        except ValueError as e:
+            print('Failed to change the demo camera:',e)
+            return False
+        return True
 
     @QMethod
     def acquireSingleImage(self):
+        """Acquire a single image. Returns a compact frame (see :py:func:`CameraTools.pack_frame`), False on errors and None if not in single frame mode"""
         if demo:
-            return self.demodata
+            return self.demo_frame()
         if self.cam.AcquisitionMode.GetValue() == ps.AcquisitionMode_SingleFrame:
             self.cam.BeginAcquisition()
             try:
                 image_result = self.cam.GetNextImage()
+                data = None
                 if image_result.IsIncomplete():
                         print('Image incomplete with image status %d ...' % image_result.GetImageStatus())
 
                 else:
-                    if self.bit8:
-                        data = np.array(image_result.GetData())
-                        print('8 bit')
-                    else:
-                        #newimage = image_result.Convert(ps.PixelFormat_Mono16)
-                        print('her')
-                        newimage = image_result.Convert(ps.PixelFormat_Mono8)
-                        data = np.array(newimage.GetData())
-                        print('converted')
-                    image_result.Release()
+                    data = ct.spinnaker_frame(image_result,self.framecompression,**self.framemetadata)
+                image_result.Release()
 
             except ps.SpinnakerException as ex:
                 print('Error: %s' % ex)
@@ -311,29 +424,25 @@ class Server(QWeatherServer):
 
     @QMethod
     def getImage(self):
+        """Wait for the next image in continuous mode. Returns a compact frame (see :py:func:`CameraTools.pack_frame`)
+        in Mono8, Mono12Packed or Mono16 as set by :py:meth:`bitFormat`, where Mono12Packed frames are sent packed with a packing entry (see :py:func:`CameraTools.pack_frame12`).
+        Returns None if the image is incomplete or not in continuous mode and False on errors.
+        While grabbing (see :py:meth:`startGrabbing`) the next frame from the buffer is returned, or None if none arrives within 10 s"""
+        if self.acquisition is not None:
+            frames = self.getNextFrames(1,10)
+            return frames[0] if len(frames) > 0 else None
         if demo:
-            return self.demodata
+            return self.demo_frame()
         if self.cam.AcquisitionMode.GetValue() == ps.AcquisitionMode_Continuous:
             try:
                 image_result = self.cam.GetNextImage()
                 if image_result.IsIncomplete():
                     print('Image incomplete with image status %d ...' % image_result.GetImageStatus())
+                    image_result.Release()
                     return None
                 else:
-                    if self.bit8:
-                        #print(image_result.GetData())
-                        data = image_result.GetData()
-                        #print(max(data))
-                        #print(len(data))
-                    else:
-                        #print('before:')
-                        #print(image_result.GetData())
-                        #print(len(image_result.GetData()))
-                        #print(max(image_result.GetData()))
-                        data = image_result.Convert(ps.PixelFormat_Mono16).GetData()
-                        #print('after')
-                        #print(max(data))
-                        #print(len(data))
+                    #The pixels are copied out of the camera buffer once, without conversion, Mono12Packed frames stay packed and are unpacked on the client
+                    data = ct.spinnaker_frame(image_result,self.framecompression,**self.framemetadata)
                     image_result.Release()       
             except ps.SpinnakerException as ex:
                 print('Error: %s' % ex)
@@ -344,7 +453,161 @@ class Server(QWeatherServer):
 
 
 
+    def _grab_frame(self):
+        """Wait up to half a second for the next image, pack it and pass it on to the absorption imaging if it is enabled.
+        Called repeatedly by the grab thread, the short timeout lets the thread notice when it is stopped while waiting for a trigger
+
+        :return: compact frame, see :py:func:`CameraTools.pack_frame`, or None if there was no complete image"""
+        frame = self._take_frame()
+        absorption = self.absorption
+        if frame is not None and absorption is not None:
+            try:
+                absorption.add(frame)
+            except Exception as e:
+                print('Absorption imaging failed:',e)
+                absorption.reset()
+        return frame
+
+    def _take_frame(self):
+        if demo:
+            self.synthetic.wait_next_frame()
+            return self.demo_frame()
+        try:
+            image_result = self.cam.GetNextImage(500)
+        except ps.SpinnakerException as ex:
+            if getattr(ex,'errorcode',None) == -1011: #SPINNAKER_ERR_TIMEOUT, no trigger yet
+                return None
+            raise
+        try:
+            if image_result.IsIncomplete():
+                print('Image incomplete with image status %d ...' % image_result.GetImageStatus())
+                return None
+            return ct.spinnaker_frame(image_result,self.framecompression,**self.framemetadata)
+        finally:
+            image_result.Release()
+
+    @QMethod
+    def startGrabbing(self,Nbuffer=100):
+        """Start continuous acquisition on a background thread, which keeps taking images from the camera into a ring buffer
+        of the last Nbuffer frames, so no trigger is lost while a frame is on its way to a client.
+        Get the frames with :py:meth:`getLatestFrame`, :py:meth:`getNextFrames` and :py:meth:`getFramesSince`.
+        The frames get record ids counting from 0 every time grabbing is started"""
+        self.stopGrabbing()
+        if not demo:
+            self.cam.AcquisitionMode.SetValue(ps.AcquisitionMode_Continuous)
+            self.cam.BeginAcquisition()
+        self.acquisition = ab.AcquisitionThread(self._grab_frame,Nbuffer)
+        self.acquisition.start()
+        return True
+
+    @QMethod
+    def stopGrabbing(self):
+        """Stop the grab thread and the acquisition"""
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            self.acquisition = None
+            if not demo:
+                self.cam.EndAcquisition()
+        return True
+
+    def _frames(self,records):
+        """Frames of a list of buffer records, with the record id added as the entry record"""
+        return [dict(aframe,record=recordid) for recordid,aframe in records]
+
+    @QMethod
+    def getLatestFrame(self):
+        """The newest frame in the buffer without waiting, as a compact frame (see :py:func:`CameraTools.pack_frame`)
+        with the entry record, or None if there is none or the camera is not grabbing"""
+        if self.acquisition is None:
+            return None
+        latest = self.acquisition.buffer.latest()
+        if latest is None:
+            return None
+        return self._frames([latest])[0]
+
+    @QMethod
+    def getNextFrames(self,N=1,timeout=10):
+        """Wait for the next N frames, e.g. N=3 for an absorption image triplet. Returns a list of compact frames with the entry record,
+        which can be shorter than N if the timeout in seconds runs out"""
+        if self.acquisition is None:
+            return []
+        return self._frames(self.acquisition.buffer.next(N,timeout))
+
+    @QMethod
+    def getFramesSince(self,recordid,timeout=0):
+        """All frames still in the buffer from record id recordid and newer, as a list of compact frames with the entry record.
+        Use the last record id received plus one to get the frames not seen yet; with a timeout in seconds it waits for that frame if it is not there yet"""
+        if self.acquisition is None:
+            return []
+        return self._frames(self.acquisition.buffer.since(recordid,timeout))
+
+    @QMethod
+    def absorptionImaging(self,enable=True,roi=None,sensorpixel=5.86e-6,wavelength=461e-9,offset=0.1,subtract_background=True,Nshots=10):
+        """Enable or disable absorption imaging on the grabbed frames. The frames are grouped in shots of (atoms, probe, background)
+        in the order they arrive, and every shot is reduced to an optical depth image and the atom number, centroid and widths,
+        see :py:class:`AbsorptionImaging.AbsorptionPipeline`. Get the results with :py:meth:`getAbsorptionResults`
+        and the optical depth images with :py:meth:`getODImage`. Only works while grabbing, see :py:meth:`startGrabbing`
+
+        :param roi: region of interest (x, y, width, height) in binned pixels of the frames, relative to the sensor region read out, None for the whole image
+        :param sensorpixel: side of an unbinned sensor pixel in the object plane in meters, the binning of the frames is taken into account
+        :param wavelength: wavelength of the probe light in meters
+        :param offset: counts added to atoms and probe in the optical depth
+        :param subtract_background: subtract the third image of the shot from the others
+        :param Nshots: number of shots to keep"""
+        if enable:
+            self.absorption = ai.AbsorptionPipeline(roi,sensorpixel,wavelength,offset,subtract_background,Nshots)
+        else:
+            self.absorption = None
+        return True
+
+    @QMethod
+    def absorptionROI(self,roi = None):
+        """set or get the region of interest (x, y, width, height) of the absorption imaging, set it to 'full' for the whole image"""
+        if self.absorption is None:
+            return False
+        if roi is None:
+            return self.absorption.roi
+        self.absorption.roi = None if roi == 'full' else tuple(roi)
+        return True
+
+    @QMethod
+    def resetAbsorption(self):
+        """Start a new shot with the next frame, e.g. if the camera has been triggered out of step with the experiment"""
+        if self.absorption is None:
+            return False
+        self.absorption.reset()
+        return True
+
+    @QMethod
+    def getAbsorptionResults(self,shot=0,timeout=0):
+        """Results of the shots still in the buffer from the shot id shot and newer, without the images.
+        Every result is a dictionary with the entries shot, timestamp, frame_ids, roi, atomnumber, centroid (x, y) and widths (x, y) in pixels and peak_od.
+        Use the last shot id received plus one to get the shots not seen yet; with a timeout in seconds it waits for that shot if it is not there yet"""
+        if self.absorption is None:
+            return []
+        return self.absorption.results(self.absorption.shots.since(shot,timeout))
+
+    @QMethod
+    def getODImage(self,shot=None):
+        """The optical depth image of a shot in the region of interest, as a compact float32 frame (see :py:func:`CameraTools.pack_frame`)
+        with the shot id as frame_id and the results of the shot as extra entries. The newest shot if shot is None.
+        None if the shot is not in the buffer anymore"""
+        if self.absorption is None:
+            return None
+        if shot is None:
+            latest = self.absorption.shots.latest()
+            shots = [] if latest is None else [latest]
+        else:
+            shots = [ashot for ashot in self.absorption.shots.since(shot) if ashot[0] == shot]
+        if len(shots) == 0:
+            return None
+        shotid,result = shots[0]
+        metadata = self.absorption.results(shots)[0]
+        timestamp = metadata.pop('timestamp')
+        return ct.pack_frame(result['od'],shotid,timestamp,**metadata)
+
     def onClosing(self):
+        self.stopGrabbing()
         self.cam.DeInit()
         del self.cam
         self.system.ReleaseInstance()
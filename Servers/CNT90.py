@@ -8,7 +8,7 @@ import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
 
-import visa
+import VisaBackend as vb
 import os
 class logging_thread(threading.Thread):
     
@@ -41,8 +41,7 @@ class Server(QWeatherServer):
         #print('Measurement done at: ' + str(datetime.datetime.now().astimezone()) + '\n')
 
     def initialize_hardware(self):
-        rm = visa.ResourceManager()
-        self.hardware = rm.open_resource(self.USBport)
+        self.hardware = vb.open_resource(self.USBport,'CNT90')
         print('Frequency counter server running. Made contact with:')
         print(self.hardware.query('*IDN?'))
         print('*'*50)
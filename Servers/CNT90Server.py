@@ -3,7 +3,7 @@ import numpy as np
 import struct
 from qweather import QWeatherServer, QMethod
 
-import visa
+import VisaBackend as vb
 
 class Server(QWeatherServer):
 
@@ -19,8 +19,7 @@ class Server(QWeatherServer):
         self.initialize_hardware()
 
     def initialize_hardware(self):
-        rm = visa.ResourceManager()
-        self.hardware = rm.open_resource(self.USBport)
+        self.hardware = vb.open_resource(self.USBport,'CNT90')
         print('Frequency couner server running. Made contact with:')
         print(self.hardware.query('*IDN?'))
         print('*'*50)
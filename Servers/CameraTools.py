@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Helpers for the Qweather camera servers'''
+import numpy as np
+import time
+import zlib
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+#Layouts of two 12 bit pixels in three bytes. Mono12Packed is the GigE Vision layout, Mono12p the GenICam PFNC layout
+PACKED12 = ['Mono12Packed','Mono12p']
+
+
+def compressions():
+    """Names of the compressions available here, lz4 is only available if the lz4 package is installed"""
+    return ['zlib'] + (['lz4'] if lz4 is not None else [])
+
+
+def compress(buffer,compression):
+    """Compress a buffer losslessly with zlib (level 1, fast) or lz4, or return it unchanged if compression is None"""
+    if compression is None:
+        return buffer
+    elif compression == 'zlib':
+        return zlib.compress(buffer,1)
+    elif compression == 'lz4':
+        if lz4 is None:
+            raise ImportError('lz4 compression needs the lz4 package')
+        return lz4.frame.compress(buffer)
+    raise ValueError('Unknown compression: {:s}'.format(compression))
+
+
+def decompress(buffer,compression):
+    """Decompress a buffer compressed by :py:func:`compress`, or return it unchanged if compression is None"""
+    if compression is None:
+        return buffer
+    elif compression == 'zlib':
+        return zlib.decompress(buffer)
+    elif compression == 'lz4':
+        if lz4 is None:
+            raise ImportError('lz4 compression needs the lz4 package')
+        return lz4.frame.decompress(buffer)
+    raise ValueError('Unknown compression: {:s}'.format(compression))
+
+
+def pack12(data,packing='Mono12Packed'):
+    """Pack 12 bit pixels two by two in three bytes, the inverse of :py:func:`unpack12`
+
+    :param data: image with values below 4096
+    :type data: numpy.ndarray
+    :param packing: 'Mono12Packed' or 'Mono12p', see PACKED12
+    :type packing: str
+    :return: the packed bytes, 1.5 bytes per pixel
+    :rtype: numpy.ndarray"""
+    pixels = np.asarray(data,dtype=np.uint16).ravel()
+    if len(pixels)%2:
+        pixels = np.append(pixels,0)
+    p0 = pixels[0::2]
+    p1 = pixels[1::2]
+    packed = np.empty((len(p0),3),dtype=np.uint8)
+    if packing == 'Mono12Packed':
+        packed[:,0] = p0 >> 4
+        packed[:,1] = (p0 & 0x0F) | ((p1 & 0x0F) << 4)
+        packed[:,2] = p1 >> 4
+    elif packing == 'Mono12p':
+        packed[:,0] = p0 & 0xFF
+        packed[:,1] = (p0 >> 8) | ((p1 & 0x0F) << 4)
+        packed[:,2] = p1 >> 4
+    else:
+        raise ValueError('Unknown packing: {:s}'.format(packing))
+    return packed.ravel()
+
+
+def unpack12(buffer,shape,packing='Mono12Packed'):
+    """Unpack 12 bit pixels packed two by two in three bytes to uint16, vectorized over the whole image
+
+    :param buffer: the packed bytes
+    :param shape: shape of the image
+    :type shape: tuple
+    :param packing: 'Mono12Packed' or 'Mono12p', see PACKED12
+    :type packing: str
+    :return: image with values from 0 to 4095
+    :rtype: numpy.ndarray"""
+    npixels = int(np.prod(shape))
+    raw = np.frombuffer(buffer,dtype=np.uint8,count=3*((npixels + 1)//2)).reshape(-1,3).astype(np.uint16)
+    data = np.empty((len(raw),2),dtype=np.uint16)
+    if packing == 'Mono12Packed':
+        np.bitwise_or(raw[:,0] << 4,raw[:,1] & 0x0F,out=data[:,0])
+        np.bitwise_or(raw[:,2] << 4,raw[:,1] >> 4,out=data[:,1])
+    elif packing == 'Mono12p':
+        np.bitwise_or(raw[:,0],(raw[:,1] & 0x0F) << 8,out=data[:,0])
+        np.bitwise_or(raw[:,2] << 4,raw[:,1] >> 4,out=data[:,1])
+    else:
+        raise ValueError('Unknown packing: {:s}'.format(packing))
+    return data.ravel()[:npixels].reshape(shape)
+
+
+def _frame(buffer,shape,dtype,frame_id,timestamp,compression,metadata):
+    frame = {'buffer':compress(buffer,compression),
+             'shape':tuple(shape),
+             'dtype':dtype,
+             'frame_id':int(frame_id),
+             'timestamp':time.time() if timestamp is None else float(timestamp)}
+    if compression is not None:
+        frame['compression'] = compression
+    frame.update(metadata)
+    return frame
+
+
+def pack_frame(data,frame_id,timestamp=None,compression=None,**metadata):
+    """Pack an image in the compact frame format sent to clients.
+    The pixels are sent as one raw buffer in the dtype of the camera (no conversion to float),
+    with the shape and dtype needed to rebuild the image on the client with np.frombuffer without copying.
+
+    :param data: image with shape (rows, columns)
+    :type data: numpy.ndarray
+    :param frame_id: id of the frame, e.g. the frame counter of the camera
+    :type frame_id: int
+    :param timestamp: time the frame was received (time.time()), defaults to now
+    :type timestamp: float
+    :param compression: lossless compression of the buffer, None, 'zlib' or 'lz4', see :py:func:`compress`
+    :type compression: str
+    :param metadata: any extra entries to put in the frame, e.g. the camera timestamp
+    :return: dictionary with the keys buffer, shape, dtype, frame_id and timestamp, and compression if the buffer is compressed
+    :rtype: dict"""
+    data = np.ascontiguousarray(data)
+    return _frame(data.tobytes(),data.shape,data.dtype.str,frame_id,timestamp,compression,metadata)
+
+
+def pack_frame12(raw,shape,frame_id,packing='Mono12Packed',timestamp=None,compression=None,**metadata):
+    """Pack an image of 12 bit pixels packed in three bytes per two pixels, as it comes from the camera.
+    The frame has the extra entry packing, and dtype is the dtype of the unpacked image, uint16
+
+    :param raw: the packed bytes, see :py:func:`pack12`
+    :param shape: shape (rows, columns) of the image
+    :type shape: tuple
+    :param packing: 'Mono12Packed' or 'Mono12p', see PACKED12
+    :type packing: str
+    :return: compact frame, see :py:func:`pack_frame`
+    :rtype: dict"""
+    raw = np.ascontiguousarray(raw,dtype=np.uint8)
+    metadata['packing'] = packing
+    return _frame(raw.tobytes(),shape,np.dtype(np.uint16).str,frame_id,timestamp,compression,metadata)
+
+
+def frame_array(frame):
+    """The image of a compact frame as an array of shape (rows, columns).
+    Decompresses and unpacks the buffer if needed, otherwise it is a read only view of the buffer"""
+    buffer = decompress(frame['buffer'],frame.get('compression'))
+    if frame.get('packing') is not None:
+        return unpack12(buffer,frame['shape'],frame['packing'])
+    return np.frombuffer(buffer,dtype=frame['dtype']).reshape(frame['shape'])
+
+
+def spinnaker_frame(image_result,compression=None,**metadata):
+    """Pack a PySpin image result, copying the pixels out of the camera buffer once, so the image can be released right after.
+    Images in a packed 12 bit pixel format are sent packed, 1.5 bytes per pixel
+
+    :param image_result: complete image from GetNextImage
+    :param compression: lossless compression of the buffer, see :py:func:`compress`
+    :type compression: str
+    :return: compact frame, see :py:func:`pack_frame`
+    :rtype: dict"""
+    pixelformat = image_result.GetPixelFormatName()
+    if pixelformat in PACKED12:
+        shape = (image_result.GetHeight(),image_result.GetWidth())
+        return pack_frame12(image_result.GetData(),shape,image_result.GetFrameID(),pixelformat,compression=compression,
+                            camera_timestamp=image_result.GetTimeStamp(),**metadata)
+    data = image_result.GetNDArray()
+    return pack_frame(data,image_result.GetFrameID(),compression=compression,camera_timestamp=image_result.GetTimeStamp(),**metadata)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 '''Server (Qweather) to control the Rigol DG1062 DDS'''
 from qweather import QWeatherServer, QMethod
-import visa
+import VisaBackend as vb
 import numpy as np
 import time
 import smtplib,ssl
@@ -33,8 +33,7 @@ class Server(QWeatherServer):
         self.initialize_hardware()
 
     def initialize_hardware(self):
-        rm = visa.ResourceManager()
-        self.hardware = rm.open_resource(self.address)
+        self.hardware = vb.open_resource(self.address,'DG1062')
         print('Rigol DDS server running Made contact with:')
         print(self.hardware.query('*IDN?'))
         print(self.servername)
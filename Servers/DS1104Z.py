@@ -2,11 +2,14 @@
 # -*- coding: utf-8 -*-
 '''Server (Qweather) to grab data from the Rigol DS1104Z oscilloscope'''
 from qweather import QWeatherServer, QMethod
-import visa
+import VisaBackend as vb
 import numpy as np
 import time
 import struct
 import sys
+import threading
+import OscilloscopeTools as ot
+import AcquisitionBuffer as ab
 __author__ = 'Asbjorn Arvad Jorgensen'
 __version__ = '0.9'
 __email__ = 'Asbjorn.Arvad@nbi.ku.dk'
@@ -26,58 +29,79 @@ class Server(QWeatherServer):
         
 
     def initialize_hardware(self):
-        """Open the connection to the hardware using visa"""
-        rm = visa.ResourceManager()
-        self.hardware = rm.open_resource(self.address)
+        """Open the connection to the hardware using visa. Waveforms are transferred as binary BYTE codes"""
+        self.hardware = vb.open_resource(self.address,'DS1104Z')
+        self.hardwarelock = threading.RLock()
         print('Oscilloscope server running Made contact with:')
         print(self.hardware.query('*IDN?'))
         print('*'*50)
-        self.hardware.write('WAV:MODE MAX')
-        self.hardware.write('WAV:FORM ASC')
+        self.hardware.write(':WAV:MODE MAX')
+        self.set_waveform_format('BYTE')
         self.hardware.timeout=2000
+        self.acquisition = None
 
+    @QMethod
+    def set_waveform_format(self,wavformat):
+        """
+        **QMethod**
+        Set the binary format used to transfer waveforms
 
+        Args:
+            wavformat(str): BYTE (8 bit codes) or WORD (16 bit codes, twice the transfer but the same resolution on this oscilloscope)
+        """
+        with self.hardwarelock:
+            if wavformat not in ot.RIGOL_CHUNK:
+                print('Waveform format must be one of {:}'.format(', '.join(ot.RIGOL_CHUNK)))
+                return False
+            self.hardware.write(':WAV:FORM {:s}'.format(wavformat))
+            self.wavformat = wavformat
+            return True
 
     def get_channel_data(self,channels):
         """Get data from channels
 
         :param channels: List of channels, or single channel to get data from
         :type channels: list, int
-        :return: List of data in the form [tlist, datalist ,header]
+        :return: List of data in the form [tlist, datalist ,preamble]
         :rtype: list"""
-        if not isinstance(channels,list):
-            self.hardware.write('CHAN{:d}:DATA:POIN MAX'.format(channels))
-            head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels)).split(',')
-            data = self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels),datatype='f',is_big_endian=True)
-        else:
-            head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels[0])).split(',')
-            data = []
-            for i in range(len(channels)):
-                data.append(self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels[i]),datatype='f',is_big_endian=True))
-        head = [float(ah.strip()) for ah in head]
-        tlist = np.linspace(head[0],head[1],head[2]*head[3])
+        with self.hardwarelock:
+            if not isinstance(channels,list):
+                preamble = ot.query_preamble(self.hardware,'CHAN{:d}'.format(channels))
+                data = ot.read_rigol_waveform(self.hardware,preamble)
+            else:
+                sources,data,preambles = self.get_multichannel_data(channels)
+                data = list(data)
+                preamble = preambles[0]
+            t0,dt,n = ot.rigol_time_axis(preamble)
+            tlist = t0 + dt*np.arange(n)
 
-        return [tlist,data,head]
+            return [tlist,data,preamble]
 
-    def get_ref_channel_data(self,channels):
-        """Get data from reference channels
+    def get_multichannel_data(self,channels,refchannels=None):
+        """Get data from several channels of the same acquisition.
+        The preamble of each channel is read once, and the raw codes are converted to volts with numpy.
+        The oscilloscope can not transfer reference waveforms.
 
         :param channels: List of channels, or single channel to get data from
         :type channels: list, int
-        :return: List of data in the form [tlist, datalist ,header]
-        :rtype: list"""
-        if not isinstance(channels,list):
-            head = self.hardware.query('REFC{:d}:DATA:HEAD?'.format(channels)).split(',')
-            data = self.hardware.query_binary_values('REFC{:d}:DATA?'.format(channels),datatype='f',is_big_endian=True)
-        else:
-            head = self.hardware.query('REFC{:d}:DATA:HEAD?'.format(channels[0])).split(',')
-            data = []
-            for i in range(len(channels)):
-                data.append(self.hardware.query_binary_values('REFC{:d}:DATA?'.format(channels[i]),datatype='f',is_big_endian=True))
-        head = [float(ah.strip()) for ah in head]
-        tlist = np.linspace(head[0],head[1],head[2]*head[3])
-
-        return [tlist,data,head]
+        :param refchannels: Not supported on this oscilloscope, must be empty
+        :type refchannels: list, int
+        :return: List of data in the form [sources, data, preambles], where data is a 2-D float32 array with one row per source
+        :rtype: list
+        :raises ValueError: if reference channels are asked for"""
+        if len(ot.as_list(refchannels)) > 0:
+            raise ValueError('Reference channels can not be transferred from the DS1104Z')
+        with self.hardwarelock:
+            sources = ['CHAN{:d}'.format(achan) for achan in ot.as_list(channels)]
+            preambles = []
+            rows = []
+            for asource in sources:
+                preambles.append(ot.query_preamble(self.hardware,asource))
+                rows.append(ot.read_rigol_waveform(self.hardware,preambles[-1]))
+            data = np.full((len(rows),max([len(arow) for arow in rows] + [0])),np.nan,dtype=np.float32)
+            for i,arow in enumerate(rows):
+                data[i,:len(arow)] = arow
+            return [sources,data,preambles]
 
     def get_time_data(self,channels):
         """Get the timearray corresponding to the current measurement
@@ -85,19 +109,13 @@ class Server(QWeatherServer):
         :param channels: List of channels, or single channel to get data from
         :type channels: list, int
         :return: timearray
-        :rtype: list"""
-        if not isinstance(channels,list):
-            self.hardware.write('CHAN{:d}:DATA:POIN MAX'.format(channels))
-            head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels)).split(',')
-        else:
-            head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels[0])).split(',')
-        head = [float(ah.strip()) for ah in head]
-        tlist = np.linspace(head[0],head[1],head[2]*head[3])
-
-        return tlist
+        :rtype: numpy.ndarray"""
+        with self.hardwarelock:
+            t0,dt,n = ot.rigol_time_axis(ot.query_preamble(self.hardware,'CHAN{:d}'.format(ot.as_list(channels)[0])))
+            return t0 + dt*np.arange(n)
 
     @QMethod
-    def single_measurement(self,channels,rerun=False,ref=False):
+    def single_measurement(self,channels,rerun=False,ref=False,compact=False):
         """
         **QMethod**
 
@@ -107,24 +125,53 @@ class Server(QWeatherServer):
             channels(list,int): List of channels to measure
             rerun (bool): Default False, If True, set Oscilloscope running after data taken
             ref (bool): Default False, if True, get reference channel data
+            compact (bool): Default False, if True, return a compact trace (see :py:func:`OscilloscopeTools.pack_trace`) instead of [timelist,data]
         Returns:
             A list of data in the form [timelist,data]. If data from multiple channels, then data is a list of lists
 
         """
-        if ref:
-            tlist,data,head = self.get_ref_channel_data(channels)
-        else:
-            tlist,data,head = self.get_channel_data(channels)
-        Nsamples = head[2]
-        samplerate = (head[1] - head[0])/Nsamples
-        if rerun:
-            self.hardware.write('RUN')
-            if self.verbose:
-                print('Returning Data')
-        return [tlist,data]
+        with self.hardwarelock:
+            if ref:
+                print('Reference channels can not be transferred from the DS1104Z')
+                return False
+            if compact:
+                sources,data,heads = self.get_multichannel_data(channels)
+                if rerun:
+                    self.hardware.write('RUN')
+                return ot.pack_rigol_trace(data,sources,heads)
+            tlist,data,preamble = self.get_channel_data(channels)
+            if rerun:
+                self.hardware.write('RUN')
+                if self.verbose:
+                    print('Returning Data')
+            return [tlist,data]
 
     @QMethod
-    def get_timedata(self,channels,rerun=False):
+    def multi_measurement(self,channels,refchannels=None,rerun=False):
+        """
+        **QMethod**
+
+        Does a single measurement of several channels and reference channels from the same trigger in one call.
+        Calls :py:meth:`get_multichannel_data`.
+
+        Args:
+            channels(list,int): List of channels to measure
+            refchannels(list,int,optional): Not supported on this oscilloscope, a ValueError is raised if any are given, defaults to None
+            rerun (bool,optional): Set Oscilloscope running after data taken, Defaults to False
+        Returns:
+            A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with one row per channel
+
+        """
+        with self.hardwarelock:
+            sources,data,heads = self.get_multichannel_data(channels,refchannels)
+            if rerun:
+                self.hardware.write('RUN')
+                if self.verbose:
+                    print('Returning Data')
+            return ot.pack_rigol_trace(data,sources,heads)
+
+    @QMethod
+    def get_timedata(self,channels,rerun=False,compact=False):
         """
         **QMethod**
         Gets the timearray corresponding to the current data. Calls :py:meth:`get_time_data`.
@@ -132,16 +179,22 @@ class Server(QWeatherServer):
         Args:
             channels(list,int): List of channels to measure
             rerun (bool,optional): Set Oscilloscope running after data taken, Defaults to False
+            compact (bool,optional): Return the description (t0,dt,n) of the time axis instead of the timearray, Defaults to False
         Returns:
             A timearray
 
         """
-        tlist = self.get_time_data(channels)
-        if rerun:
-            self.hardware.write('RUN')
-            if self.verbose:
-                print('Returning time')
-        return tlist   
+        with self.hardwarelock:
+            if compact:
+                channel = ot.as_list(channels)[0]
+                tlist = ot.rigol_time_axis(ot.query_preamble(self.hardware,'CHAN{:d}'.format(channel)))
+            else:
+                tlist = self.get_time_data(channels)
+            if rerun:
+                self.hardware.write('RUN')
+                if self.verbose:
+                    print('Returning time')
+            return tlist   
 
     @QMethod
     def get_data(self,channels,rerun=False):
@@ -156,16 +209,189 @@ class Server(QWeatherServer):
             A list of data in the form [timelist,data]. If data from multiple channels, then data is a list of lists
 
         """
-        trash,data,trash2 = self.get_channel_data(channels)
-        if rerun:
+        with self.hardwarelock:
+            trash,data,trash2 = self.get_channel_data(channels)
+            if rerun:
+                self.hardware.write('RUN')
+                if self.verbose:
+                    print('Returning time')
+            return data   
+
+
+    def _burst_acquire(self,channels,Nsegments,timeout=10):
+        """Record Nsegments frames with the waveform recorder, play them back one at a time to read them, and RUN the oscilloscope.
+        Afterwards, also if anything fails, the recorder is turned off and the oscilloscope RUN. On errors the instrument is cleared with :py:func:`OscilloscopeTools.clear_device`
+
+        :return: List of data in the form [sources, data, preambles, timestamps], where data has the shape (Nsegments, channels, samples)
+        :rtype: list
+        :raises TimeoutError: if the recorder has not recorded all frames within timeout"""
+        with self.hardwarelock:
+            try:
+                self.hardware.write(':FUNC:WREC:ENAB ON')
+                self.hardware.write(':FUNC:WREC:FEND {:d}'.format(Nsegments))
+                self.hardware.write(':FUNC:WREC:OPER RUN')
+                deadline = time.time() + timeout
+                while self.hardware.query(':FUNC:WREC:OPER?').strip() != 'STOP':
+                    if time.time() > deadline:
+                        self.hardware.write(':FUNC:WREC:OPER STOP')
+                        raise TimeoutError('The recorder did not record {:d} frames within {:g} s'.format(Nsegments,timeout))
+                    time.sleep(0.05)
+                interval = float(self.hardware.query(':FUNC:WREC:FINT?'))
+                frames = []
+                for aframe in range(1,Nsegments+1):
+                    self.hardware.write(':FUNC:WREP:FCUR {:d}'.format(aframe))
+                    sources,adata,preambles = self.get_multichannel_data(channels)
+                    frames.append(adata)
+                timestamps = interval*np.arange(1-Nsegments,1)
+                return [sources,np.stack(frames),preambles,timestamps]
+            except Exception:
+                ot.clear_device(self.hardware)
+                raise
+            finally:
+                self.hardware.write(':FUNC:WREC:ENAB OFF')
+                self.hardware.write('RUN')
+
+    @QMethod
+    def burst_measurement(self,channels,Nsegments,timeout=10):
+        """
+        **QMethod**
+        Record a burst of triggers with the waveform recorder of the oscilloscope and read all frames back afterwards.
+        The oscilloscope is not stopped and restarted for every trace, so the frames are recorded at the recording interval.
+
+        Args:
+            channels(list,int): List of channels to measure
+            Nsegments (int): Number of triggers to record
+            timeout (float,optional): Time in seconds to wait for all the triggers, defaults to 10. A TimeoutError is raised if not all frames are recorded in time
+        Returns:
+            A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (Nsegments,channels,samples) and the entry timestamps, the nominal time of each frame relative to the newest one
+
+        """
+        sources,data,heads,timestamps = self._burst_acquire(channels,Nsegments,timeout)
+        return ot.pack_rigol_trace(data,sources,heads,timestamps=timestamps.tolist())
+
+    @QMethod
+    def reduced_measurement(self,channels,reductions,Navg=1,timeout=10):
+        """
+        **QMethod**
+        Measure the channels and reduce the traces on the server with numpy, so only the small results are sent.
+        See :py:func:`OscilloscopeTools.reduce_traces` for the available reductions.
+
+        Args:
+            channels(list,int): List of channels to measure
+            reductions (list): List of reductions, e.g. ['mean','rms',['welch',{'nperseg':4096}],['minmax',{'npoints':1000}]]
+            Navg (int,optional): Number of triggers to average the reductions over. If larger than 1 the triggers are recorded with the waveform recorder, defaults to 1
+            timeout (float,optional): Time in seconds to wait for the Navg triggers, defaults to 10
+        Returns:
+            A dictionary with the results keyed by reduction name (or label), and the entry sources with the names of the channels
+
+        """
+        if Navg > 1:
+            sources,data,heads,timestamps = self._burst_acquire(channels,Navg,timeout)
+        else:
+            sources,data,heads = self.get_multichannel_data(channels)
+            data = data[np.newaxis]
+        t0,dt,n = ot.rigol_time_axis(heads[0])
+        result = ot.reduce_traces(data,t0,dt,reductions)
+        result['sources'] = sources
+        return result
+
+    def _fetch_record(self,channels):
+        """Arm a single acquisition, wait for it and read it. Called repeatedly by the continuous acquisition thread.
+        The trigger status still reads STOP from the last acquisition right after :SING, so it is first polled until the oscilloscope is armed,
+        then until it has stopped again. The lock is only held for each poll, so other calls can use the oscilloscope while it waits for a trigger
+
+        :return: record, see :py:func:`OscilloscopeTools.make_record`, or None if there was no trigger within the timeout
+        :rtype: dict"""
+        deadline = time.time() + self.hardware.timeout/1000
+        with self.hardwarelock:
+            self.hardware.write(':SING')
+        for stopped in (False,True):
+            while True:
+                with self.hardwarelock:
+                    if (self.hardware.query(':TRIG:STAT?').strip() == 'STOP') == stopped:
+                        break
+                if time.time() > deadline:
+                    return None
+                time.sleep(0.01)
+        sources,data,heads = self.get_multichannel_data(channels)
+        return ot.make_record(sources,data,heads)
+
+    @QMethod
+    def start_continuous(self,channels,Nbuffer=100):
+        """
+        **QMethod**
+        Start continuous acquisition. A background thread keeps arming the oscilloscope and reading the triggered records into a ring buffer,
+        so the next trigger is armed while the last record is on its way to the client. Get the records with :py:meth:`get_latest`, :py:meth:`get_next` and :py:meth:`get_since`.
+
+        Args:
+            channels(list,int): List of channels to measure
+            Nbuffer (int,optional): Number of records to keep in the buffer, defaults to 100
+        """
+        self.stop_continuous()
+        self.acquisition = ab.AcquisitionThread(lambda: self._fetch_record(channels),Nbuffer)
+        self.acquisition.start()
+
+    @QMethod
+    def stop_continuous(self):
+        """
+        **QMethod**
+        Stop continuous acquisition and RUN the oscilloscope
+        """
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            self.acquisition = None
             self.hardware.write('RUN')
-            if self.verbose:
-                print('Returning time')
-        return data   
 
+    @QMethod
+    def get_latest(self):
+        """
+        **QMethod**
+        Get the newest record of the continuous acquisition without waiting for the oscilloscope
+
+        Returns:
+            A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (1,channels,samples) and the entries timestamps and records (the record ids), or None if there is no record
+        """
+        if self.acquisition is None:
+            return None
+        latest = self.acquisition.buffer.latest()
+        if latest is None:
+            return None
+        return ot.pack_records([latest],ot.pack_rigol_trace)
+
+    @QMethod
+    def get_next(self,N=1,timeout=10):
+        """
+        **QMethod**
+        Wait for the next N records of the continuous acquisition
+
+        Args:
+            N (int,optional): Number of records, defaults to 1
+            timeout (float,optional): Time in seconds to wait, the records received until then are returned, defaults to 10
+        Returns:
+            A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (records,channels,samples) and the entries timestamps and records (the record ids), or None if there are no records
+        """
+        if self.acquisition is None:
+            return None
+        return ot.pack_records(self.acquisition.buffer.next(N,timeout),ot.pack_rigol_trace)
+
+    @QMethod
+    def get_since(self,recordid):
+        """
+        **QMethod**
+        Get all records of the continuous acquisition still in the buffer, from recordid and newer.
+        Use the last record id received plus one to get the records not seen yet
+
+        Args:
+            recordid (int): id of the first record to get
+        Returns:
+            A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (records,channels,samples) and the entries timestamps and records (the record ids), or None if there are no records
+        """
+        if self.acquisition is None:
+            return None
+        return ot.pack_records(self.acquisition.buffer.since(recordid),ot.pack_rigol_trace)
 
     @QMethod 
-    def repeat_measurements(self,channels,Nmeas):
+    def repeat_measurements(self,channels,Nmeas,compact=False,burst=False):
         """
         **QMethod**
         Initialize the measurement and RUN oscilloscope when done. Repeat N times. Each iteration is a new trigger on the oscilloscope.
@@ -173,20 +399,34 @@ class Server(QWeatherServer):
         Args:
             channels(list,int): List of channels to measure
             Nmeans (int): Number of times to repeat taking data
+            compact (bool,optional): Return one compact trace with data of shape (Nmeas,channels,samples), Defaults to False
+            burst (bool,optional): Record the Nmeas triggers with the waveform recorder and read them afterwards, see :py:meth:`burst_measurement`. Always returns a compact trace, Defaults to False
         Returns:
             A list of lists of lists containing [timearray,data,[number of samples,samplerate]]xNmeans
 
         """
-        data = []
-        #self.hardware.write('STOP')
-        for i in range(Nmeas):
-            self.hardware.write('STOP')
-            data.append([])
-            data[-1] = self.get_channel_data(channels)
-            self.hardware.write('RUN')
-            time.sleep(0.1)
-        #self.hardware.write('RUN')
-        return data
+        with self.hardwarelock:
+            if burst:
+                return self.burst_measurement(channels,Nmeas)
+            if compact:
+                data = []
+                for i in range(Nmeas):
+                    self.hardware.write('STOP')
+                    sources,adata,heads = self.get_multichannel_data(channels)
+                    data.append(adata)
+                    self.hardware.write('RUN')
+                    time.sleep(0.1)
+                return ot.pack_rigol_trace(np.stack(data),sources,heads)
+            data = []
+            #self.hardware.write('STOP')
+            for i in range(Nmeas):
+                self.hardware.write('STOP')
+                data.append([])
+                data[-1] = self.get_channel_data(channels)
+                self.hardware.write('RUN')
+                time.sleep(0.1)
+            #self.hardware.write('RUN')
+            return data
 
 
 
@@ -194,24 +434,12 @@ class Server(QWeatherServer):
     def get_history_data(self,channels):
         #self.hardware.write('RUN')
         #time.sleep(2)
-        self.hardware.write('STOP')
-        if not isinstance(channels,list):
-            head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels)).split(',')
-            self.hardware.write('CHAN{:d}:DATA:POIN MAX'.format(channels))
-            data = self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels),datatype='f',is_big_endian=True)
-        else:
-            head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels[0])).split(',')
-            data = []
-            for i in range(len(channels)):
-                self.hardware.write('CHAN{:d}:DATA:POIN MAX'.format(channels[i]))
-                print('getting data from channel ',i)
-                data.append(self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels[i]),datatype='f',is_big_endian=True))
-        head = [float(ah.strip()) for ah in head]
-        tlist = np.linspace(head[0],head[1],head[2]*head[3])
-#        with open('Z:/Acetylene/AllanDevs/181026/1225/OscilloscopeTrace.txt'):
-        data = [tlist,data]
+        with self.hardwarelock:
+            self.hardware.write('STOP')
+            tlist,data,preamble = self.get_channel_data(channels)
+            data = [tlist,data]
 
-        return data
+            return data
 
     @QMethod
     def measure_peakpeak(self,channel,place,stat=False,stattime = 3):
@@ -303,50 +531,30 @@ class Server(QWeatherServer):
         Measure some value of the signal
 
         Args:
-            channel(int): Channel to measure
+            channel(int,list): Channel, or list of channels to measure
             place (int): measurement place on the oscilloscope
             measurement(str): PEAK-peak peak; MEAN-mean; STDD-std; LPE-min; UPE-max
             stat (bool): Do statistics
             stattime (int): How long to do statistics over
 
         Returns:
-            measurement value Float
+            measurement value Float, or a record with the fields avg, std, min, max and count if stat.
+            For a list of channels, measured at the places with the same numbers as the channels, an array with one value per channel
+            or a record array with one record per channel if stat
         """
-        if not isinstance(channel,list):
-            self.hardware.write('MEAS{:d}:SOUR CH{:d}'.format(place,channel))
+        channels = ot.as_list(channel)
+        places = channels if isinstance(channel,list) else [place]
+        with self.hardwarelock:
+            ot.setup_measurements(self.hardware,channels,places,stat)
+        if stat or isinstance(channel,list):
+            time.sleep(stattime)
+        with self.hardwarelock:
             if stat:
-                self.hardware.write('MEAS{:d}:STAT ON'.format(place))
-                self.hardware.write('MEAS{:d}:STAT:RES'.format(place))
-                time.sleep(stattime)
-                avgval = float(self.hardware.query('MEAS{:d}:RES:AVG?').format(place))
-                std = float(self.hardware.query('MEAS{:d}:RES:STDD?').format(place))
-                minval = float(self.hardware.query('MEAS{:d}:RES:NPE?').format(place))
-                maxval = float(self.hardware.query('MEAS{:d}:RES:PPE?').format(place))
-                trigevents = int(self.hardware.query('MEAS{:d}:RES:WFMC?').format(place))
-
-                data = [avgval,std,minval,maxval,trigevents]
-
+                data = ot.query_statistics(self.hardware,places)
             else:
-                data = float(self.hardware.query('MEAS{:d}:RES? {:s}'.format(place,measurement)))
-        else:
-            for achan in channel:
-                self.hardware.write('MEAS{:d}:SOUR CH{:d}'.format(achan,achan))
-                if stat:
-                    self.hardware.write('MEAS{:d}:STAT ON'.format(achan))
-                    self.hardware.write('MEAS{:d}:STAT:RES'.format(achan))
-            time.sleep(stattime)
-            data = []
-            for achan in channel:
-                if stat:
-                    avgval = float(self.hardware.query('MEAS{:d}:RES:AVG?'.format(achan)))
-                    std = float(self.hardware.query('MEAS{:d}:RES:STDD?'.format(achan)))
-                    minval = float(self.hardware.query('MEAS{:d}:RES:NPE?'.format(achan)))
-                    maxval = float(self.hardware.query('MEAS{:d}:RES:PPE?'.format(achan)))
-                    trigevents = int(self.hardware.query('MEAS{:d}:RES:WFMC?'.format(achan)))
-
-                    data.append([avgval,std,minval,maxval,trigevents])
-                else:
-                    data.append(float(self.hardware.query('MEAS{:d}:RES? {:s}'.format(achan,measurement))))
+                data = ot.query_results(self.hardware,places,measurement)
+        if not isinstance(channel,list):
+            data = data[0]
         return data
 
 
@@ -2,11 +2,14 @@
 # -*- coding: utf-8 -*-
 '''Server (Qweather) to grab data from the Rode&Schwartz HM03004 oscilloscope'''
 from qweather import QWeatherServer, QMethod
-import visa
+import VisaBackend as vb
 import numpy as np
 import time
 import struct
 import sys
+import threading
+import OscilloscopeTools as ot
+import AcquisitionBuffer as ab
 __author__ = 'Asbjorn Arvad Jorgensen'
 __version__ = '1.1'
 __email__ = 'Asbjorn.Arvad@nbi.ku.dk'
@@ -25,63 +28,269 @@ class Server(QWeatherServer):
         self.initialize_hardware()
 
     def initialize_hardware(self):
-        rm = visa.ResourceManager()
-        self.hardware = rm.open_resource(self.address)
+        self.hardware = vb.open_resource(self.address,'HMO3004')
         print('Oscilloscope server running Made contact with:')
         print(self.hardware.query('*IDN?'))
         print('*'*50)
         self.hardware.write('FORM REAL; FORM MSBF')
         self.hardware.timeout=2000
+        self.hardwarelock = threading.RLock()
+        self.acquisition = None
 
 
 
     def get_channel_data(self,channels,maxpoints):
-        if not isinstance(channels,list):
-            head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels)).split(',')
-            if maxpoints:
-                self.hardware.write('CHAN{:d}:DATA:POIN MAX'.format(channels))
-            else:
-                self.hardware.write('CHAN{:d}:DATA:POIN DEF'.format(channels))
-            data = self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels),datatype='f',is_big_endian=False)
-        else:
-            head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels[0])).split(',')
-            data = []
-            for i in range(len(channels)):
+        with self.hardwarelock:
+            if not isinstance(channels,list):
+                head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels)).split(',')
                 if maxpoints:
-                    self.hardware.write('CHAN{:d}:DATA:POIN MAX'.format(channels[i]))
+                    self.hardware.write('CHAN{:d}:DATA:POIN MAX'.format(channels))
                 else:
-                    self.hardware.write('CHAN{:d}:DATA:POIN DEF'.format(channels[i]))
-                data.append(self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels[i]),datatype='f',is_big_endian=False))
-        head = [float(ah.strip()) for ah in head]
-        tlist = np.linspace(head[0],head[1],head[2]*head[3])
+                    self.hardware.write('CHAN{:d}:DATA:POIN DEF'.format(channels))
+                data = self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels),datatype='f',is_big_endian=False)
+            else:
+                head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels[0])).split(',')
+                data = []
+                for i in range(len(channels)):
+                    if maxpoints:
+                        self.hardware.write('CHAN{:d}:DATA:POIN MAX'.format(channels[i]))
+                    else:
+                        self.hardware.write('CHAN{:d}:DATA:POIN DEF'.format(channels[i]))
+                    data.append(self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels[i]),datatype='f',is_big_endian=False))
+            head = [float(ah.strip()) for ah in head]
+            tlist = np.linspace(head[0],head[1],head[2]*head[3])
+
+            return [tlist,data,head]
+
+    def get_multichannel_data(self,channels,refchannels=None,maxpoints=False):
+        """Get data from channels and reference channels in one batched transaction.
+        All headers are fetched in one query and all data blocks in one pipelined query.
+
+        :param channels: List of channels, or single channel to get data from
+        :type channels: list, int
+        :param refchannels: List of reference channels, or single reference channel to get data from
+        :type refchannels: list, int
+        :param maxpoints: If True get the maximum number of points, otherwise the default number
+        :type maxpoints: bool
+        :return: List of data in the form [sources, data, headers], where data is a 2-D float32 array with one row per source
+        :rtype: list"""
+        with self.hardwarelock:
+            channels = ot.as_list(channels)
+            sources = ['CHAN{:d}'.format(achan) for achan in channels] + ['REFC{:d}'.format(achan) for achan in ot.as_list(refchannels)]
+            if len(channels) > 0:
+                points = 'MAX' if maxpoints else 'DEF'
+                self.hardware.write(';:'.join('CHAN{:d}:DATA:POIN {:s}'.format(achan,points) for achan in channels))
+            heads = ot.query_headers(self.hardware,sources)
+            data = ot.stack_blocks(ot.query_blocks(self.hardware,sources),'<f4')
+            return [sources,data,heads]
+
+    @QMethod
+    def single_measurement(self,channels,maxpoints = False,quick=False,compact=False):
+        with self.hardwarelock:
+            if not quick:
+                self.hardware.write('SING')
+                time.sleep(1)
+            if compact:
+                sources,data,heads = self.get_multichannel_data(channels,None,maxpoints)
+                if not quick:
+                    self.hardware.write('RUN')
+                return ot.pack_rs_trace(data,sources,heads)
+            tlist,data,head = self.get_channel_data(channels,maxpoints)
+            Nsamples = head[2]
+            samplerate = (head[1] - head[0])/Nsamples
+            if not quick:
+                self.hardware.write('RUN')
+            return [tlist,data,[Nsamples,samplerate]]
+
+
+    @QMethod
+    def multi_measurement(self,channels,refchannels=None,maxpoints=False,quick=False):
+        """
+        **QMethod**
+
+        Does a single measurement of several channels and reference channels from the same trigger in one call.
+        Calls :py:meth:`get_multichannel_data`.
+
+        Args:
+            channels(list,int): List of channels to measure
+            refchannels(list,int,optional): List of reference channels to measure, defaults to None
+            maxpoints (bool,optional): Get the maximum number of points, defaults to False
+            quick (bool,optional): If False, take a single acquisition first and RUN the oscilloscope afterwards, defaults to False
+        Returns:
+            A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with one row per source, channels first, then reference channels
+
+        """
+        with self.hardwarelock:
+            if not quick:
+                self.hardware.write('SING')
+                time.sleep(1)
+            sources,data,heads = self.get_multichannel_data(channels,refchannels,maxpoints)
+            if not quick:
+                self.hardware.write('RUN')
+            return ot.pack_rs_trace(data,sources,heads)
+
+    def _burst_acquire(self,channels,Nsegments,timeout=10):
+        """Record Nsegments triggers in the segmented memory, read them back and RUN the oscilloscope. Calls :py:func:`OscilloscopeTools.burst_acquire`
+
+        :return: List of data in the form [sources, data, headers, timestamps], where data has the shape (Nsegments, channels, samples)
+        :rtype: list"""
+        with self.hardwarelock:
+            return ot.burst_acquire(self.hardware,channels,Nsegments,'ACQ:SEGM:STAT ON;:ACQ:NSIN:COUN {:d};:SING','<f4',timeout)
+
+    @QMethod
+    def burst_measurement(self,channels,Nsegments,timeout=10):
+        """
+        **QMethod**
+        Record a burst of triggers in the segmented (history) memory of the oscilloscope and read all segments back in one bulk transfer.
+        No triggers are missed between the segments, as the oscilloscope is not stopped and restarted for every trace.
+
+        Args:
+            channels(list,int): List of channels to measure
+            Nsegments (int): Number of triggers to record
+            timeout (float,optional): Time in seconds to wait for all the triggers, defaults to 10
+        Returns:
+            A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (Nsegments,channels,samples) and the entry timestamps, the time of each segment relative to the newest one
+
+        """
+        sources,data,heads,timestamps = self._burst_acquire(channels,Nsegments,timeout)
+        return ot.pack_rs_trace(data,sources,heads,timestamps=timestamps.tolist())
+
+    @QMethod
+    def reduced_measurement(self,channels,reductions,Navg=1,timeout=10):
+        """
+        **QMethod**
+        Measure the channels and reduce the traces on the server with numpy, so only the small results are sent.
+        See :py:func:`OscilloscopeTools.reduce_traces` for the available reductions.
+
+        Args:
+            channels(list,int): List of channels to measure
+            reductions (list): List of reductions, e.g. ['mean','rms',['welch',{'nperseg':4096}],['minmax',{'npoints':1000}]]
+            Navg (int,optional): Number of triggers to average the reductions over. If larger than 1 the triggers are recorded in the segmented memory, defaults to 1
+            timeout (float,optional): Time in seconds to wait for the Navg triggers, defaults to 10
+        Returns:
+            A dictionary with the results keyed by reduction name (or label), and the entry sources with the names of the channels
+
+        """
+        if Navg > 1:
+            sources,data,heads,timestamps = self._burst_acquire(channels,Navg,timeout)
+        else:
+            sources,data,heads = self.get_multichannel_data(channels,None,True)
+            data = data[np.newaxis]
+        t0,dt,n = ot.time_axis(heads[0])
+        result = ot.reduce_traces(data,t0,dt,reductions)
+        result['sources'] = sources
+        return result
+
+    def _fetch_record(self,channels,maxpoints=False):
+        """Arm a single acquisition, wait for it and read it. Called repeatedly by the continuous acquisition thread.
+        The lock is only held while arming, polling and reading, see :py:func:`OscilloscopeTools.wait_single`
 
-        return [tlist,data,head]
+        :return: record, see :py:func:`OscilloscopeTools.make_record`, or None if there was no trigger within the timeout
+        :rtype: dict"""
+        if not ot.wait_single(self.hardware,self.hardwarelock,self.hardware.timeout/1000):
+            return None
+        sources,data,heads = self.get_multichannel_data(channels,None,maxpoints)
+        return ot.make_record(sources,data,heads)
 
     @QMethod
-    def single_measurement(self,channels,maxpoints = False,quick=False):
-        if not quick:
-            self.hardware.write('SING')
-            time.sleep(1)
-        tlist,data,head = self.get_channel_data(channels,maxpoints)
-        Nsamples = head[2]
-        samplerate = (head[1] - head[0])/Nsamples
-        if not quick:
+    def start_continuous(self,channels,Nbuffer=100,maxpoints=False):
+        """
+        **QMethod**
+        Start continuous acquisition. A background thread keeps arming the oscilloscope and reading the triggered records into a ring buffer,
+        so the next trigger is armed while the last record is on its way to the client. Get the records with :py:meth:`get_latest`, :py:meth:`get_next` and :py:meth:`get_since`.
+
+        Args:
+            channels(list,int): List of channels to measure
+            Nbuffer (int,optional): Number of records to keep in the buffer, defaults to 100
+            maxpoints (bool,optional): Get the maximum number of points, defaults to False
+        """
+        self.stop_continuous()
+        self.acquisition = ab.AcquisitionThread(lambda: self._fetch_record(channels,maxpoints),Nbuffer)
+        self.acquisition.start()
+
+    @QMethod
+    def stop_continuous(self):
+        """
+        **QMethod**
+        Stop continuous acquisition and RUN the oscilloscope
+        """
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            self.acquisition = None
             self.hardware.write('RUN')
-        return [tlist,data,[Nsamples,samplerate]]
 
+    @QMethod
+    def get_latest(self):
+        """
+        **QMethod**
+        Get the newest record of the continuous acquisition without waiting for the oscilloscope
+
+        Returns:
+            A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (1,channels,samples) and the entries timestamps and records (the record ids), or None if there is no record
+        """
+        if self.acquisition is None:
+            return None
+        latest = self.acquisition.buffer.latest()
+        if latest is None:
+            return None
+        return ot.pack_records([latest],ot.pack_rs_trace)
+
+    @QMethod
+    def get_next(self,N=1,timeout=10):
+        """
+        **QMethod**
+        Wait for the next N records of the continuous acquisition
+
+        Args:
+            N (int,optional): Number of records, defaults to 1
+            timeout (float,optional): Time in seconds to wait, the records received until then are returned, defaults to 10
+        Returns:
+            A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (records,channels,samples) and the entries timestamps and records (the record ids), or None if there are no records
+        """
+        if self.acquisition is None:
+            return None
+        return ot.pack_records(self.acquisition.buffer.next(N,timeout),ot.pack_rs_trace)
+
+    @QMethod
+    def get_since(self,recordid):
+        """
+        **QMethod**
+        Get all records of the continuous acquisition still in the buffer, from recordid and newer.
+        Use the last record id received plus one to get the records not seen yet
+
+        Args:
+            recordid (int): id of the first record to get
+        Returns:
+            A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (records,channels,samples) and the entries timestamps and records (the record ids), or None if there are no records
+        """
+        if self.acquisition is None:
+            return None
+        return ot.pack_records(self.acquisition.buffer.since(recordid),ot.pack_rs_trace)
 
     @QMethod 
-    def repeat_measurements(self,channels,Nmeas):
-        data = []
-        #self.hardware.write('STOP')
-        for i in range(Nmeas):
-            self.hardware.write('STOP')
-            data.append([])
-            data[-1] = self.get_channel_data(channels)
-            self.hardware.write('RUN')
-            time.sleep(0.1)
-        #self.hardware.write('RUN')
-        return data
+    def repeat_measurements(self,channels,Nmeas,compact=False,burst=False):
+        with self.hardwarelock:
+            if burst:
+                return self.burst_measurement(channels,Nmeas)
+            if compact:
+                data = []
+                for i in range(Nmeas):
+                    self.hardware.write('STOP')
+                    sources,adata,heads = self.get_multichannel_data(channels)
+                    data.append(adata)
+                    self.hardware.write('RUN')
+                    time.sleep(0.1)
+                return ot.pack_rs_trace(np.stack(data),sources,heads)
+            data = []
+            #self.hardware.write('STOP')
+            for i in range(Nmeas):
+                self.hardware.write('STOP')
+                data.append([])
+                data[-1] = self.get_channel_data(channels)
+                self.hardware.write('RUN')
+                time.sleep(0.1)
+            #self.hardware.write('RUN')
+            return data
 
     @QMethod
     def measure_peakpeak(self,channel,place,stat=False,stattime = 3):
@@ -104,41 +313,19 @@ class Server(QWeatherServer):
         return self._measure_value(channel,place,'UPE',stat,stattime)
 
     def _measure_value(self,channel,place,measurement,stat,stattime):
-        if not isinstance(channel,list):
-            self.hardware.write('MEAS{:d}:SOUR CH{:d}'.format(place,channel))
+        channels = ot.as_list(channel)
+        places = channels if isinstance(channel,list) else [place]
+        with self.hardwarelock:
+            ot.setup_measurements(self.hardware,channels,places,stat)
+        if stat or isinstance(channel,list):
+            time.sleep(stattime)
+        with self.hardwarelock:
             if stat:
-                self.hardware.write('MEAS{:d}:STAT ON'.format(place))
-                self.hardware.write('MEAS{:d}:STAT:RES'.format(place))
-                time.sleep(stattime)
-                avgval = float(self.hardware.query('MEAS{:d}:RES:AVG?').format(place))
-                std = float(self.hardware.query('MEAS{:d}:RES:STDD?').format(place))
-                minval = float(self.hardware.query('MEAS{:d}:RES:NPE?').format(place))
-                maxval = float(self.hardware.query('MEAS{:d}:RES:PPE?').format(place))
-                trigevents = int(self.hardware.query('MEAS{:d}:RES:WFMC?').format(place))
-
-                data = [avgval,std,minval,maxval,trigevents]
-
+                data = ot.query_statistics(self.hardware,places)
             else:
-                data = float(self.hardware.query('MEAS{:d}:RES? {:s}'.format(place,measurement)))
-        else:
-            for achan in channel:
-                self.hardware.write('MEAS{:d}:SOUR CH{:d}'.format(achan,achan))
-                if stat:
-                    self.hardware.write('MEAS{:d}:STAT ON'.format(achan))
-                    self.hardware.write('MEAS{:d}:STAT:RES'.format(achan))
-            time.sleep(stattime)
-            data = []
-            for achan in channel:
-                if stat:
-                    avgval = float(self.hardware.query('MEAS{:d}:RES:AVG?'.format(achan)))
-                    std = float(self.hardware.query('MEAS{:d}:RES:STDD?'.format(achan)))
-                    minval = float(self.hardware.query('MEAS{:d}:RES:NPE?'.format(achan)))
-                    maxval = float(self.hardware.query('MEAS{:d}:RES:PPE?'.format(achan)))
-                    trigevents = int(self.hardware.query('MEAS{:d}:RES:WFMC?'.format(achan)))
-
-                    data.append([avgval,std,minval,maxval,trigevents])
-                else:
-                    data.append(float(self.hardware.query('MEAS{:d}:RES? {:s}'.format(achan,measurement))))
+                data = ot.query_results(self.hardware,places,measurement)
+        if not isinstance(channel,list):
+            data = data[0]
         return data
 
 
@@ -80,6 +80,7 @@ class StrontiumBrain(QWeatherServer):
         self.channelsAO = defaultdict(Channel)
         self.channelsDI = defaultdict(Channel)
         self.channelsDO = defaultdict(Channel)
+        self.compiled = None # Sequence compiled with compileSequence, waiting to be armed
         
         self.clock = "/Dev1/Ctr0InternalOutput"#"/Dev1/100kHzTimebase"#
         # The (DO) clockrate has been lowered from 10 to 1 MHz to accomodate AO signals
@@ -130,11 +131,42 @@ class StrontiumBrain(QWeatherServer):
 
 
 
+    @QMethod
+    def compileSequence(self,digital,analog,AOdata,user_Max_Time = None):
+        '''Compiles a sequence without arming it, so the next sequence can be prepared while the current one is running.
+        compileSequence(dict digital, dict analog, list AOdata, float user_Max_Time) with digital a dictionary of channel name to a list of (tstart, tstop)
+        and analog of channel name to a list of (tstart, tstop, volt), all in seconds. Arm it with armCompiledSequence. Returns None'''
+        if user_Max_Time is None:
+            user_Max_Time = self.maxtime
+        channelsDO = defaultdict(Channel)
+        for aname,timings in digital.items():
+            channelsDO[aname].timings = [tuple(atiming) for atiming in timings]
+        channelsAO = defaultdict(Channel)
+        for aname,timings in analog.items():
+            channelsAO[aname].timings = [tuple(atiming) for atiming in timings]
+        self.compileDigitalOutput(user_Max_Time,channelsDO)
+        self.compiled = (channelsDO,channelsAO,AOdata,user_Max_Time)
+
+    @QMethod
+    def armCompiledSequence(self):
+        '''Arms the sequence compiled with compileSequence in place of the current one, stop the current sequence first. Returns None'''
+        if self.compiled is None:
+            print('No compiled sequence to arm')
+            return
+        self.channelsDO,self.channelsAO,AOdata,user_Max_Time = self.compiled
+        self.compiled = None
+        self.armTasks(AOdata,user_Max_Time)
+
     @QMethod
     def armSequence(self,AOdata,user_Max_Time = None):
         '''arms sequence'''
         if user_Max_Time is None:
             user_Max_Time = self.maxtime
+        self.compileDigitalOutput(user_Max_Time)
+        self.armTasks(AOdata,user_Max_Time)
+
+    def armTasks(self,AOdata,user_Max_Time):
+        '''Creates and commits the tasks of the sequence in channelsDO and channelsAO, with the digital output already compiled'''
         
         #############################################
         #                                           #
@@ -232,7 +264,6 @@ class StrontiumBrain(QWeatherServer):
         #############################################
         if len(self.channelsDO.items()) is not 0:
             self.DOtask = CallBackTask()
-            self.compileDigitalOutput(user_Max_Time)
 
             digitalChannelNames = list(self.channelsDO.keys()) + list(self.channelsDI.keys()) #list of names of digital lines used
             lineadress = ','.join([self.channellistDO[aname][0] for aname in digitalChannelNames])
@@ -302,8 +333,11 @@ class StrontiumBrain(QWeatherServer):
     def getChannelList(self):
         return [list(self.channellistDO.keys()),list(self.channellistAI.keys()), list(self.channellistAO.keys())] 
 
-    def compileDigitalOutput(self,max_time):
-        for aname,achannel in self.channelsDO.items():
+    def compileDigitalOutput(self,max_time,channels = None):
+        '''Compiles the timings of the digital channels (channelsDO by default) to arrays of samples'''
+        if channels is None:
+            channels = self.channelsDO
+        for aname,achannel in channels.items():
             invpolarity = self.channellistDO[aname][1]
             timings = achannel.timings
             timings.sort(key=lambda x: x[0]) # Sort timings according to tstart
@@ -0,0 +1,582 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Helpers shared by the Qweather oscilloscope servers (RTB2004, HMO3004, RTO1044, DS1104Z)'''
+import numpy as np
+import time
+import warnings
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+
+def as_list(channels):
+    """Return channels as a list, so single channels and lists of channels can be treated the same way
+
+    :param channels: List of channels, or single channel
+    :type channels: list, int
+    :return: list of channels
+    :rtype: list"""
+    if channels is None:
+        return []
+    if isinstance(channels,(list,tuple)):
+        return list(channels)
+    return [channels]
+
+
+def read_block(hardware):
+    """Read a single IEEE 488.2 definite length binary block (#<n><length><data>) from the hardware.
+    Separators between blocks of a combined reply (';' or whitespace) are skipped.
+
+    :param hardware: open visa resource
+    :return: the raw bytes of the block
+    :rtype: bytes"""
+    start = hardware.read_bytes(1)
+    while start != b'#':
+        start = hardware.read_bytes(1)
+    ndigits = int(hardware.read_bytes(1))
+    if ndigits == 0:
+        raise ValueError('Indefinite length blocks are not supported')
+    length = int(hardware.read_bytes(ndigits))
+    return hardware.read_bytes(length)
+
+
+def query_headers(hardware,sources):
+    """Get the data headers of a list of sources with a single ';'-joined query
+
+    :param hardware: open visa resource
+    :param sources: list of source names, e.g. ['CHAN1','REFC2']
+    :type sources: list
+    :return: array of headers, one row [xstart, xstop, samples, values per sample] per source
+    :rtype: numpy.ndarray"""
+    reply = hardware.query(';:'.join('{:s}:DATA:HEAD?'.format(asource) for asource in sources))
+    values = [float(aval.strip()) for aval in reply.replace(';',',').split(',')]
+    return np.array(values).reshape(len(sources),-1)
+
+
+def query_blocks(hardware,sources,query='{:s}:DATA?'):
+    """Pipeline the data queries of all sources into one message and read the combined binary reply
+
+    :param hardware: open visa resource
+    :param sources: list of source names, e.g. ['CHAN1','REFC2']
+    :type sources: list
+    :param query: format string of the data query for a single source
+    :type query: str
+    :return: list of raw bytes, one per source
+    :rtype: list"""
+    hardware.write(';:'.join(query.format(asource) for asource in sources))
+    blocks = [read_block(hardware) for asource in sources]
+    hardware.read_bytes(1) #Trailing message terminator
+    return blocks
+
+
+def stack_blocks(blocks,dtype='>f4'):
+    """Convert a list of raw binary blocks to one contiguous 2-D float32 array, one row per block.
+    Rows shorter than the longest block are padded with NaN.
+
+    :param blocks: list of raw bytes
+    :type blocks: list
+    :param dtype: numpy dtype of the samples in the blocks
+    :type dtype: str
+    :return: array with shape (len(blocks), samples)
+    :rtype: numpy.ndarray"""
+    dtype = np.dtype(dtype)
+    lengths = [len(ablock)//dtype.itemsize for ablock in blocks]
+    data = np.empty((len(blocks),max(lengths,default=0)),dtype=np.float32)
+    for row,ablock,alength in zip(data,blocks,lengths):
+        row[:alength] = np.frombuffer(ablock,dtype=dtype,count=alength)
+        row[alength:] = np.nan
+    return data
+
+
+def time_axis(head):
+    """Describe the time axis of a Rohde&Schwarz data header instead of building it
+
+    :param head: header in the form [xstart, xstop, samples, values per sample]
+    :type head: list
+    :return: (t0, dt, n), the time of the first sample, the sample spacing and the number of samples
+    :rtype: tuple"""
+    n = int(head[2]*head[3])
+    if n > 1:
+        dt = (head[1] - head[0])/(n - 1)
+    else:
+        dt = 0.
+    return float(head[0]),float(dt),n
+
+
+def channel_metadata(sources,heads):
+    """Make the per channel metadata of a compact trace from the source names and their data headers
+
+    :param sources: list of source names, e.g. ['CHAN1','REFC2']
+    :type sources: list
+    :param heads: one header per source
+    :type heads: list, numpy.ndarray
+    :return: list of dictionaries with the source name and its header
+    :rtype: list"""
+    return [{'source':asource,'head':[float(ah) for ah in ahead]} for asource,ahead in zip(sources,heads)]
+
+
+def pack_trace(data,t0,dt,channels,**metadata):
+    """Pack a measurement in the compact trace format sent to clients.
+    The time axis is described by (t0, dt, n) and the samples are sent as one raw buffer,
+    so no time array is sent along with the data. Clients rebuild the arrays with np.frombuffer.
+
+    :param data: samples with the channels along the second to last axis and time along the last axis
+    :type data: numpy.ndarray
+    :param t0: time of the first sample
+    :type t0: float
+    :param dt: time between samples
+    :type dt: float
+    :param channels: list of metadata dictionaries, one per channel, see :py:func:`channel_metadata`
+    :type channels: list
+    :param metadata: any extra entries to put in the trace, e.g. timestamps
+    :return: dictionary with the keys t0, dt, n, dtype, shape, channels and buffer
+    :rtype: dict"""
+    data = np.ascontiguousarray(data)
+    trace = {'t0':float(t0),
+             'dt':float(dt),
+             'n':int(data.shape[-1]),
+             'dtype':data.dtype.str,
+             'shape':data.shape,
+             'channels':channels,
+             'buffer':data.tobytes()}
+    trace.update(metadata)
+    return trace
+
+
+def pack_rs_trace(data,sources,heads,**metadata):
+    """Pack a measurement from a Rohde&Schwarz style oscilloscope, using the header of the first source for the time axis
+
+    :param data: samples, see :py:func:`pack_trace`
+    :type data: numpy.ndarray
+    :param sources: list of source names
+    :type sources: list
+    :param heads: one data header per source
+    :type heads: list, numpy.ndarray
+    :return: compact trace, see :py:func:`pack_trace`
+    :rtype: dict"""
+    t0,dt,n = time_axis(heads[0])
+    return pack_trace(data,t0,dt,channel_metadata(sources,heads),**metadata)
+
+
+#Maximum number of points a Rigol DS1000Z returns per :WAV:DATA? query, and the dtype of the points, per waveform format
+RIGOL_CHUNK = {'BYTE':250000,'WORD':125000}
+RIGOL_DTYPE = {'BYTE':'u1','WORD':'<u2'}
+RIGOL_FORMATS = ['BYTE','WORD','ASC']
+
+
+def query_preamble(hardware,source):
+    """Select a source on a Rigol oscilloscope and read its waveform preamble
+
+    :param hardware: open visa resource
+    :param source: source name, e.g. CHAN1
+    :type source: str
+    :return: preamble [format, type, points, count, xincrement, xorigin, xreference, yincrement, yorigin, yreference]
+    :rtype: list"""
+    hardware.write(':WAV:SOUR {:s}'.format(source))
+    return [float(aval) for aval in hardware.query(':WAV:PRE?').split(',')]
+
+
+def rigol_time_axis(preamble):
+    """Describe the time axis of a Rigol waveform preamble
+
+    :param preamble: preamble as returned by :py:func:`query_preamble`
+    :type preamble: list
+    :return: (t0, dt, n)
+    :rtype: tuple"""
+    xinc,xorig,xref = preamble[4:7]
+    return float(xorig - xref*xinc),float(xinc),int(preamble[2])
+
+
+def read_rigol_waveform(hardware,preamble,out=None):
+    """Read the selected source of a Rigol oscilloscope as raw BYTE or WORD codes and convert them to volts.
+    Records longer than the per read limit of the oscilloscope are read in chunks with :WAV:STAR and :WAV:STOP.
+    The source must be selected first, see :py:func:`query_preamble`.
+
+    :param hardware: open visa resource
+    :param preamble: preamble of the selected source
+    :type preamble: list
+    :param out: optional float32 array to write the volts into, must hold at least the number of points in the preamble
+    :type out: numpy.ndarray
+    :return: the volts as float32
+    :rtype: numpy.ndarray"""
+    wavformat = RIGOL_FORMATS[int(preamble[0])]
+    if wavformat not in RIGOL_CHUNK:
+        raise ValueError('Waveform format {:s} is not a binary format'.format(wavformat))
+    npoints = int(preamble[2])
+    chunk = RIGOL_CHUNK[wavformat]
+    codes = np.empty(npoints,dtype=RIGOL_DTYPE[wavformat])
+    for start in range(0,npoints,chunk):
+        stop = min(start + chunk,npoints)
+        hardware.write(':WAV:STAR {:d}'.format(start + 1))
+        hardware.write(':WAV:STOP {:d}'.format(stop))
+        hardware.write(':WAV:DATA?')
+        block = np.frombuffer(read_block(hardware),dtype=codes.dtype)
+        hardware.read_bytes(1)
+        codes[start:start + len(block)] = block
+    if out is None:
+        out = np.empty(npoints,dtype=np.float32)
+    out = out[:npoints]
+    yinc,yorig,yref = preamble[7:10]
+    np.subtract(codes,yorig + yref,out=out)
+    out *= yinc
+    return out
+
+
+def pack_rigol_trace(data,sources,preambles,**metadata):
+    """Pack a measurement from a Rigol oscilloscope, using the preamble of the first source for the time axis
+
+    :param data: samples, see :py:func:`pack_trace`
+    :type data: numpy.ndarray
+    :param sources: list of source names
+    :type sources: list
+    :param preambles: one waveform preamble per source
+    :type preambles: list
+    :return: compact trace, see :py:func:`pack_trace`
+    :rtype: dict"""
+    t0,dt,n = rigol_time_axis(preambles[0])
+    channels = [{'source':asource,'preamble':[float(ap) for ap in apre]} for asource,apre in zip(sources,preambles)]
+    return pack_trace(data,t0,dt,channels,**metadata)
+
+
+def query_segment_timestamps(hardware,source,segments):
+    """Get the time stamps of history segments relative to the newest segment in a single ';'-joined query
+
+    :param hardware: open visa resource
+    :param source: source name whose history is read, e.g. 'CHAN1'
+    :type source: str
+    :param segments: history indices, 0 is the newest segment, negative numbers are older segments
+    :type segments: list
+    :return: time stamps in seconds, one per segment
+    :rtype: numpy.ndarray"""
+    reply = hardware.query(';:'.join('{0:s}:HIST:CURR {1:d};:{0:s}:HIST:TSR?'.format(source,aseg) for aseg in segments))
+    return np.array([float(aval.strip()) for aval in reply.split(';')])
+
+
+def query_segment_blocks(hardware,sources,segments,query='{:s}:DATA?'):
+    """Read the data of several history segments of several sources in one pipelined query.
+    Selecting a segment gives no reply, so the combined reply is only the binary blocks, segment by segment.
+
+    :param hardware: open visa resource
+    :param sources: list of source names, e.g. ['CHAN1','CHAN2']
+    :type sources: list
+    :param segments: history indices, 0 is the newest segment, negative numbers are older segments
+    :type segments: list
+    :param query: format string of the data query for a single source
+    :type query: str
+    :return: list of raw bytes, segment by segment and source by source
+    :rtype: list"""
+    commands = []
+    for aseg in segments:
+        commands += ['{:s}:HIST:CURR {:d}'.format(asource,aseg) for asource in sources]
+        commands += [query.format(asource) for asource in sources]
+    hardware.write(';:'.join(commands))
+    blocks = [read_block(hardware) for i in range(len(segments)*len(sources))]
+    hardware.read_bytes(1) #Trailing message terminator
+    return blocks
+
+
+def clear_device(hardware):
+    """Clear the input and output buffers of the instrument and the event status, e.g. after a timeout,
+    so a reply that arrives late is not read as the reply to the next query
+
+    :param hardware: open visa resource"""
+    hardware.clear()
+    hardware.write('*CLS')
+
+
+def wait_single(hardware,lock,timeout,arm='SING',interval=0.01):
+    """Arm a single acquisition and wait for it by polling the operation complete bit of the event status register (\\*ESR?).
+    The lock is only held while arming and for each poll, so other calls can use the instrument while the oscilloscope waits for a trigger,
+    and no query is left waiting for the trigger, so a late reply can not get out of step with the next query.
+    If the trigger does not come in time the acquisition is stopped, and if a query fails the instrument is cleared with :py:func:`clear_device`
+
+    :param hardware: open visa resource
+    :param lock: lock protecting the instrument connection
+    :type lock: threading.Lock, threading.RLock
+    :param timeout: time in seconds to wait for the trigger
+    :type timeout: float
+    :param arm: command arming the single acquisition
+    :type arm: str
+    :param interval: time in seconds between the polls
+    :type interval: float
+    :return: True if the acquisition is done, False if it timed out
+    :rtype: bool"""
+    deadline = time.time() + timeout
+    try:
+        with lock:
+            hardware.write('*CLS;:{:s};*OPC'.format(arm))
+        while True:
+            with lock:
+                if int(hardware.query('*ESR?')) & 1:
+                    return True
+                if time.time() > deadline:
+                    hardware.write('STOP')
+                    return False
+            time.sleep(interval)
+    except Exception:
+        with lock:
+            clear_device(hardware)
+        raise
+
+
+def burst_acquire(hardware,channels,nsegments,arm,dtype='>f4',timeout=10,restore='ACQ:SEGM:STAT OFF;:ACQ:NSIN:COUN 1'):
+    """Arm the segmented (history) memory for a number of triggers, wait for them and read all segments back in bulk.
+    Afterwards, also if anything fails, the segmented memory is turned off, the acquisition count set back to 1 and the oscilloscope RUN,
+    so the next single acquisition is a plain one. On errors the instrument is cleared with :py:func:`clear_device`, so a late reply is not left pending
+
+    :param hardware: open visa resource
+    :param channels: List of channels, or single channel to get data from
+    :type channels: list, int
+    :param nsegments: number of triggers to record
+    :type nsegments: int
+    :param arm: format string of the command that arms the oscilloscope for a number of single acquisitions
+    :type arm: str
+    :param dtype: numpy dtype of the samples sent by the oscilloscope
+    :type dtype: str
+    :param timeout: time in seconds to wait for all the triggers
+    :type timeout: float
+    :param restore: command undoing the settings of arm
+    :type restore: str
+    :return: List of data in the form [sources, data, headers, timestamps], where data is a float32 array with the shape (nsegments, channels, samples)
+    :rtype: list"""
+    sources = ['CHAN{:d}'.format(achan) for achan in as_list(channels)]
+    segments = list(range(-(nsegments-1),1))
+    try:
+        oldtimeout = hardware.timeout
+        hardware.timeout = max(oldtimeout,int(timeout*1000))
+        try:
+            hardware.write(arm.format(nsegments))
+            hardware.query('*OPC?')
+        finally:
+            hardware.timeout = oldtimeout
+        heads = query_headers(hardware,sources)
+        timestamps = query_segment_timestamps(hardware,sources[0],segments)
+        data = stack_blocks(query_segment_blocks(hardware,sources,segments),dtype)
+        return [sources,data.reshape(nsegments,len(sources),-1),heads,timestamps]
+    except Exception:
+        clear_device(hardware)
+        raise
+    finally:
+        hardware.write(restore + ';:RUN')
+
+
+def window(name,n):
+    """Make a window function for spectral reductions
+
+    :param name: 'hann', 'hamming', 'blackman', 'bartlett' or 'boxcar' (no window)
+    :type name: str
+    :param n: number of points
+    :type n: int
+    :return: the window
+    :rtype: numpy.ndarray"""
+    windows = {'hann':np.hanning,'hanning':np.hanning,'hamming':np.hamming,'blackman':np.blackman,'bartlett':np.bartlett}
+    if name is None or name.lower() in ('boxcar','rect','none'):
+        return np.ones(n)
+    return windows[name.lower()](n)
+
+
+def _statistic(name,data):
+    """Calculate a single statistic along the last axis, leaving out the NaN padding of shorter channels"""
+    if name == 'mean':
+        return np.nanmean(data,axis=-1)
+    elif name == 'rms':
+        return np.sqrt(np.nanmean(np.square(data),axis=-1))
+    elif name == 'std':
+        return np.nanstd(data,axis=-1)
+    elif name == 'min':
+        return np.nanmin(data,axis=-1)
+    elif name == 'max':
+        return np.nanmax(data,axis=-1)
+    elif name == 'ptp':
+        return np.nanmax(data,axis=-1) - np.nanmin(data,axis=-1)
+    raise ValueError('Unknown statistic: {:s}'.format(name))
+
+
+def _fft(data,dt,window_name='hann'):
+    """Single sided amplitude spectrum along the last axis"""
+    w = window(window_name,data.shape[-1])
+    spectrum = np.abs(np.fft.rfft(data*w,axis=-1))*(2/w.sum())
+    return {'f0':0.,'df':1/(data.shape[-1]*dt),'magnitude':spectrum.astype(np.float32)}
+
+
+def _welch(data,dt,nperseg=1024,overlap=0.5,window_name='hann'):
+    """Welch power spectral density along the last axis, in units^2/Hz"""
+    nperseg = min(int(nperseg),data.shape[-1])
+    step = max(1,int(nperseg*(1-overlap)))
+    segments = np.lib.stride_tricks.sliding_window_view(data,nperseg,axis=-1)[...,::step,:]
+    segments = segments - segments.mean(axis=-1,keepdims=True)
+    w = window(window_name,nperseg)
+    psd = np.square(np.abs(np.fft.rfft(segments*w,axis=-1)))*(dt/np.square(w).sum())
+    psd[...,1:(nperseg+1)//2] *= 2
+    return {'f0':0.,'df':1/(nperseg*dt),'psd':psd.mean(axis=-2).astype(np.float32)}
+
+
+def _minmax(data,t0,dt,npoints=1000):
+    """Decimate to an envelope of npoints min/max pairs along the last axis, bin i starts at t0 + i*dt of the result"""
+    npoints = int(npoints)
+    if npoints < 1 or npoints > data.shape[-1]:
+        raise ValueError('npoints must be between 1 and the number of samples ({:d}), not {:d}'.format(data.shape[-1],npoints))
+    binsize = data.shape[-1]//npoints
+    binned = data[...,:binsize*npoints].reshape(data.shape[:-1] + (npoints,binsize))
+    return {'t0':t0,'dt':dt*binsize,'min':np.nanmin(binned,axis=-1),'max':np.nanmax(binned,axis=-1)}
+
+
+def _gated(data,t0,dt,start,stop,statistics=('mean','rms','std','min','max','ptp')):
+    """Statistics of the samples between the times start and stop"""
+    istart = max(0,int(round((start - t0)/dt)))
+    istop = min(data.shape[-1],int(round((stop - t0)/dt)) + 1)
+    gate = data[...,istart:istop]
+    return dict((astat,_statistic(astat,gate)) for astat in statistics)
+
+
+def _valid(data):
+    """The samples every channel has, as shorter channels are padded with NaN by :py:func:`stack_blocks`"""
+    padded = np.isnan(data).any(axis=tuple(range(data.ndim - 1)))
+    return data[...,:np.argmax(padded)] if padded.any() else data
+
+
+def _combine(key,value):
+    """Combine the results of the triggers along the first axis: minima by the minimum, maxima by the maximum and everything else by the mean"""
+    if key == 'min':
+        return np.nanmin(value,axis=0)
+    elif key == 'max':
+        return np.nanmax(value,axis=0)
+    return np.nanmean(value,axis=0)
+
+
+def reduce_traces(data,t0,dt,reductions):
+    """Calculate reductions of traces with numpy, so only the small results have to be sent to clients.
+    All reductions are calculated for every trigger along the first axis and then combined over the triggers:
+    minima (min) by their minimum, maxima (max) by their maximum and all other results by their mean.
+    The NaN padding of channels shorter than the others is left out of the statistics and the envelope,
+    and the spectra are calculated from the samples all channels have.
+
+    Reductions are given as a name, or as a list [name, options]:
+
+    * 'mean', 'rms', 'std', 'min', 'max', 'ptp': statistic of each channel
+    * ['fft', {'window':'hann'}]: single sided amplitude spectrum, with the frequency axis described by f0 and df
+    * ['welch', {'nperseg':1024, 'overlap':0.5, 'window':'hann'}]: Welch power spectral density
+    * ['minmax', {'npoints':1000}]: min/max envelope decimated to npoints, with the time axis described by t0 and dt
+    * ['gated', {'start':t1, 'stop':t2, 'statistics':['mean','rms']}]: statistics between the times t1 and t2
+
+    An option 'label' can be given to name the result, e.g. to have two gates.
+
+    :param data: samples with the shape (triggers, channels, samples)
+    :type data: numpy.ndarray
+    :param t0: time of the first sample
+    :type t0: float
+    :param dt: time between samples
+    :type dt: float
+    :param reductions: list of reductions
+    :type reductions: list
+    :return: dictionary of results, keyed by the reduction name or label
+    :rtype: dict"""
+    data = np.asarray(data,dtype=np.float32)
+    results = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',RuntimeWarning) #bins and triggers with only padding give NaN
+        for areduction in reductions:
+            if isinstance(areduction,str):
+                name,options = areduction,{}
+            else:
+                name,options = areduction[0],dict(areduction[1])
+            label = options.pop('label',name)
+            if 'window' in options:
+                options['window_name'] = options.pop('window')
+            if name == 'fft':
+                result = _fft(_valid(data),dt,**options)
+            elif name == 'welch':
+                result = _welch(_valid(data),dt,**options)
+            elif name == 'minmax':
+                result = _minmax(data,t0,dt,**options)
+            elif name == 'gated':
+                result = _gated(data,t0,dt,**options)
+            else:
+                result = _statistic(name,data)
+            if isinstance(result,dict):
+                results[label] = dict((akey,_combine(akey,aval) if isinstance(aval,np.ndarray) else aval) for akey,aval in result.items())
+            else:
+                results[label] = _combine(name,result)
+    return results
+
+
+def make_record(sources,data,heads):
+    """Make a record of a single acquisition for a continuous acquisition, see :py:mod:`AcquisitionBuffer`
+
+    :return: dictionary with the keys sources, data, heads and timestamp
+    :rtype: dict"""
+    return {'sources':sources,'data':data,'heads':heads,'timestamp':time.time()}
+
+
+def pack_records(records,pack=pack_rs_trace):
+    """Pack records from a continuous acquisition in one compact trace with data of shape (records, channels, samples)
+
+    :param records: list of (id, record) as returned by :py:class:`AcquisitionBuffer.RingBuffer`, see :py:func:`make_record`
+    :type records: list
+    :param pack: function packing the data, :py:func:`pack_rs_trace` or :py:func:`pack_rigol_trace`
+    :type pack: callable
+    :return: compact trace with the extra entries timestamps and records (the record ids), or None if there are no records
+    :rtype: dict"""
+    if len(records) == 0:
+        return None
+    ids = [arecord[0] for arecord in records]
+    records = [arecord[1] for arecord in records]
+    data = np.stack([arecord['data'] for arecord in records])
+    return pack(data,records[-1]['sources'],records[-1]['heads'],timestamps=[arecord['timestamp'] for arecord in records],records=ids)
+
+
+#Statistics read from a measurement place, in the order they are queried, and the fields they are stored in
+STATISTICS = ['AVG','STDD','NPE','PPE','WFMC']
+STATISTICS_DTYPE = np.dtype([('avg','f8'),('std','f8'),('min','f8'),('max','f8'),('count','i8')])
+
+
+def setup_measurements(hardware,channels,places,stat=False):
+    """Set the sources of several measurement places, and optionally turn on and reset their statistics, in one message
+
+    :param hardware: open visa resource
+    :param channels: one channel per place
+    :type channels: list
+    :param places: measurement places on the oscilloscope
+    :type places: list
+    :param stat: If True, turn statistics on and reset them
+    :type stat: bool"""
+    commands = []
+    for achan,aplace in zip(channels,places):
+        commands.append('MEAS{:d}:SOUR CH{:d}'.format(aplace,achan))
+        if stat:
+            commands.append('MEAS{:d}:STAT ON'.format(aplace))
+            commands.append('MEAS{:d}:STAT:RES'.format(aplace))
+    hardware.write(';:'.join(commands))
+
+
+def query_results(hardware,places,measurement):
+    """Get the current result of a measurement from several places in one ';'-joined query
+
+    :param hardware: open visa resource
+    :param places: measurement places on the oscilloscope
+    :type places: list
+    :param measurement: PEAK-peak peak; MEAN-mean; STDD-std; LPE-min; UPE-max
+    :type measurement: str
+    :return: one result per place
+    :rtype: numpy.ndarray"""
+    reply = hardware.query(';:'.join('MEAS{:d}:RES? {:s}'.format(aplace,measurement) for aplace in places))
+    return np.array([float(aval) for aval in reply.split(';')])
+
+
+def query_statistics(hardware,places):
+    """Get the statistics (average, standard deviation, min, max and number of waveforms) of several measurement places
+    in one ';'-joined query, parsed in one pass
+
+    :param hardware: open visa resource
+    :param places: measurement places on the oscilloscope
+    :type places: list
+    :return: record array with the fields avg, std, min, max and count, one record per place in the order of places,
+             so a record unpacks as avg,std,mn,mx,count
+    :rtype: numpy.ndarray"""
+    places = as_list(places)
+    reply = hardware.query(';:'.join('MEAS{:d}:RES:{:s}?'.format(aplace,astat) for aplace in places for astat in STATISTICS))
+    values = np.array([float(aval) for aval in reply.split(';')]).reshape(len(places),len(STATISTICS))
+    result = np.empty(len(places),dtype=STATISTICS_DTYPE)
+    for i,afield in enumerate(STATISTICS_DTYPE.names):
+        result[afield] = values[:,i]
+    return result.view(np.recarray)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 '''Server (Qweather) to grab data from the Rode&Schwartz Multimeters'''
 from qweather import QWeatherServer, QMethod
-import visa
+import VisaBackend as vb
 import numpy as np
 import time
 import smtplib,ssl
@@ -35,8 +35,7 @@ class Server(QWeatherServer):
 
     def initialize_hardware(self):
         """Open connection to hardware via visa"""
-        rm = visa.ResourceManager()
-        self.hardware = rm.open_resource(self.address)
+        self.hardware = vb.open_resource(self.address,'RSMultimeter')
         print('Multimeter server running Made contact with:')
         print(self.hardware.query('*IDN?'))
         print('*'*50)
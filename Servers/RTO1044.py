@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 '''Server (Qweather) to grab data from the Rode&Schwartz RTO1044 (big) oscilloscope'''
 from qweather import QWeatherServer, QMethod
-import visa
+import VisaBackend as vb
 import numpy as np
 import time, datetime
 import struct
@@ -10,6 +10,9 @@ import h5py
 import sys
 import gc
 import copy
+import threading
+import OscilloscopeTools as ot
+import AcquisitionBuffer as ab
 __author__ = 'Asbjorn Arvad Jorgensen'
 __version__ = '1.0'
 __email__ = 'Asbjorn.Arvad@nbi.ku.dk'
@@ -53,14 +56,15 @@ class Server(QWeatherServer):
 
     def initialize_hardware(self):
         """Open the connection to the hardware using a visa connection"""
-        rm = visa.ResourceManager()
-        self.hardware = rm.open_resource(self.address)
+        self.hardware = vb.open_resource(self.address,'RTO1044')
         print('Oscilloscope server running Made contact with:')
         print(self.hardware.query('*IDN?'))
         print('*'*50)
         self.hardware.write('FORM REAL, 32')
         self.hardware.write('FORM:BORD MSB')
         self.hardware.timeout=20000
+        self.hardwarelock = threading.RLock()
+        self.acquisition = None
 
 
 
@@ -72,70 +76,238 @@ class Server(QWeatherServer):
         :type channels: list, int
         :return: List of data in the form [tlist, datalist ,header]
         :rtype: list"""
-        if not isinstance(channels,list):
-            head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels)).split(',')
-            data = self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels),datatype='d',is_big_endian=True)
-        else:
-            head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels[0])).split(',')
-            print(head)
-            data = []
-            print('starting to get data')
-            print(datetime.datetime.now())
-            self.hardware.write('CHAN1:EXP OFF')
-            self.hardware.write('CHAN2:EXP OFF')
-            self.hardware.write('CHAN3:EXP OFF')
-            self.hardware.write('CHAN4:EXP OFF')
-            for i in range(len(channels)):
-                self.hardware.write('CHAN{:d}:EXP ON'.format(channels[i]))
-                self.hardware.write('CHAN{:d}:DATA?'.format(channels[i]))
-                a = self.hardware.read_bytes(1)
-                if a == b'#':
-                    a = int(self.hardware.read_bytes(1))
-                    if a == 0:
-                        print('Unknown length, not sure how to do')
-                    else:
-                        length = int(self.hardware.read_bytes(int(a)))
-                        print(length)
-                bstring = b''
-                subdiv = int(length/10)
-                while len(bstring) < length:
-                    bstring += self.hardware.read_bytes(subdiv)
-                    print(len(bstring))
-                data.append(copy.deepcopy(bstring))
-                del bstring
-                gc.collect()
-
-                #data.append(self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels[i]),datatype='f',is_big_endian=True))
-                print('finished getting data')
+        with self.hardwarelock:
+            if not isinstance(channels,list):
+                head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels)).split(',')
+                data = self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels),datatype='d',is_big_endian=True)
+            else:
+                head = self.hardware.query('CHAN{:d}:DATA:HEAD?'.format(channels[0])).split(',')
+                print(head)
+                data = []
+                print('starting to get data')
                 print(datetime.datetime.now())
-                self.hardware.write('CHAN{:d}:EXP OFF'.format(channels[i]))
+                self.hardware.write('CHAN1:EXP OFF')
+                self.hardware.write('CHAN2:EXP OFF')
+                self.hardware.write('CHAN3:EXP OFF')
+                self.hardware.write('CHAN4:EXP OFF')
+                for i in range(len(channels)):
+                    self.hardware.write('CHAN{:d}:EXP ON'.format(channels[i]))
+                    self.hardware.write('CHAN{:d}:DATA?'.format(channels[i]))
+                    a = self.hardware.read_bytes(1)
+                    if a == b'#':
+                        a = int(self.hardware.read_bytes(1))
+                        if a == 0:
+                            print('Unknown length, not sure how to do')
+                        else:
+                            length = int(self.hardware.read_bytes(int(a)))
+                            print(length)
+                    bstring = b''
+                    subdiv = int(length/10)
+                    while len(bstring) < length:
+                        bstring += self.hardware.read_bytes(subdiv)
+                        print(len(bstring))
+                    data.append(copy.deepcopy(bstring))
+                    del bstring
+                    gc.collect()
+
+                    #data.append(self.hardware.query_binary_values('CHAN{:d}:DATA?'.format(channels[i]),datatype='f',is_big_endian=True))
+                    print('finished getting data')
+                    print(datetime.datetime.now())
+                    self.hardware.write('CHAN{:d}:EXP OFF'.format(channels[i]))
+
+            head = [float(ah.strip()) for ah in head]
+            tlist = np.linspace(head[0],head[1],head[2]*head[3])
 
-        head = [float(ah.strip()) for ah in head]
-        tlist = np.linspace(head[0],head[1],head[2]*head[3])
+            return [tlist,data,head]
 
-        return [tlist,data,head]
+    def get_multichannel_data(self,channels,refchannels=None):
+        """Get data from channels and reference channels in one batched transaction.
+        All headers are fetched in one query and all data blocks in one pipelined query.
+        With several channels exported the oscilloscope sends all of them in every data block, so in the pipelined query
+        each channel is exported on its own: export on, read, export off, as the commands of a message are run in order.
+
+        :param channels: List of channels, or single channel to get data from
+        :type channels: list, int
+        :param refchannels: List of reference channels, or single reference channel to get data from
+        :type refchannels: list, int
+        :return: List of data in the form [sources, data, headers], where data is a 2-D float32 array with one row per source
+        :rtype: list"""
+        with self.hardwarelock:
+            channels = ot.as_list(channels)
+            sources = ['CHAN{:d}'.format(achan) for achan in channels] + ['REFC{:d}'.format(achan) for achan in ot.as_list(refchannels)]
+            self.hardware.write(';:'.join('CHAN{:d}:EXP OFF'.format(achan) for achan in range(1,5)))
+            heads = ot.query_headers(self.hardware,sources)
+            queries = [('{0:s}:EXP ON;:{0:s}:DATA?;:{0:s}:EXP OFF' if asource.startswith('CHAN') else '{0:s}:DATA?').format(asource) for asource in sources]
+            data = ot.stack_blocks(ot.query_blocks(self.hardware,queries,'{:s}'),'>f4')
+            return [sources,data,heads]
 
     @QMethod
-    def single_measurement(self,channels):
+    def single_measurement(self,channels,compact=False):
         """Do a single measurement. Initialize the measurement and RUN oscilloscope when done
 
         :param channels: List of channels, or single channel to take data from
         :type channels: list,int
+        :param compact: If True, return a compact trace (see :py:func:`OscilloscopeTools.pack_trace`)
+        :type compact: bool
         :return: A list of lists containing [timearray,data,[number of samples,samplerate]]
         :rtype: list"""
-        self.hardware.write('SING')
-        time.sleep(2)
+        with self.hardwarelock:
+            self.hardware.write('SING')
+            time.sleep(2)
+            if compact:
+                sources,data,heads = self.get_multichannel_data(channels)
+                self.hardware.write('RUN')
+                return ot.pack_rs_trace(data,sources,heads)
+
+            tlist,data,head = self.get_channel_data(channels)
+
+            Nsamples = head[2]
+            samplerate = (head[1] - head[0])/Nsamples
+            self.hardware.write('RUN')
+            return [tlist,data,[Nsamples,samplerate]]
+
+
+    @QMethod
+    def multi_measurement(self,channels,refchannels=None):
+        """Do a single measurement of several channels and reference channels from the same trigger in one call.
+        Initialize the measurement and RUN oscilloscope when done
+
+        :param channels: List of channels, or single channel to take data from
+        :type channels: list,int
+        :param refchannels: List of reference channels, or single reference channel to take data from
+        :type refchannels: list,int
+        :return: A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with one row per source
+        :rtype: dict"""
+        with self.hardwarelock:
+            self.hardware.write('SING')
+            time.sleep(2)
+            sources,data,heads = self.get_multichannel_data(channels,refchannels)
+            self.hardware.write('RUN')
+            return ot.pack_rs_trace(data,sources,heads)
+
+    def _burst_acquire(self,channels,Nsegments,timeout=10):
+        """Record Nsegments triggers in the segmented memory, read them back and RUN the oscilloscope. Calls :py:func:`OscilloscopeTools.burst_acquire`
+
+        :return: List of data in the form [sources, data, headers, timestamps], where data has the shape (Nsegments, channels, samples)
+        :rtype: list"""
+        with self.hardwarelock:
+            return ot.burst_acquire(self.hardware,channels,Nsegments,'ACQ:SEGM:STAT ON;:ACQ:COUN {:d};:SING','>f4',timeout,'ACQ:SEGM:STAT OFF;:ACQ:COUN 1')
+
+    @QMethod
+    def burst_measurement(self,channels,Nsegments,timeout=10):
+        """Record a burst of triggers in the segmented (history) memory of the oscilloscope and read all segments back in one bulk transfer.
+        No triggers are missed between the segments, as the oscilloscope is not stopped and restarted for every trace.
+
+        :param channels: List of channels, or single channel to take data from
+        :type channels: list,int
+        :param Nsegments: number of triggers to record
+        :type Nsegments: int
+        :param timeout: time in seconds to wait for all the triggers
+        :type timeout: float
+        :return: A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (Nsegments,channels,samples) and the entry timestamps, the time of each segment relative to the newest one
+        :rtype: dict"""
+        sources,data,heads,timestamps = self._burst_acquire(channels,Nsegments,timeout)
+        return ot.pack_rs_trace(data,sources,heads,timestamps=timestamps.tolist())
 
-        tlist,data,head = self.get_channel_data(channels)
+    @QMethod
+    def reduced_measurement(self,channels,reductions,Navg=1,timeout=10):
+        """Measure the channels and reduce the traces on the server with numpy, so only the small results are sent.
+        See :py:func:`OscilloscopeTools.reduce_traces` for the available reductions.
 
-        Nsamples = head[2]
-        samplerate = (head[1] - head[0])/Nsamples
-        self.hardware.write('RUN')
-        return [tlist,data,[Nsamples,samplerate]]
+        :param channels: List of channels, or single channel to take data from
+        :type channels: list,int
+        :param reductions: List of reductions, e.g. ['mean','rms',['welch',{'nperseg':4096}],['minmax',{'npoints':1000}]]
+        :type reductions: list
+        :param Navg: Number of triggers to average the reductions over. If larger than 1 the triggers are recorded in the segmented memory
+        :type Navg: int
+        :param timeout: time in seconds to wait for the Navg triggers
+        :type timeout: float
+        :return: A dictionary with the results keyed by reduction name (or label), and the entry sources with the names of the channels
+        :rtype: dict"""
+        if Navg > 1:
+            sources,data,heads,timestamps = self._burst_acquire(channels,Navg,timeout)
+        else:
+            sources,data,heads = self.get_multichannel_data(channels)
+            data = data[np.newaxis]
+        t0,dt,n = ot.time_axis(heads[0])
+        result = ot.reduce_traces(data,t0,dt,reductions)
+        result['sources'] = sources
+        return result
+
+    def _fetch_record(self,channels):
+        """Arm a single acquisition, wait for it and read it. Called repeatedly by the continuous acquisition thread.
+        The lock is only held while arming, polling and reading, see :py:func:`OscilloscopeTools.wait_single`
 
+        :return: record, see :py:func:`OscilloscopeTools.make_record`, or None if there was no trigger within the timeout
+        :rtype: dict"""
+        if not ot.wait_single(self.hardware,self.hardwarelock,self.hardware.timeout/1000):
+            return None
+        sources,data,heads = self.get_multichannel_data(channels)
+        return ot.make_record(sources,data,heads)
+
+    @QMethod
+    def start_continuous(self,channels,Nbuffer=100):
+        """Start continuous acquisition. A background thread keeps arming the oscilloscope and reading the triggered records into a ring buffer,
+        so the next trigger is armed while the last record is on its way to the client. Get the records with :py:meth:`get_latest`, :py:meth:`get_next` and :py:meth:`get_since`.
+
+        :param channels: List of channels, or single channel to take data from
+        :type channels: list,int
+        :param Nbuffer: Number of records to keep in the buffer
+        :type Nbuffer: int"""
+        self.stop_continuous()
+        self.acquisition = ab.AcquisitionThread(lambda: self._fetch_record(channels),Nbuffer)
+        self.acquisition.start()
+
+    @QMethod
+    def stop_continuous(self):
+        """Stop continuous acquisition and RUN the oscilloscope"""
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            self.acquisition = None
+            self.hardware.write('RUN')
+
+    @QMethod
+    def get_latest(self):
+        """Get the newest record of the continuous acquisition without waiting for the oscilloscope
+
+        :return: A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (1,channels,samples) and the entries timestamps and records (the record ids), or None if there is no record
+        :rtype: dict"""
+        if self.acquisition is None:
+            return None
+        latest = self.acquisition.buffer.latest()
+        if latest is None:
+            return None
+        return ot.pack_records([latest],ot.pack_rs_trace)
+
+    @QMethod
+    def get_next(self,N=1,timeout=10):
+        """Wait for the next N records of the continuous acquisition
+
+        :param N: Number of records
+        :type N: int
+        :param timeout: Time in seconds to wait, the records received until then are returned
+        :type timeout: float
+        :return: A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (records,channels,samples) and the entries timestamps and records (the record ids), or None if there are no records
+        :rtype: dict"""
+        if self.acquisition is None:
+            return None
+        return ot.pack_records(self.acquisition.buffer.next(N,timeout),ot.pack_rs_trace)
+
+    @QMethod
+    def get_since(self,recordid):
+        """Get all records of the continuous acquisition still in the buffer, from recordid and newer.
+        Use the last record id received plus one to get the records not seen yet
+
+        :param recordid: id of the first record to get
+        :type recordid: int
+        :return: A compact trace (see :py:func:`OscilloscopeTools.pack_trace`) with data of shape (records,channels,samples) and the entries timestamps and records (the record ids), or None if there are no records
+        :rtype: dict"""
+        if self.acquisition is None:
+            return None
+        return ot.pack_records(self.acquisition.buffer.since(recordid),ot.pack_rs_trace)
 
     @QMethod 
-    def repeat_measurements(self,channels,Nmeas):
+    def repeat_measurements(self,channels,Nmeas,compact=False,burst=False):
         """Repeat measurements. Initialize the measurement and RUN oscilloscope when done. Repeat N times. Each iteration is a new trigger on the oscilloscope.
 
 
@@ -143,18 +315,34 @@ class Server(QWeatherServer):
         :type channels: list,int
         :param Nmeas: number of times to repeat taking data
         :type Nmeas: int
+        :param compact: If True, return one compact trace with data of shape (Nmeas,channels,samples)
+        :type compact: bool
+        :param burst: If True, record the Nmeas triggers in the segmented memory and read them in bulk, see :py:meth:`burst_measurement`. Always returns a compact trace
+        :type burst: bool
         :return: A list of lists of lists containing [timearray,data,[number of samples,samplerate]]xNmeans
         :rtype: list"""
-        data = []
-        #self.hardware.write('STOP')
-        for i in range(Nmeas):
-            self.hardware.write('STOP')
-            data.append([])
-            data[-1] = self.get_channel_data(channels)
-            self.hardware.write('RUN')
-            time.sleep(0.1)
-        #self.hardware.write('RUN')
-        return data
+        with self.hardwarelock:
+            if burst:
+                return self.burst_measurement(channels,Nmeas)
+            if compact:
+                data = []
+                for i in range(Nmeas):
+                    self.hardware.write('STOP')
+                    sources,adata,heads = self.get_multichannel_data(channels)
+                    data.append(adata)
+                    self.hardware.write('RUN')
+                    time.sleep(0.1)
+                return ot.pack_rs_trace(np.stack(data),sources,heads)
+            data = []
+            #self.hardware.write('STOP')
+            for i in range(Nmeas):
+                self.hardware.write('STOP')
+                data.append([])
+                data[-1] = self.get_channel_data(channels)
+                self.hardware.write('RUN')
+                time.sleep(0.1)
+            #self.hardware.write('RUN')
+            return data
 
 
 
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Synthetic camera for the demo mode of the camera server.
+
+Generates absorption imaging triplets (atoms, probe, background) of a Gaussian cloud of atoms after a time of flight,
+so the optical depth, fitting and time of flight code can be run, and benchmarked, without a camera.
+The cloud expands ballistically with the temperature and falls with gravity, the probe beam has interference fringes
+with a phase that changes from frame to frame, and the counts have shot noise.
+With a seed the frames are the same every run.
+
+The frames are calculated in float32 with separable outer products, and the shot noise is drawn from the normal approximation
+of the Poisson distribution, so a full frame takes a few tens of ms and the generator keeps up with the camera frame rates.
+'''
+import numpy as np
+import time
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+KB = 1.38064852e-23
+G = 9.82
+
+
+class SyntheticCamera:
+    """Frames of a synthetic absorption imaging sequence, in the order atoms, probe, background.
+    All lengths are in sensor pixels, and all settings can be changed between frames with :py:meth:`configure`
+
+    :param sensorshape: (rows, columns) of the sensor
+    :param bitdepth: 8, 12 or 16, the frames are uint8 for 8 bit and uint16 otherwise
+    :param pixelsize: side of a sensor pixel in the object plane in meters
+    :param center: (x, y) position of the cloud at time of flight 0
+    :param sigma0: (x, y) rms widths of the cloud at time of flight 0
+    :param peak_od: optical depth in the center of the cloud at time of flight 0, it drops as the cloud expands
+    :param temperature: temperature in kelvin, giving the expansion of the cloud
+    :param mass: mass of an atom in kg, 88Sr by default
+    :param tof: time of flight in ms
+    :param gravity: let the cloud fall along y (the rows)
+    :param probe: peak counts of the probe beam
+    :param probewaist: (x, y) 1/e^2 radii of the probe beam
+    :param background: mean counts without probe light
+    :param fringes: relative amplitude of the fringes on the probe beam
+    :param fringeperiod: period of the fringes
+    :param fringeangle: direction of the fringes in radians
+    :param shotnoise: add Poisson noise to the counts
+    :param framerate: target frame rate of :py:meth:`wait_next_frame` in frames per second
+    :param seed: seed of the random numbers, None for different frames every run"""
+
+    def __init__(self,sensorshape=(1200,1920),bitdepth=8,pixelsize=5.86e-6,center=(960,600),sigma0=(40,40),peak_od=1.5,
+                 temperature=1e-3,mass=1.4592332e-25,tof=0,gravity=True,probe=150,probewaist=(1500,1500),background=2,
+                 fringes=0.05,fringeperiod=25,fringeangle=0.6,shotnoise=True,framerate=10,seed=None):
+        self.sensorshape = tuple(sensorshape)
+        self.bitdepth = bitdepth
+        self.pixelsize = pixelsize
+        self.center = tuple(center)
+        self.sigma0 = tuple(sigma0)
+        self.peak_od = peak_od
+        self.temperature = temperature
+        self.mass = mass
+        self.tof = tof
+        self.gravity = gravity
+        self.probe = probe
+        self.probewaist = tuple(probewaist)
+        self.background = background
+        self.fringes = fringes
+        self.fringeperiod = fringeperiod
+        self.fringeangle = fringeangle
+        self.shotnoise = shotnoise
+        self.framerate = framerate
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        self.nextframe = None
+        self._envelope = (None,None)
+
+    def configure(self,**settings):
+        """Change settings, with the names of the arguments of the constructor"""
+        for akey,avalue in settings.items():
+            if not hasattr(self,akey) or akey.startswith('_') or akey in ('rng','count','nextframe'):
+                raise ValueError('Unknown setting: {:s}'.format(akey))
+            setattr(self,akey,tuple(avalue) if isinstance(avalue,list) else avalue)
+
+    def settings(self):
+        """The current settings as a dictionary, see :py:meth:`configure`"""
+        return dict((akey,avalue) for akey,avalue in vars(self).items() if not akey.startswith('_') and akey not in ('rng','count','nextframe'))
+
+    def cloud(self,tof=None):
+        """Center (x, y), rms widths (x, y) and peak optical depth of the cloud after a time of flight in ms, in sensor pixels.
+        The widths grow as sqrt(sigma0^2 + kB T t^2/m) and the peak optical depth drops so the atom number is kept"""
+        t = (self.tof if tof is None else tof)*1e-3
+        velocity = np.sqrt(KB*self.temperature/self.mass)/self.pixelsize
+        sigma = tuple(np.sqrt(s0**2 + (velocity*t)**2) for s0 in self.sigma0)
+        drop = 0.5*G*t**2/self.pixelsize if self.gravity else 0
+        center = (self.center[0],self.center[1] + drop)
+        peak = self.peak_od*self.sigma0[0]*self.sigma0[1]/(sigma[0]*sigma[1])
+        return center,sigma,peak
+
+    def atom_number(self,crosssection=3*(461e-9)**2/(2*np.pi)):
+        """Number of atoms in the cloud for a cross section in m^2, the resonant cross section of the 461 nm line by default"""
+        return 2*np.pi*self.peak_od*self.sigma0[0]*self.sigma0[1]*self.pixelsize**2/crosssection
+
+    def _grid(self,bins,offset,shape):
+        """Sensor coordinates of the centers of the binned pixels of a region of the sensor"""
+        x = (offset[0] + np.arange(shape[1]))*bins + (bins - 1)/2
+        y = (offset[1] + np.arange(shape[0]))*bins + (bins - 1)/2
+        return x,y
+
+    def _beam(self,x,y):
+        """Counts of the probe beam without fringes, kept until the region or the beam changes"""
+        key = (len(x),len(y),x[0],y[0],x[-1],y[-1],self.probe,self.probewaist,self.sensorshape)
+        if self._envelope[0] != key:
+            wx,wy = self.probewaist
+            cx,cy = self.sensorshape[1]/2,self.sensorshape[0]/2
+            envelope = np.outer(np.exp(-2*(y - cy)**2/wy**2),np.exp(-2*(x - cx)**2/wx**2)).astype(np.float32)
+            self._envelope = (key,envelope*np.float32(self.probe))
+        return self._envelope[1]
+
+    def _probe(self,x,y):
+        """Counts of the probe beam with fringes of a new random phase"""
+        beam = self._beam(x,y)
+        if not self.fringes:
+            return beam.copy()
+        k = 2*np.pi/self.fringeperiod
+        phase = self.rng.uniform(0,2*np.pi)
+        #the fringes are separable as cos(a + b) = cos a cos b - sin a sin b, so no full size phase image is made
+        ax = k*np.cos(self.fringeangle)*x
+        ay = k*np.sin(self.fringeangle)*y + phase
+        fringes = np.outer(np.float32(self.fringes)*np.cos(ay,dtype=np.float32),np.cos(ax,dtype=np.float32))
+        fringes -= np.outer(np.float32(self.fringes)*np.sin(ay,dtype=np.float32),np.sin(ax,dtype=np.float32))
+        fringes += 1
+        fringes *= beam
+        return fringes
+
+    def _transmission(self,x,y):
+        center,sigma,peak = self.cloud()
+        ex = np.exp(-(x - center[0])**2/(2*sigma[0]**2)).astype(np.float32)
+        ey = np.exp(-(y - center[1])**2/(2*sigma[1]**2)).astype(np.float32)
+        transmission = np.outer(np.float32(-peak)*ey,ex)
+        return np.exp(transmission,out=transmission)
+
+    def _counts(self,counts,bins):
+        counts += np.float32(self.background)
+        if self.shotnoise:
+            #normal approximation of the shot noise, the camera averages bins x bins pixels each with its own noise
+            noise = self.rng.standard_normal(counts.shape,dtype=np.float32)
+            noise *= np.sqrt(counts)
+            noise /= bins
+            counts += noise
+        maxcount = 2**self.bitdepth - 1
+        np.clip(np.round(counts,out=counts),0,maxcount,out=counts)
+        return counts.astype(np.uint8 if self.bitdepth == 8 else np.uint16)
+
+    def frame(self,kind=None,bins=1,offset=(0,0),shape=None):
+        """Make the next frame of the sequence
+
+        :param kind: 'atoms', 'probe' or 'background', by default the next in the sequence atoms, probe, background
+        :param bins: binning of the sensor
+        :param offset: (x, y) offset of the region read out in binned pixels
+        :param shape: (rows, columns) of the region read out, the whole sensor by default
+        :return: image of shape (rows, columns)
+        :rtype: numpy.ndarray"""
+        if kind is None:
+            kind = ('atoms','probe','background')[self.count%3]
+        self.count += 1
+        if shape is None:
+            shape = (self.sensorshape[0]//bins,self.sensorshape[1]//bins)
+        x,y = self._grid(bins,offset,shape)
+        if kind == 'atoms':
+            counts = self._probe(x,y)
+            counts *= self._transmission(x,y)
+        elif kind == 'probe':
+            counts = self._probe(x,y)
+        elif kind == 'background':
+            counts = np.zeros(shape,dtype=np.float32)
+        else:
+            raise ValueError('Unknown kind of frame: {:s}'.format(kind))
+        return self._counts(counts,bins)
+
+    def wait_next_frame(self):
+        """Sleep until the next frame is due at the target frame rate. If the frames are fetched slower than that the rate is not caught up"""
+        now = time.time()
+        if self.nextframe is None or self.nextframe < now:
+            self.nextframe = now
+        time.sleep(self.nextframe - now)
+        self.nextframe += 1/self.framerate
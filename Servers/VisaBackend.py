@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Opens the visa connections of the Qweather instrument servers, either to the real instruments or to simulated ones.
+
+The backend is picked when the server starts, from the environment variable QWEATHER_VISA_BACKEND
+(visa, the default, or sim) or with :py:func:`set_backend`. The simulated instruments answer the SCPI commands
+used by the servers with synthetic waveforms, counter streams and readings, and model the link with a latency per
+message (QWEATHER_SIM_LATENCY, in seconds) and a bandwidth (QWEATHER_SIM_BANDWIDTH, in bytes/s).
+This way the servers can be run, benchmarked and profiled without any hardware.
+
+Example::
+
+    QWEATHER_VISA_BACKEND=sim QWEATHER_SIM_LATENCY=0.001 python RTB2004.py OSC1 10.90.61.10
+'''
+import os
+import re
+import time
+import collections
+import numpy as np
+__author__ = 'Asbjorn Arvad Jorgensen'
+__version__ = '1.0'
+__email__ = 'Asbjorn.Arvad@nbi.ku.dk'
+
+BACKEND = os.environ.get('QWEATHER_VISA_BACKEND','visa').lower()
+LATENCY = float(os.environ.get('QWEATHER_SIM_LATENCY',0.0005))
+BANDWIDTH = float(os.environ.get('QWEATHER_SIM_BANDWIDTH',50e6))
+
+
+def set_backend(backend,latency=None,bandwidth=None):
+    """Pick the backend used by :py:func:`open_resource`, and the link model of the simulated instruments
+
+    :param backend: visa or sim
+    :type backend: str
+    :param latency: time in seconds every message written to a simulated instrument takes
+    :type latency: float
+    :param bandwidth: bytes/s read from a simulated instrument
+    :type bandwidth: float"""
+    global BACKEND, LATENCY, BANDWIDTH
+    BACKEND = backend.lower()
+    if latency is not None:
+        LATENCY = latency
+    if bandwidth is not None:
+        BANDWIDTH = bandwidth
+
+
+def open_resource(address,model=None):
+    """Open a visa resource, or a simulated instrument if the sim backend is used
+
+    :param address: visa address of the instrument
+    :type address: str
+    :param model: name of the instrument model, see MODELS. Only used by the sim backend
+    :type model: str
+    :return: open visa resource, or an object with the same interface"""
+    if BACKEND == 'sim':
+        if model not in MODELS:
+            print('No simulation of {:}, using a generic instrument'.format(model))
+            return SimulatedInstrument(address)
+        simclass,kwargs = MODELS[model]
+        return simclass(address,**kwargs)
+    import visa
+    rm = visa.ResourceManager()
+    return rm.open_resource(address)
+
+
+def make_block(data):
+    """Make an IEEE 488.2 definite length binary block (#<n><length><data>)"""
+    length = str(len(data)).encode()
+    return b'#' + str(len(length)).encode() + length + data
+
+
+def synthetic_waveform(n,t0,dt,channel,segment=0,noise=0.01):
+    """A sine with a frequency and amplitude depending on the channel, plus white noise, as float32"""
+    t = t0 + dt*np.arange(n)
+    phase = 0.1*segment + np.random.uniform(0,0.01)
+    wave = np.sin(2*np.pi*1e4*channel*t + phase)/channel
+    wave += np.random.normal(0,noise,n)
+    return wave.astype(np.float32)
+
+
+class SimulatedTimeout(Exception):
+    pass
+
+
+class SimulatedInstrument:
+    """Simulated visa resource. Writes are split into SCPI program units at ';',
+    and every unit is matched against the regular expressions in commands, which name the method handling it.
+    Queries put their reply in an output queue read by read, read_raw and read_bytes, one message per write.
+    Commands without a handler are stored as settings, so querying them returns the last value set.
+
+    :param address: visa address
+    :type address: str
+    :param idn: reply to \\*IDN?
+    :type idn: str"""
+    commands = [(r'\*IDN\?','query_idn'),
+                (r'\*OPC\?','query_opc'),
+                (r'\*ESR\?','query_esr'),
+                (r'\*RST','reset')]
+
+    def __init__(self,address,idn='QWeather,Simulated instrument,0,1.0'):
+        self.address = address
+        self.idn = idn
+        self.timeout = 2000
+        self.latency = LATENCY
+        self.bandwidth = BANDWIDTH
+        self.command_latency = {}
+        self.settings = {}
+        self.output = collections.deque()
+        self.handlers = [(re.compile(pattern,re.IGNORECASE),getattr(self,name)) for pattern,name in self.commands]
+
+    def write(self,message):
+        delay = self.latency
+        replies = []
+        for unit in message.split(';'):
+            unit = unit.strip().lstrip(':')
+            if len(unit) == 0:
+                continue
+            reply = self.handle(unit)
+            delay += self.command_latency.get(unit.split(' ')[0].upper(),0)
+            if reply is not None:
+                replies.append(reply.encode() if isinstance(reply,str) else reply)
+        time.sleep(delay)
+        if len(replies) > 0:
+            self.output.append(b';'.join(replies) + b'\n')
+        return len(message)
+
+    def handle(self,unit):
+        for pattern,handler in self.handlers:
+            match = pattern.match(unit)
+            if match is not None:
+                return handler(*match.groups())
+        if '?' in unit:
+            return self.settings.get(unit.split('?')[0].upper(),'0')
+        header,_,value = unit.partition(' ')
+        self.settings[header.upper()] = value.strip()
+        return None
+
+    def _transfer(self,data):
+        time.sleep(len(data)/self.bandwidth)
+        return data
+
+    def read_bytes(self,count):
+        data = b''
+        while len(data) < count:
+            if len(self.output) == 0:
+                raise SimulatedTimeout('No data to read from {:s}'.format(self.address))
+            message = self.output.popleft()
+            needed = count - len(data)
+            if len(message) > needed:
+                self.output.appendleft(message[needed:])
+                message = message[:needed]
+            data += message
+        return self._transfer(data)
+
+    def read_raw(self):
+        if len(self.output) == 0:
+            raise SimulatedTimeout('No data to read from {:s}'.format(self.address))
+        return self._transfer(self.output.popleft())
+
+    def read(self):
+        return self.read_raw().decode().rstrip('\n')
+
+    def query(self,message):
+        self.write(message)
+        return self.read()
+
+    def query_binary_values(self,message,datatype='f',is_big_endian=False,container=list):
+        self.write(message)
+        raw = self.read_raw()
+        start = raw.index(b'#')
+        ndigits = int(raw[start+1:start+2])
+        length = int(raw[start+2:start+2+ndigits])
+        block = raw[start+2+ndigits:start+2+ndigits+length]
+        values = np.frombuffer(block,dtype=('>' if is_big_endian else '<') + datatype)
+        return container(values)
+
+    def close(self):
+        pass
+
+    def clear(self):
+        self.output.clear()
+
+    def query_idn(self):
+        return self.idn
+
+    def query_opc(self):
+        return '1'
+
+    def query_esr(self):
+        return '1' #operations complete at once
+
+    def reset(self):
+        self.settings = {}
+
+
+class SimulatedScope(SimulatedInstrument):
+    """Base for the simulated oscilloscopes: time window, acquisitions and the measurement places"""
+    commands = SimulatedInstrument.commands + [
+                (r'(SING|RUN|STOP)$','acquire'),
+                (r'MEAS(\d+):RES:(AVG|STDD|NPE|PPE|WFMC)\?','query_statistic'),
+                (r'MEAS(\d+):RES\? (\w+)','query_result')]
+
+    def __init__(self,address,idn,npoints=10000,window=1e-3):
+        super().__init__(address,idn)
+        self.npoints = npoints
+        self.window = window
+        self.acquisitions = 0
+
+    def acquire(self,command):
+        self.acquisitions += 1
+
+    def query_statistic(self,place,statistic):
+        values = {'AVG':0.,'STDD':0.01,'NPE':-1/int(place),'PPE':1/int(place),'WFMC':self.acquisitions}
+        return '{:e}'.format(values[statistic.upper()])
+
+    def query_result(self,place,measurement):
+        values = {'PEAK':2/int(place),'MEAN':0.,'STDD':0.7/int(place),'LPE':-1/int(place),'UPE':1/int(place)}
+        return '{:e}'.format(values.get(measurement.upper(),0.))
+
+
+class RSScope(SimulatedScope):
+    """Simulated Rohde&Schwarz oscilloscope (RTB2004, HMO3004, RTO1044): CHANn/REFCn data and headers in REAL,32 and the history memory
+
+    :param byteorder: > or <, the byte order of the samples the server expects
+    :type byteorder: str
+    :param maxpoints: number of points with DATA:POIN MAX
+    :type maxpoints: int"""
+    commands = SimulatedScope.commands + [
+                (r'(CHAN|REFC)(\d):DATA:POIN (\w+)','set_points'),
+                (r'(CHAN|REFC)(\d):DATA:HEAD\?','query_head'),
+                (r'(CHAN|REFC)(\d):DATA\?','query_data'),
+                (r'CHAN(\d):HIST:CURR (-?\d+)','set_segment'),
+                (r'CHAN(\d):HIST:TSR\?','query_segment_time')]
+
+    def __init__(self,address,idn='Rohde&Schwarz,Simulated oscilloscope,0,1.0',byteorder='>',maxpoints=100000,defpoints=10000):
+        super().__init__(address,idn,defpoints)
+        self.dtype = byteorder + 'f4'
+        self.maxpoints = maxpoints
+        self.defpoints = defpoints
+        self.segment = 0
+
+    def set_points(self,kind,channel,points):
+        points = points.upper()
+        if points == 'MAX':
+            self.npoints = self.maxpoints
+        elif points == 'DEF':
+            self.npoints = self.defpoints
+        else:
+            self.npoints = int(points)
+
+    def query_head(self,kind,channel):
+        return '{:e},{:e},{:d},1'.format(-self.window/2,self.window/2,self.npoints)
+
+    def query_data(self,kind,channel):
+        dt = self.window/(self.npoints - 1)
+        wave = synthetic_waveform(self.npoints,-self.window/2,dt,int(channel),self.segment)
+        return make_block(wave.astype(self.dtype).tobytes())
+
+    def set_segment(self,channel,segment):
+        self.segment = int(segment)
+
+    def query_segment_time(self,channel):
+        return '{:e}'.format(self.segment*1e-3)
+
+
+class RigolScope(SimulatedScope):
+    """Simulated Rigol DS1000Z oscilloscope: the :WAV subsystem with BYTE and WORD codes, the preamble and chunked reads"""
+    commands = SimulatedScope.commands + [
+                (r'WAV:SOUR (\w+)','set_source'),
+                (r'WAV:FORM (\w+)','set_format'),
+                (r'WAV:STAR (\d+)','set_start'),
+                (r'WAV:STOP (\d+)','set_stop'),
+                (r'WAV:PRE\?','query_preamble'),
+                (r'WAV:DATA\?','query_data'),
+                (r'TRIG:STAT\?','query_trigger'),
+                (r'FUNC:WREC:OPER (\w+)','record')]
+    chunk = {'BYTE':250000,'WORD':125000}
+
+    def __init__(self,address,idn='RIGOL TECHNOLOGIES,Simulated DS1104Z,0,1.0',npoints=300000):
+        super().__init__(address,idn,npoints,window=12e-3)
+        self.source = 1
+        self.format = 'BYTE'
+        self.start = 1
+        self.stop = npoints
+        self.yinc = 8/250
+        self.yref = 127
+        self.settings['FUNC:WREC:OPER'] = 'STOP'
+        self.settings['FUNC:WREC:FINT'] = '1e-3'
+        self.armed = False
+
+    def set_source(self,source):
+        self.source = int(re.sub(r'\D','',source) or 1)
+
+    def set_format(self,wavformat):
+        self.format = wavformat.upper()[:4]
+
+    def set_start(self,start):
+        self.start = int(start)
+
+    def set_stop(self,stop):
+        self.stop = int(stop)
+
+    def query_preamble(self):
+        xinc = self.window/self.npoints
+        formats = ['BYTE','WORD','ASC']
+        return '{:d},0,{:d},1,{:e},{:e},0,{:e},0,{:d}'.format(formats.index(self.format),self.npoints,xinc,-self.window/2,self.yinc,self.yref)
+
+    def query_data(self):
+        stop = min(self.stop,self.npoints,self.start + self.chunk[self.format] - 1)
+        n = stop - self.start + 1
+        xinc = self.window/self.npoints
+        wave = synthetic_waveform(n,-self.window/2 + (self.start - 1)*xinc,xinc,self.source)
+        codes = np.clip(np.round(wave/self.yinc + self.yref),0,255)
+        dtype = 'u1' if self.format == 'BYTE' else '<u2'
+        return make_block(codes.astype(dtype).tobytes())
+
+    def acquire(self,command):
+        super().acquire(command)
+        self.armed = command.upper() == 'SING'
+
+    def query_trigger(self):
+        if self.armed: #triggers right after the first poll
+            self.armed = False
+            return 'WAIT'
+        return 'STOP'
+
+    def record(self,operation):
+        self.acquisitions += 1
+
+
+class Counter(SimulatedInstrument):
+    """Simulated frequency counter (CNT90, Agilent 53230A). Streams frequencies with white and random walk noise
+    in the packed format (8 byte float frequency, 8 byte integer timestamp in ps) or as ASCII readings"""
+    commands = SimulatedInstrument.commands + [
+                (r'ACQ:APER ([0-9.eE+-]+)','set_gatetime'),
+                (r'FREQ:GATE:TIME ([0-9.eE+-]+)','set_gatetime'),
+                (r'(INIT|ABOR)','restart'),
+                (r'MEAS:FREQ\?','query_frequency'),
+                (r'MEM:DATA:REC:FETC:ARR\? (\d+),(\d+)','query_memory'),
+                (r'FETC:ARR\? \(?(\d+)\)?','query_array'),
+                (r'R\?','query_readings')]
+
+    def __init__(self,address,idn='Pendulum,Simulated counter,0,1.0',frequency=10e6,noise=0.1):
+        super().__init__(address,idn)
+        self.frequency = frequency
+        self.noise = noise
+        self.gatetime = 0.1
+        self.drift = 0.
+        self.stamp = 0.
+
+    def set_gatetime(self,gatetime):
+        self.gatetime = float(gatetime)
+
+    def restart(self,command):
+        self.stamp = 0.
+
+    def stream(self,n):
+        """The next n frequencies and their timestamps in s"""
+        self.drift += np.cumsum(np.random.normal(0,self.noise*0.1,n))
+        freqs = self.frequency + self.drift + np.random.normal(0,self.noise,n)
+        self.drift = self.drift[-1]
+        stamps = self.stamp + self.gatetime*np.arange(1,n+1)
+        self.stamp = stamps[-1]
+        return freqs,stamps
+
+    def query_frequency(self):
+        return '{:.12e}'.format(self.stream(1)[0][0])
+
+    def query_array(self,n):
+        freqs,stamps = self.stream(int(n))
+        packed = np.empty(int(n),dtype=[('freq','>f8'),('stamp','>u8')])
+        packed['freq'] = freqs
+        packed['stamp'] = np.round(stamps*1e12)
+        return make_block(packed.tobytes())
+
+    def query_memory(self,location,n):
+        return self.query_array(n)
+
+    def query_readings(self):
+        freqs,stamps = self.stream(100)
+        return make_block(','.join('{:.12e}'.format(af) for af in freqs).encode())
+
+
+class Multimeter(SimulatedInstrument):
+    """Simulated multimeter (RSMultimeter, Agilent 34461A). Readings are a constant value plus noise, with running statistics"""
+    commands = SimulatedInstrument.commands + [
+                (r'(FETC|READ|MEAS(:\w+)*)\?','query_reading'),
+                (r'CALC:AVER:(AVER|MAX|MIN|SDEV|COUN)\?','query_statistic'),
+                (r'CALC:AVER:CLE','clear_statistics'),
+                (r'R\?','query_readings')]
+
+    def __init__(self,address,idn='QWeather,Simulated multimeter,0,1.0',value=1.,noise=1e-4):
+        super().__init__(address,idn)
+        self.value = value
+        self.noise = noise
+        self.readings = []
+
+    def reading(self):
+        value = self.value + np.random.normal(0,self.noise)
+        self.readings.append(value)
+        return value
+
+    def query_reading(self,*command):
+        return '{:.9e}'.format(self.reading())
+
+    def query_statistic(self,statistic):
+        if len(self.readings) == 0:
+            self.reading()
+        functions = {'AVER':np.mean,'MAX':np.max,'MIN':np.min,'SDEV':np.std,'COUN':len}
+        return '{:.9e}'.format(functions[statistic.upper()](self.readings))
+
+    def clear_statistics(self):
+        self.readings = []
+
+    def query_readings(self):
+        return make_block(','.join('{:.9e}'.format(self.reading()) for i in range(100)).encode())
+
+
+#Simulated instrument class and its arguments for every model
+MODELS = {'RTB2004':(RSScope,{'idn':'Rohde&Schwarz,RTB2004 (simulated),0,1.0','byteorder':'>'}),
+          'HMO3004':(RSScope,{'idn':'Rohde&Schwarz,HMO3004 (simulated),0,1.0','byteorder':'<'}),
+          'RTO1044':(RSScope,{'idn':'Rohde&Schwarz,RTO1044 (simulated),0,1.0','byteorder':'>','maxpoints':1000000}),
+          'DS1104Z':(RigolScope,{'idn':'RIGOL TECHNOLOGIES,DS1104Z (simulated),0,1.0'}),
+          'CNT90':(Counter,{'idn':'Pendulum,CNT-90 (simulated),0,1.0'}),
+          'Agilent 53230A':(Counter,{'idn':'Agilent Technologies,53230A (simulated),0,1.0'}),
+          'RSMultimeter':(Multimeter,{'idn':'Rohde&Schwarz,HMC8012 (simulated),0,1.0'}),
+          'Agilent 34461A':(Multimeter,{'idn':'Agilent Technologies,34461A (simulated),0,1.0','value':1000.}),
+          'DG1002':(SimulatedInstrument,{'idn':'RIGOL TECHNOLOGIES,DG1002 (simulated),0,1.0'}),
+          'DG1022':(SimulatedInstrument,{'idn':'RIGOL TECHNOLOGIES,DG1022 (simulated),0,1.0'}),
+          'DG1062':(SimulatedInstrument,{'idn':'RIGOL TECHNOLOGIES,DG1062 (simulated),0,1.0'})}
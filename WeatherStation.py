@@ -1,7 +1,9 @@
 from PyQt5.QtWidgets import *
 from PyQt5 import QtGui
-import asyncio
 import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'Clients'))
+import QtLoop
 sys.path.append('../')
 from qweather import QWeatherStation
 
@@ -77,10 +79,6 @@ class BrokerGui(QWidget):
         self.clientlist.setText(clienttext)
 
 
-async def process_events(qapp):
-    while True:
-        await asyncio.sleep(0)
-        qapp.processEvents()
 
 def icon():
     iconstring = ["40 40 4 1","   c #FFFFFF",".  c #000000","+  c #AE7C3C","@  c #FF1E00",
@@ -103,10 +101,8 @@ if __name__=="__main__":
     ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
 #    loop = QEventLoop(a)
  #   asyncio.set_event_loop(loop)
-    loop = asyncio.get_event_loop()
+    loop = QtLoop.make_loop(a)
     w = BrokerGui(loop)
-    loop.run_until_complete(process_events(a))
+    QtLoop.run(loop)
 #    with loop:
  #      loop.run_until_complete(w.client.run())
-
-    sys.exit(a.exec_())
\ No newline at end of file